@@ -0,0 +1,70 @@
+import argparse
+import time
+
+import numpy as np
+
+from genotype import GenotypeDecoder
+
+
+# Microbenchmark comparing the lookup-table GenotypeDecoder against the per-cell np.vectorize genotype mapper
+# it replaced in transform_genotype_data_vcf
+# Run from the repository root with: python -m benchmarks.genotype_decoding [--samples N] [--snps N]
+
+
+# The original per-cell mapper from transform_genotype_data_vcf
+def legacy_genotype_mapper(gen):
+    alleles = gen.split('|')
+    if (alleles[0] != '0' and alleles[0] != '1') or (alleles[1] != '0' and alleles[1] != '1'):
+        return -1
+    else:
+        return int(alleles[0]) + int(alleles[1])
+
+
+# Generate a block of synthetic GT fields (SNPs x samples) with a mix of phased, unphased and missing calls
+def synthetic_block(rng, num_snps, num_samples):
+    calls = np.array([b'0|0', b'0|1', b'1|0', b'1|1', b'0/1', b'./.'])
+    return calls[rng.choice(len(calls), size=(num_snps, num_samples), p=[0.4, 0.2, 0.2, 0.1, 0.05, 0.05])]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark genotype decoding')
+    parser.add_argument('--samples', type=int, default=10000)
+    parser.add_argument('--snps', type=int, default=100000)
+    parser.add_argument('--block-size', type=int, default=1000, help='SNPs generated and decoded at a time')
+    parser.add_argument('--legacy-snps', type=int, default=2000,
+                        help='SNPs timed on the np.vectorize path, which is extrapolated to --snps')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    decoder = GenotypeDecoder()
+    legacy = np.vectorize(legacy_genotype_mapper)
+
+    lut_seconds = 0.0
+    legacy_seconds = 0.0
+    legacy_snps = 0
+    for start in range(0, args.snps, args.block_size):
+        block = synthetic_block(rng, min(args.block_size, args.snps - start), args.samples)
+
+        t = time.perf_counter()
+        decoder.decode(block)
+        lut_seconds += time.perf_counter() - t
+
+        if legacy_snps < args.legacy_snps:
+            cells = block[:args.legacy_snps - legacy_snps].astype(str).astype(object).transpose()
+            t = time.perf_counter()
+            legacy(cells)
+            legacy_seconds += time.perf_counter() - t
+            legacy_snps += cells.shape[1]
+
+    num_genotypes = args.samples * args.snps
+    legacy_estimate = legacy_seconds * args.snps / max(1, legacy_snps)
+    print('matrix: {} samples x {} SNPs ({} genotypes)'.format(args.samples, args.snps, num_genotypes))
+    print('lookup table:  {:10.2f} s  {:14.0f} genotypes/s'.format(lut_seconds, num_genotypes / lut_seconds))
+    print('np.vectorize:  {:10.2f} s  {:14.0f} genotypes/s  (extrapolated from {} SNPs)'.format(
+        legacy_estimate, num_genotypes / legacy_estimate, legacy_snps))
+    print('speedup:       {:10.1f}x'.format(legacy_estimate / lut_seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from benchmarks.synthetic import write_synthetic_covariates, write_synthetic_vcf
+from converter import open_vcf_source, read_vcf_header, transform_covariate_data, transform_genotype_data_vcf
+from preprocess import transform_genotype_data_vcf_parallel
+
+
+# Benchmark harness for the preprocessing pipeline
+# Synthetic inputs are generated for every size, and each preprocessing stage is run in a fresh process, so that the
+# peak RSS reported for a stage belongs to that stage alone; results are written as JSON, and can be compared against
+# an earlier results file to flag stages that got slower
+# Run from the repository root with: python -m benchmarks.preprocessing [--sizes toy small] [--output results.json]
+
+
+# (samples, SNPs) of every named input size
+SIZES = {
+    'toy': (100, 1000),
+    'small': (1000, 10000),
+    'medium': (5000, 100000),
+    'large': (10000, 1000000)
+}
+
+STAGES = ['genotype_serial', 'genotype_parallel', 'genotype_binary', 'covariates']
+
+
+def peak_rss_bytes(who):
+    # ru_maxrss is in kilobytes on Linux, but in bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(who).ru_maxrss * scale
+
+
+# Run one stage on the given inputs in the current process and return its measurements
+# Inputs are passed as open streams, since the converters delete input files given by path
+def run_stage(stage, vcf, cov, out_dir):
+    # the covariates are aligned to the genotype subject order, which is read outside of the timed part
+    if stage == 'covariates':
+        with open_vcf_source(vcf) as f:
+            columns, offset_index = read_vcf_header(f)
+        ids = columns[offset_index:]
+
+    start = time.perf_counter()
+    with open(vcf if stage != 'covariates' else cov, 'rb') as source:
+        if stage == 'genotype_serial':
+            transform_genotype_data_vcf(source, out_dir=out_dir)
+        elif stage == 'genotype_parallel':
+            transform_genotype_data_vcf_parallel(source, out_dir=out_dir)
+        elif stage == 'genotype_binary':
+            transform_genotype_data_vcf(source, binary=True, out_dir=out_dir)
+        elif stage == 'covariates':
+            transform_covariate_data(source, ids, out_dir=out_dir)
+        else:
+            raise ValueError('Unknown stage {}'.format(stage))
+    seconds = time.perf_counter() - start
+
+    output_bytes = sum(os.path.getsize(os.path.join(out_dir, name)) for name in os.listdir(out_dir))
+    return {
+        'seconds': seconds,
+        'peak_rss_bytes': peak_rss_bytes(resource.RUSAGE_SELF),
+        'peak_child_rss_bytes': peak_rss_bytes(resource.RUSAGE_CHILDREN),
+        'output_bytes': output_bytes
+    }
+
+
+# Run a stage in a freshly spawned process
+def run_stage_isolated(stage, vcf, cov, out_dir):
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(run_stage, stage, vcf, cov, out_dir).result()
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                universal_newlines=True).stdout.strip()
+    except OSError:
+        commit = ''
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S')
+    }
+
+
+def benchmark_size(name, num_samples, num_snps, stages, work_dir, args):
+    vcf = os.path.join(work_dir, '{}.vcf.gz'.format(name))
+    cov = os.path.join(work_dir, '{}-cov.txt'.format(name))
+
+    start = time.perf_counter()
+    ids = write_synthetic_vcf(vcf, num_samples, num_snps, args.phased_fraction, args.missing_rate, args.seed)
+    write_synthetic_covariates(cov, ids, args.seed)
+    print('{}: generated {} samples x {} SNPs in {:.1f} s ({:.1f} MB gzipped)'.format(
+        name, num_samples, num_snps, time.perf_counter() - start, os.path.getsize(vcf) / 1e6))
+
+    results = []
+    for stage in stages:
+        out_dir = tempfile.mkdtemp(dir=work_dir)
+        try:
+            result = run_stage_isolated(stage, vcf, cov, out_dir)
+        finally:
+            shutil.rmtree(out_dir)
+
+        # covariate throughput is per subject, everything else per genotype
+        items = num_samples if stage == 'covariates' else num_samples * num_snps
+        result.update({
+            'size': name,
+            'stage': stage,
+            'samples': num_samples,
+            'snps': num_snps,
+            'throughput': items / result['seconds'],
+            'throughput_unit': 'subjects/s' if stage == 'covariates' else 'genotypes/s'
+        })
+        results.append(result)
+        print('{}: {:18s} {:9.2f} s  {:14.0f} {:12s} peak RSS {:8.1f} MB (children {:8.1f} MB)'.format(
+            name, stage, result['seconds'], result['throughput'], result['throughput_unit'],
+            result['peak_rss_bytes'] / 1e6, result['peak_child_rss_bytes'] / 1e6))
+
+    os.remove(vcf)
+    os.remove(cov)
+    return results
+
+
+# Print the stages whose throughput dropped by more than tolerance compared to a baseline results file, and return
+# how many there were
+def compare_to_baseline(results, baseline_fname, tolerance):
+    with open(baseline_fname) as f:
+        baseline = {(r['size'], r['stage']): r for r in json.load(f)['results']}
+
+    regressions = 0
+    for result in results:
+        previous = baseline.get((result['size'], result['stage']))
+        if previous is None:
+            continue
+        change = result['throughput'] / previous['throughput'] - 1
+        flag = ''
+        if change < -tolerance:
+            flag = '  REGRESSION'
+            regressions += 1
+        print('{}: {:18s} {:+7.1%} throughput vs baseline{}'.format(result['size'], result['stage'], change, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the preprocessing pipeline on synthetic data')
+    parser.add_argument('--sizes', nargs='+', default=['toy', 'small'], choices=sorted(SIZES))
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES)
+    parser.add_argument('--phased-fraction', type=float, default=0.9)
+    parser.add_argument('--missing-rate', type=float, default=0.01)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--work-dir', help='directory for the generated inputs (default: a temporary directory)')
+    parser.add_argument('--output', default='preprocessing-results.json', help='JSON file to write the results to')
+    parser.add_argument('--baseline', help='earlier results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='fraction by which throughput may drop compared to the baseline before it counts as a regression')
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='gwas-bench-')
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        results = []
+        for name in args.sizes:
+            num_samples, num_snps = SIZES[name]
+            results += benchmark_size(name, num_samples, num_snps, args.stages, work_dir, args)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir)
+
+    with open(args.output, 'w') as f:
+        json.dump({'environment': environment(), 'results': results}, f, indent=2)
+    print('Wrote results to {}'.format(args.output))
+
+    if args.baseline and compare_to_baseline(results, args.baseline, args.tolerance) > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
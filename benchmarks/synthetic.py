@@ -0,0 +1,100 @@
+import argparse
+import gzip
+
+import numpy as np
+
+
+# Generators for reproducible synthetic input data: gzipped VCF files with a GT field per sample, and the tab separated
+# covariate files that go with them
+# Genotypes are drawn per SNP from a random allele frequency, and a configurable fraction of calls are unphased or
+# missing; the same arguments and seed always produce the same files
+# Run from the repository root with: python -m benchmarks.synthetic VCF_PATH [--samples N] [--snps N] [--cov PATH]
+
+
+# Text of every GT field, indexed by 2 * first allele + second allele, plus 4 if unphased; 8 and 9 are missing calls
+GT_FIELDS = [b'0|0', b'0|1', b'1|0', b'1|1', b'0/0', b'0/1', b'0/1', b'1/1', b'.|.', b'./.']
+
+# Roughly the number of bytes of genotype text generated at once
+GENERATE_BLOCK_BYTES = 32 * 1024 * 1024
+
+POPULATIONS = ['ACB', 'CEU', 'CHB', 'FIN', 'GBR', 'JPT', 'YRI']
+
+
+def sample_ids(num_samples):
+    return ['S{:07d}'.format(i) for i in range(num_samples)]
+
+
+def vcf_header(ids):
+    lines = [
+        b'##fileformat=VCFv4.1\n',
+        b'##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n',
+        '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t{}\n'.format('\t'.join(ids)).encode('utf-8')
+    ]
+    return b''.join(lines)
+
+
+# Genotype text (without line prefixes) for a block of num_snps SNPs, as a (num_snps, 4 * num_samples) byte matrix
+def genotype_block(rng, num_snps, num_samples, phased_fraction, missing_rate):
+    freqs = rng.uniform(0.05, 0.5, size=(num_snps, 1))
+    codes = 2 * (rng.random((num_snps, num_samples)) < freqs) + (rng.random((num_snps, num_samples)) < freqs)
+    unphased = rng.random((num_snps, num_samples)) >= phased_fraction
+    codes = codes + 4 * unphased
+    missing = rng.random((num_snps, num_samples)) < missing_rate
+    codes[missing] = 8 + unphased[missing]
+
+    table = np.array([list(field + b'\t') for field in GT_FIELDS], dtype=np.uint8)
+    block = table[codes].reshape(num_snps, 4 * num_samples)
+    block[:, -1] = ord('\n')
+    return block
+
+
+# Write a gzipped VCF with num_samples samples and num_snps SNPs on a single chromosome
+def write_synthetic_vcf(fname, num_samples, num_snps, phased_fraction=0.9, missing_rate=0.01, seed=0,
+                        compresslevel=1):
+    rng = np.random.default_rng(seed)
+    snps_per_block = max(1, GENERATE_BLOCK_BYTES // (4 * num_samples))
+    position = 0
+    with gzip.open(fname, 'wb', compresslevel=compresslevel) as f:
+        f.write(vcf_header(sample_ids(num_samples)))
+        for start in range(0, num_snps, snps_per_block):
+            n = min(snps_per_block, num_snps - start)
+            positions = position + np.cumsum(rng.integers(1, 1000, size=n))
+            position = int(positions[-1])
+            block = genotype_block(rng, n, num_samples, phased_fraction, missing_rate)
+            for i in range(n):
+                f.write('1\t{}\trs{}\tA\tG\t.\tPASS\t.\tGT\t'.format(positions[i], start + i).encode('utf-8'))
+                f.write(block[i].tobytes())
+    return sample_ids(num_samples)
+
+
+# Write a covariate file for the given sample ids, with the columns transform_covariate_data reads by default plus an
+# age column; rows are shuffled so the covariate pipeline has to realign them to the genotype order
+def write_synthetic_covariates(fname, ids, seed=0):
+    rng = np.random.default_rng(seed)
+    sexes = rng.choice(['female', 'male'], size=len(ids))
+    populations = rng.choice(POPULATIONS, size=len(ids))
+    ages = rng.integers(18, 90, size=len(ids))
+    with open(fname, 'w') as f:
+        f.write('Sample name\tSex\tPopulation code\tAge\n')
+        for i in rng.permutation(len(ids)):
+            f.write('{}\t{}\t{}\t{}\n'.format(ids[i], sexes[i], populations[i], ages[i]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic gzipped VCF and covariate file')
+    parser.add_argument('vcf', help='path of the .vcf.gz file to write')
+    parser.add_argument('--samples', type=int, default=1000)
+    parser.add_argument('--snps', type=int, default=10000)
+    parser.add_argument('--phased-fraction', type=float, default=0.9)
+    parser.add_argument('--missing-rate', type=float, default=0.01)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cov', help='also write a covariate file for the samples to this path')
+    args = parser.parse_args()
+
+    ids = write_synthetic_vcf(args.vcf, args.samples, args.snps, args.phased_fraction, args.missing_rate, args.seed)
+    if args.cov:
+        write_synthetic_covariates(args.cov, ids, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+import struct
+import sys
+
+import numpy as np
+
+
+# This file contains the compact binary format used to store and transfer the geno, pheno and cov matrices
+# A file is a fixed size header followed by the matrix in row-major order, so it can be opened directly with np.memmap
+# Genotype matrices are packed 4 values per byte (2 bits per dosage, with 3 marking a missing call), and every row
+# starts on a byte boundary so that individual rows can be read without unpacking the whole file
+# Other matrices are stored one byte per value, or four bytes per value when some value doesn't fit in a byte (e.g.
+# numeric covariates)
+# The file only depends on numpy so that it can be copied to a compute instance and run there to produce the text
+# files expected by the secure-gwas binaries:
+#   python3 binformat.py geno.bin geno.txt
+
+
+MAGIC = b'GWASBIN\x00'
+VERSION = 1
+HEADER_FORMAT = '<8sHHQQ'
+HEADER_SIZE = 32
+
+# Supported matrix encodings
+ENCODING_INT8 = 0
+ENCODING_PACKED2 = 1
+ENCODING_INT32 = 2
+
+# Type of the values stored for every encoding
+STORED_DTYPES = {
+    ENCODING_INT8: np.int8,
+    ENCODING_PACKED2: np.uint8,
+    ENCODING_INT32: np.int32
+}
+
+# 2-bit code used for missing genotypes (-1)
+PACKED_MISSING = 3
+
+# Default number of bytes of matrix data held in memory at once when converting to text
+CONVERT_BLOCK_BYTES = 64 * 1024 * 1024
+
+
+# Write an integer matrix as space separated text, producing the same bytes as np.savetxt(fmt='%i')
+# Blocks made up entirely of single digit values are formatted directly as a byte array
+def write_int_matrix(f, matrix):
+    if matrix.size == 0:
+        return
+    if matrix.min() < 0 or matrix.max() > 9:
+        np.savetxt(f, matrix.astype(int), fmt='%i')
+        return
+    out = np.full((matrix.shape[0], 2 * matrix.shape[1]), ord(' '), dtype=np.uint8)
+    out[:, 0::2] = matrix + ord('0')
+    out[:, -1] = ord('\n')
+    f.write(out.tobytes())
+
+
+# Number of values stored for one row of num_cols values in the given encoding
+def row_values(encoding, num_cols):
+    if encoding == ENCODING_PACKED2:
+        return (num_cols + 3) // 4
+    return num_cols
+
+
+# Number of bytes used to store one row of num_cols values in the given encoding
+def row_bytes(encoding, num_cols):
+    return row_values(encoding, num_cols) * np.dtype(STORED_DTYPES[encoding]).itemsize
+
+
+# Smallest unpacked encoding that can hold every value of the matrix
+def int_encoding(matrix):
+    if matrix.size == 0 or (matrix.min() >= np.iinfo(np.int8).min and matrix.max() <= np.iinfo(np.int8).max):
+        return ENCODING_INT8
+    return ENCODING_INT32
+
+
+# Pack a block of dosages (values 0, 1, 2 or -1 for missing) into 2-bit codes, 4 per byte
+def pack_genotypes(matrix):
+    codes = np.where(matrix < 0, PACKED_MISSING, matrix).astype(np.uint8)
+    num_rows, num_cols = codes.shape
+    padded = np.zeros((num_rows, 4 * row_values(ENCODING_PACKED2, num_cols)), dtype=np.uint8)
+    padded[:, :num_cols] = codes
+    padded = padded.reshape(num_rows, -1, 4)
+    return padded[..., 0] | (padded[..., 1] << 2) | (padded[..., 2] << 4) | (padded[..., 3] << 6)
+
+
+# Unpack a block of 2-bit packed rows back into int8 dosages with -1 for missing calls
+def unpack_genotypes(packed, num_cols):
+    codes = np.stack([(packed >> shift) & 3 for shift in (0, 2, 4, 6)], axis=-1).reshape(packed.shape[0], -1)
+    codes = codes[:, :num_cols].astype(np.int8)
+    codes[codes == PACKED_MISSING] = -1
+    return codes
+
+
+# Write a matrix file from an iterable of row blocks, which must add up to num_rows rows of num_cols values each
+# Raises ValueError if a value doesn't fit in the encoding, rather than writing it wrapped around
+def write_matrix_file(fname, blocks, num_rows, num_cols, encoding=ENCODING_INT8):
+    with open(fname, 'wb') as f:
+        f.write(struct.pack(HEADER_FORMAT, MAGIC, VERSION, encoding, num_rows, num_cols).ljust(HEADER_SIZE, b'\0'))
+        for block in blocks:
+            if encoding == ENCODING_PACKED2:
+                f.write(pack_genotypes(block).tobytes())
+                continue
+            block = np.asarray(block)
+            limits = np.iinfo(STORED_DTYPES[encoding])
+            if block.size and (block.min() < limits.min or block.max() > limits.max):
+                raise ValueError('{} has values between {} and {}, which do not fit in {}'.format(
+                    fname, block.min(), block.max(), limits.dtype))
+            f.write(block.astype(STORED_DTYPES[encoding]).tobytes())
+
+
+# Read the header of a matrix file, returning its encoding and its shape
+def read_matrix_header(fname):
+    with open(fname, 'rb') as f:
+        magic, version, encoding, num_rows, num_cols = struct.unpack(HEADER_FORMAT, f.read(struct.calcsize(HEADER_FORMAT)))
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('{} is not a version {} GWAS binary matrix file'.format(fname, VERSION))
+    if encoding not in STORED_DTYPES:
+        raise ValueError('{} uses the unknown matrix encoding {}'.format(fname, encoding))
+    return encoding, num_rows, num_cols
+
+
+# Memory map the stored rows of a matrix file, i.e. the packed bytes for a genotype matrix
+def open_matrix_file(fname):
+    encoding, num_rows, num_cols = read_matrix_header(fname)
+    data = np.memmap(fname, dtype=STORED_DTYPES[encoding], mode='r', offset=HEADER_SIZE,
+                     shape=(num_rows, row_values(encoding, num_cols)))
+    return encoding, num_cols, data
+
+
+# Yield the decoded rows of a matrix file in blocks holding at most max_bytes of stored data
+def iter_matrix_rows(fname, max_bytes=CONVERT_BLOCK_BYTES):
+    encoding, num_cols, data = open_matrix_file(fname)
+    step = max(1, max_bytes // max(1, data.shape[1] * data.itemsize))
+    for start in range(0, data.shape[0], step):
+        block = np.asarray(data[start:start + step])
+        yield unpack_genotypes(block, num_cols) if encoding == ENCODING_PACKED2 else block
+
+
+# Load a whole matrix file into memory, as an int8 array unless its values were stored four bytes each
+def load_matrix_file(fname):
+    encoding, num_rows, num_cols = read_matrix_header(fname)
+    return np.vstack(list(iter_matrix_rows(fname)) or [np.zeros((0, num_cols), dtype=np.int8)])
+
+
+# Convert a matrix file into the text format (one row per line, space separated) read by the secure-gwas binaries
+def convert_matrix_file_to_text(fname, out_fname, max_bytes=CONVERT_BLOCK_BYTES):
+    with open(out_fname, 'wb') as f:
+        for block in iter_matrix_rows(fname, max_bytes):
+            write_int_matrix(f, block)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or len(sys.argv) % 2 != 1:
+        print('usage: python3 binformat.py IN.bin OUT.txt [IN.bin OUT.txt ...]')
+        sys.exit(1)
+    for i in range(1, len(sys.argv), 2):
+        convert_matrix_file_to_text(sys.argv[i], sys.argv[i + 1])
@@ -0,0 +1,65 @@
+import itertools
+
+from cache import TTLCache
+
+
+# This file contains helpers for browsing the Cloud Storage blobs that can be used as GWAS input data
+# Blobs are listed lazily page by page, filtered by prefix and file type, and only the first few matches are kept in a
+# per-project index; a chosen blob is later fetched directly by its bucket and name rather than by listing again
+
+
+# How long (in seconds) a listing is reused before the buckets are listed again
+BLOB_INDEX_TTL = 300
+
+# Maximum number of blobs offered for selection at once
+BLOB_LIST_LIMIT = 50
+
+# Number of blobs requested per page while listing a bucket
+BLOB_PAGE_SIZE = 1000
+
+# File types that can hold genotype (VCF) or covariate (tab separated) data
+INPUT_BLOB_SUFFIXES = ('.vcf.gz', '.tsv', '.txt', '.csv')
+
+blob_index = TTLCache(BLOB_INDEX_TTL)
+
+
+# Blobs are identified in the UI by the key bucket/name
+def blob_key(bucket_name, blob_name):
+    return '{}/{}'.format(bucket_name, blob_name)
+
+
+def split_blob_key(key):
+    bucket_name, _, blob_name = key.partition('/')
+    return bucket_name, blob_name
+
+
+# Lazily yield the keys of all input data blobs in the project whose names start with prefix
+# Only the blob names are requested from the API, and buckets that can't be listed are skipped
+def iter_input_blobs(client, project, prefix='', suffixes=INPUT_BLOB_SUFFIXES):
+    for bucket in client.list_buckets(project=project, fields='items(name),nextPageToken'):
+        try:
+            blobs = client.list_blobs(bucket, prefix=prefix or None, page_size=BLOB_PAGE_SIZE,
+                                      fields='items(name),nextPageToken')
+            for blob in blobs:
+                if blob.name.endswith(suffixes):
+                    yield blob_key(bucket.name, blob.name)
+        except Exception as e:
+            print('Failed to list blobs in bucket {}: {}'.format(bucket.name, e))
+            continue
+
+
+# Return the keys of at most limit input data blobs in the project whose names start with prefix, using the cached
+# index when possible
+def list_input_blobs(client, project, prefix='', limit=BLOB_LIST_LIMIT):
+    def fetch():
+        return list(itertools.islice(iter_input_blobs(client, project, prefix), limit))
+
+    return blob_index.get_or_compute((project, prefix, limit), fetch)
+
+
+# Look up a single blob by its key, returning None if it does not exist
+def get_input_blob(client, key):
+    bucket_name, blob_name = split_blob_key(key)
+    if not bucket_name or not blob_name:
+        return None
+    return client.bucket(bucket_name).get_blob(blob_name)
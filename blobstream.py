@@ -0,0 +1,66 @@
+import collections
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+
+# This file contains a readable stream over a Cloud Storage blob, so that input data can be fed straight into the
+# preprocessing code (e.g. through a gzip decompressor) without first being downloaded to a local file
+# The blob is fetched as a series of ranged downloads, and several chunks can be downloaded ahead in parallel
+# Only blob.size, blob.reload() and blob.download_as_bytes(start=..., end=...) are used, so any object providing those
+# (for instance one backed by a local file) can stand in for a real blob
+
+
+# Size of each ranged download, in bytes
+BLOB_CHUNK_SIZE = 16 * 1024 * 1024
+
+# Number of chunks downloaded ahead of the reader at once
+BLOB_DOWNLOAD_WORKERS = 4
+
+
+class BlobStream(io.RawIOBase):
+    def __init__(self, blob, chunk_size=BLOB_CHUNK_SIZE, num_workers=BLOB_DOWNLOAD_WORKERS):
+        if blob.size is None:
+            blob.reload()
+        self.blob = blob
+        self.size = blob.size
+        self.chunk_size = chunk_size
+        self.num_workers = max(1, num_workers)
+        self.executor = ThreadPoolExecutor(max_workers=self.num_workers)
+        self.pending = collections.deque()
+        self.next_start = 0
+        self.chunk = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    # Keep up to num_workers ranged downloads in flight ahead of the reader
+    def schedule_downloads(self):
+        while len(self.pending) < self.num_workers and self.next_start < self.size:
+            end = min(self.next_start + self.chunk_size, self.size) - 1
+            self.pending.append(self.executor.submit(self.blob.download_as_bytes, start=self.next_start, end=end))
+            self.next_start = end + 1
+
+    def readinto(self, b):
+        if len(self.chunk) == 0:
+            self.schedule_downloads()
+            if not self.pending:
+                return 0
+            self.chunk = memoryview(self.pending.popleft().result())
+            self.schedule_downloads()
+
+        n = min(len(b), len(self.chunk))
+        b[:n] = self.chunk[:n]
+        self.chunk = self.chunk[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            for future in self.pending:
+                future.cancel()
+            self.executor.shutdown(wait=False)
+        super().close()
+
+
+# Open a buffered binary stream over a blob, for use in a with statement
+def open_blob_stream(blob, chunk_size=BLOB_CHUNK_SIZE, num_workers=BLOB_DOWNLOAD_WORKERS):
+    return io.BufferedReader(BlobStream(blob, chunk_size, num_workers), buffer_size=1024 * 1024)
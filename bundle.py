@@ -0,0 +1,139 @@
+import gzip
+import hashlib
+import os
+import shlex
+import shutil
+import subprocess
+import tarfile
+import tempfile
+
+from remote import get_remote_backend
+
+
+# This file contains the bulk transfer used to send a set of data files to a compute instance
+# Files whose content already matches the copy on the instance are skipped, and the rest are packed into a single
+# compressed tar stream that is uploaded in one transfer and unpacked on the instance
+# The bundle is built deterministically and named after its contents, so if an upload is interrupted, retrying the
+# same transfer appends the missing bytes to the partial upload on the instance instead of starting over
+
+
+# gzip level used for bundles; genotype text compresses very well even at the fastest level
+BUNDLE_COMPRESS_LEVEL = 1
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# Number of times an interrupted upload is resumed before giving up
+BUNDLE_UPLOAD_ATTEMPTS = 5
+
+
+class BundleTransferError(Exception):
+    pass
+
+
+def file_sha256(fname):
+    h = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+# Return a dictionary from file name to sha256 hash for the given files in a directory on the instance
+# Files that don't exist on the instance are left out
+def remote_file_hashes(backend, project, instance, path, names):
+    if not names:
+        return {}
+    quoted = ' '.join(shlex.quote(name) for name in names)
+    output = backend.check_output(project, instance, 'cd {} 2>/dev/null && sha256sum {} 2>/dev/null; true'.format(path, quoted))
+    hashes = {}
+    for line in output.splitlines():
+        tokens = line.split(None, 1)
+        if len(tokens) == 2:
+            hashes[tokens[1].lstrip('*')] = tokens[0]
+    return hashes
+
+
+# Pack the given files (by base name) into a gzipped tar file whose bytes depend only on the files' names and contents
+def build_bundle(fnames, out_fname):
+    with open(out_fname, 'wb') as raw, gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=BUNDLE_COMPRESS_LEVEL, mtime=0) as gz, \
+            tarfile.open(fileobj=gz, mode='w', format=tarfile.GNU_FORMAT) as tar:
+        for fname in fnames:
+            info = tar.gettarinfo(fname, arcname=os.path.basename(fname))
+            info.mtime = 0
+            info.uid = info.gid = 0
+            info.uname = info.gname = ''
+            info.mode = 0o644
+            with open(fname, 'rb') as f:
+                tar.addfile(info, f)
+
+
+def remote_file_size(backend, project, instance, fname):
+    return int(backend.check_output(project, instance, 'stat -c %s {} 2>/dev/null || echo 0'.format(fname)).strip() or 0)
+
+
+# Upload a local bundle to the instance, resuming from however much of it is already there
+# A failed or partial upload is resumed from the size that actually made it to the instance; only a bundle whose
+# content turns out not to match (e.g. a leftover from an upload of different files) is deleted and sent again
+def upload_bundle(backend, project, instance, local_bundle, remote_bundle, attempts=BUNDLE_UPLOAD_ATTEMPTS):
+    size = os.path.getsize(local_bundle)
+    local_hash = file_sha256(local_bundle)
+    for attempt in range(attempts):
+        try:
+            offset = remote_file_size(backend, project, instance, remote_bundle)
+            if offset > size:
+                backend.run(project, instance, 'rm -f {}'.format(remote_bundle))
+                offset = 0
+            if offset < size:
+                with open(local_bundle, 'rb') as f:
+                    f.seek(offset)
+                    status = backend.run(project, instance, 'cat >> {}'.format(remote_bundle), stdin=f)
+                if status != 0:
+                    print('Upload of {} to {} was interrupted (attempt {}), resuming'.format(remote_bundle, instance, attempt + 1))
+                    continue
+
+            # check the upload arrived intact before it is unpacked
+            remote_hash = backend.check_output(project, instance, 'sha256sum {} 2>/dev/null; true'.format(remote_bundle)).split()
+            if remote_hash and remote_hash[0] == local_hash:
+                return
+            backend.run(project, instance, 'rm -f {}'.format(remote_bundle))
+            print('Upload of {} to {} was corrupted (attempt {}), sending it again'.format(remote_bundle, instance, attempt + 1))
+        except subprocess.CalledProcessError as e:
+            print('Upload of {} to {} failed (attempt {}): {}'.format(remote_bundle, instance, attempt + 1, e))
+    raise BundleTransferError('Transfer of {} to {} did not complete after {} attempts'.format(
+        os.path.basename(remote_bundle), instance, attempts))
+
+
+# Transfer a set of local files into a directory on the instance as a single compressed bundle
+# Returns the base names of the files that actually had to be sent
+def transfer_bundle_to_instance(project, instance, fnames, path, backend=None):
+    if backend is None:
+        backend = get_remote_backend()
+    if path[-1] != '/':
+        path += '/'
+
+    # skip files whose content already matches the copy on the instance
+    local_hashes = {os.path.basename(fname): file_sha256(fname) for fname in fnames}
+    remote_hashes = remote_file_hashes(backend, project, instance, path, list(local_hashes))
+    to_send = [fname for fname in fnames if remote_hashes.get(os.path.basename(fname)) != local_hashes[os.path.basename(fname)]]
+    if not to_send:
+        return []
+
+    manifest = '\n'.join('{} {}'.format(os.path.basename(fname), local_hashes[os.path.basename(fname)]) for fname in to_send)
+    bundle_name = '.bundle-{}.tar.gz'.format(hashlib.sha256(manifest.encode('utf-8')).hexdigest()[:16])
+    remote_bundle = path + bundle_name
+
+    tmpdir = tempfile.mkdtemp(prefix='gwas-bundle-')
+    try:
+        local_bundle = os.path.join(tmpdir, bundle_name)
+        build_bundle(to_send, local_bundle)
+
+        backend.run(project, instance, 'mkdir -p {}'.format(path))
+        upload_bundle(backend, project, instance, local_bundle, remote_bundle)
+
+        status = backend.run(project, instance, 'tar -xzf {b} -C {p} && rm -f {b}'.format(b=remote_bundle, p=path))
+        if status != 0:
+            raise BundleTransferError('Failed to unpack {} on {}'.format(bundle_name, instance))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return [os.path.basename(fname) for fname in to_send]
@@ -0,0 +1,42 @@
+import threading
+import time
+
+
+# This file contains a small thread-safe in-memory cache whose entries expire after a fixed time-to-live
+# It is used to avoid repeating slow Google Cloud listing calls on every page load
+
+
+class TTLCache:
+    def __init__(self, ttl, clock=time.monotonic):
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    # Return the cached value for key, or default if it is missing or has expired
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            expires, value = entry
+            if self.clock() >= expires:
+                del self.entries[key]
+                return default
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (self.clock() + self.ttl, value)
+
+    # Return the cached value for key, computing and caching it with compute() if it is missing or has expired
+    def get_or_compute(self, key, compute):
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.set(key, value)
+        return value
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
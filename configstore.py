@@ -0,0 +1,149 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+# This file contains the store that keeps every user's GWAS config, keyed by their Google Cloud project and instance
+# Configs used to live in a dictionary inside the web server process, so a config loaded by one gunicorn worker could
+# not be seen by the others; the default store keeps them in a SQLite database that every worker process shares
+# Every save adds a new numbered snapshot instead of overwriting the previous one, so earlier versions of a config
+# can still be looked up, and a save can be made conditional on the config not having changed since it was loaded
+
+
+CONFIG_DB = os.environ.get('GWAS_CONFIG_DB', 'configs.db')
+
+
+# Raised when a conditional save finds that the config was saved by someone else since it was loaded
+class ConfigConflictError(Exception):
+    pass
+
+
+def check_expected_version(project, instance, latest, expected_version):
+    if expected_version is not None and latest != expected_version:
+        raise ConfigConflictError('Config for {} {} is at version {}, expected version {}'.format(
+            project, instance, latest, expected_version))
+
+
+# Store backed by a SQLite database, safe to use from several threads and processes at once
+class SQLiteConfigStore:
+    def __init__(self, path=CONFIG_DB):
+        self.path = path
+        with self.connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''CREATE TABLE IF NOT EXISTS configs (
+                                project TEXT,
+                                instance TEXT,
+                                version INTEGER,
+                                config TEXT,
+                                saved REAL,
+                                PRIMARY KEY (project, instance, version))''')
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    # Return the config saved as the given version, or the latest one when version is None, or None if there is none
+    def load(self, project, instance, version=None):
+        conn = self.connect()
+        try:
+            if version is None:
+                row = conn.execute('SELECT config FROM configs WHERE project = ? AND instance = ? '
+                                   'ORDER BY version DESC LIMIT 1', (project, instance)).fetchone()
+            else:
+                row = conn.execute('SELECT config FROM configs WHERE project = ? AND instance = ? AND version = ?',
+                                   (project, instance, version)).fetchone()
+        finally:
+            conn.close()
+        return json.loads(row[0]) if row is not None else None
+
+    # Latest version number of the config, or 0 if it has never been saved
+    def latest_version(self, project, instance):
+        conn = self.connect()
+        try:
+            row = conn.execute('SELECT MAX(version) FROM configs WHERE project = ? AND instance = ?',
+                               (project, instance)).fetchone()
+        finally:
+            conn.close()
+        return row[0] or 0
+
+    # Save the config as a new version and return its version number
+    # If expected_version is given, the save only happens if that is still the latest version
+    def save(self, project, instance, config, expected_version=None):
+        conn = self.connect()
+        try:
+            # take the write lock up front, so that two workers can't both claim the same version number
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute('SELECT MAX(version) FROM configs WHERE project = ? AND instance = ?',
+                                   (project, instance)).fetchone()
+                latest = row[0] or 0
+                check_expected_version(project, instance, latest, expected_version)
+                conn.execute('INSERT INTO configs VALUES (?, ?, ?, ?, ?)',
+                             (project, instance, latest + 1, json.dumps(config), time.time()))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        finally:
+            conn.close()
+        return latest + 1
+
+    # List of (version, time saved) pairs for every saved version of the config, oldest first
+    def versions(self, project, instance):
+        conn = self.connect()
+        try:
+            return [tuple(row) for row in conn.execute('SELECT version, saved FROM configs WHERE project = ? AND instance = ? '
+                                                       'ORDER BY version', (project, instance))]
+        finally:
+            conn.close()
+
+
+# Store that keeps configs in memory, only visible to the current process
+class MemoryConfigStore:
+    def __init__(self):
+        self.snapshots = {}
+        self.lock = threading.Lock()
+
+    def load(self, project, instance, version=None):
+        with self.lock:
+            snapshots = self.snapshots.get((project, instance), [])
+            if version is None:
+                version = len(snapshots)
+            if not 1 <= version <= len(snapshots):
+                return None
+            return json.loads(snapshots[version - 1][0])
+
+    def latest_version(self, project, instance):
+        with self.lock:
+            return len(self.snapshots.get((project, instance), []))
+
+    def save(self, project, instance, config, expected_version=None):
+        with self.lock:
+            snapshots = self.snapshots.setdefault((project, instance), [])
+            check_expected_version(project, instance, len(snapshots), expected_version)
+            # store a serialized copy, so later changes to the caller's dictionary don't leak into the snapshot
+            snapshots.append((json.dumps(config), time.time()))
+            return len(snapshots)
+
+    def versions(self, project, instance):
+        with self.lock:
+            return [(i + 1, saved) for i, (_, saved) in enumerate(self.snapshots.get((project, instance), []))]
+
+
+config_store = None
+
+
+def get_config_store():
+    global config_store
+    if config_store is None:
+        config_store = SQLiteConfigStore()
+    return config_store
+
+
+# Replace the store used for all GWAS configs, returning the previous one
+def set_config_store(store):
+    global config_store
+    previous = config_store
+    config_store = store
+    return previous
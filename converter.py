@@ -0,0 +1,233 @@
+import gzip
+import os
+import random
+import tempfile
+
+import numpy as np
+
+from binformat import ENCODING_PACKED2, int_encoding, write_int_matrix, write_matrix_file
+from genotype import GenotypeDecoder
+from covariates import ID_COLUMN, DEFAULT_COVARIATE_COLUMNS, parse_covariate_columns, read_covariate_table, build_covariate_matrix
+
+
+# This file contains the converters from the input VCF and covariate files to the geno, pheno, pos and cov files used
+# by the GWAS code
+# It is shipped to the compute instances along with prepworker.py, so it only depends on the other converter modules,
+# numpy and pandas, and has to keep running on the Python 3.5 of the instances' Debian 9 image
+
+
+# Number of VCF rows (SNPs) decoded and held in memory at once while streaming a genotype file
+VCF_BLOCK_SIZE = 4096
+
+# Number of simulated causal SNPs used to generate the phenotype data
+NUM_CAUSAL_SNPS = 10
+
+
+# Read the VCF meta-information lines up to and including the #CHROM header line
+# Returns the header columns and the index of the first subject column
+def read_vcf_header(f):
+	for line in f:
+		if line.startswith(b'#CHROM'):
+			columns = line.decode('utf-8').split()
+			if 'FORMAT' in columns:
+				return columns, columns.index('FORMAT') + 1
+			for i in range(len(columns)):
+				if any(s.isdigit() for s in columns[i]):
+					return columns, i
+			return columns, len(columns)
+	raise ValueError('VCF file is missing the #CHROM header line')
+
+
+# Yield lists of at most block_size raw VCF data lines from an open binary stream
+def iter_vcf_blocks(f, block_size=VCF_BLOCK_SIZE):
+	block = []
+	for line in f:
+		block.append(line)
+		if len(block) == block_size:
+			yield block
+			block = []
+	if block:
+		yield block
+
+
+# Split a block of raw VCF lines into its (chromosome, position) pairs and its genotype dosage matrix
+def parse_vcf_block(lines, offset_index, decoder):
+	rows = [line.rstrip(b'\r\n').split(b'\t') for line in lines]
+	positions = [(int(row[0]), int(row[1])) for row in rows]
+	dosages = decoder.decode([row[offset_index:] for row in rows])
+	return positions, dosages
+
+
+# Open the on-disk SNP-major int8 dosage segments, given as (file name, number of SNPs) pairs, as memory maps
+def open_geno_segments(segments, num_subjects):
+	return [np.memmap(raw_fname, dtype=np.int8, mode='r', shape=(num_snps, num_subjects))
+			for raw_fname, num_snps in segments if num_snps > 0]
+
+
+# Name of the file holding the given matrix (geno, pheno or cov) in either the text or the compact binary format
+def matrix_fname(name, binary=False):
+	return name + ('.bin' if binary else '.txt')
+
+
+# Save an integer matrix either as text or in the compact binary format, one byte per value when they all fit
+def save_int_matrix(fname, matrix, binary=False):
+	if matrix.ndim == 1:
+		matrix = matrix.reshape(-1, 1)
+	if binary:
+		write_matrix_file(fname, [matrix], matrix.shape[0], matrix.shape[1], int_encoding(matrix))
+	else:
+		np.savetxt(fname, matrix.astype(int), fmt='%i')
+
+
+# Transpose the concatenated SNP-major dosage segments into a subject-major int8 file, in tiles of consecutive SNPs by
+# all subjects holding at most max_bytes, so every segment is read once, front to back, and every subject's row is
+# written in runs of a whole tile's SNPs
+def transpose_geno_segments(segments, num_subjects, out_fname, max_bytes):
+	num_snps = sum(n for _, n in segments)
+	transposed = np.memmap(out_fname, dtype=np.int8, mode='w+', shape=(num_subjects, num_snps))
+	step = max(1, max_bytes // num_subjects)
+	offset = 0
+	for dosages in open_geno_segments(segments, num_subjects):
+		for start in range(0, dosages.shape[0], step):
+			tile = np.asarray(dosages[start:start + step])
+			transposed[:, offset:offset + tile.shape[0]] = tile.T
+			offset += tile.shape[0]
+	transposed.flush()
+	del transposed
+
+
+# Write the transpose of the concatenated SNP-major dosage segments to the subject-major geno file
+# Subjects are processed in groups sized so that at most max_bytes of genotypes are held in memory at once; when that
+# takes more than one group, the genotypes are first transposed tile by tile into a temporary subject-major file next to
+# the segments, since reading a group's columns straight from the SNP-major segments would reread them for every group
+# In binary mode the genotypes are written 2-bit packed instead of as text
+def write_geno_file(segments, num_subjects, out_fname, max_bytes, binary=False):
+	num_snps = sum(n for _, n in segments)
+	blocks = []
+	transposed_fname = None
+	try:
+		if num_snps > 0 and num_subjects > 0:
+			step = max(1, max_bytes // num_snps)
+			if step >= num_subjects:
+				blocks = [np.hstack([d.T for d in open_geno_segments(segments, num_subjects)])]
+			else:
+				fd, transposed_fname = tempfile.mkstemp(suffix='.geno-t', dir=os.path.dirname(os.path.abspath(segments[0][0])))
+				os.close(fd)
+				transpose_geno_segments(segments, num_subjects, transposed_fname, max_bytes)
+				transposed = np.memmap(transposed_fname, dtype=np.int8, mode='r', shape=(num_subjects, num_snps))
+				blocks = (np.asarray(transposed[start:start + step]) for start in range(0, num_subjects, step))
+
+		if binary:
+			write_matrix_file(out_fname, blocks, num_subjects, num_snps, ENCODING_PACKED2)
+		else:
+			with open(out_fname, 'wb') as f:
+				for block in blocks:
+					write_int_matrix(f, block)
+	finally:
+		blocks = transposed = None
+		if transposed_fname is not None:
+			os.remove(transposed_fname)
+
+
+# Read the genotypes of NUM_CAUSAL_SNPS randomly chosen SNPs from the dosage segments (subjects x causal SNPs)
+def sample_causal_genotypes(segments, num_subjects):
+	num_snps = sum(n for _, n in segments)
+	snp_indices = sorted(random.sample(range(num_snps), min(NUM_CAUSAL_SNPS, num_snps)))
+	causal_snps = []
+	offset = 0
+	for dosages in open_geno_segments(segments, num_subjects):
+		causal_snps.extend(dosages[i - offset] for i in snp_indices if offset <= i < offset + dosages.shape[0])
+		offset += dosages.shape[0]
+	return np.array(causal_snps, dtype=np.int8).reshape(-1, num_subjects).transpose()
+
+
+# Write (chromosome, position) pairs to an open pos text file
+def write_positions(f, positions):
+	f.write(''.join('{} {}\n'.format(chrom, pos) for chrom, pos in positions))
+
+
+# Simulate binary phenotypes from a small set of randomly weighted causal SNPs (subjects x causal SNPs)
+def simulate_phenotypes(causal_genotypes):
+	num_subjects, num_causal = causal_genotypes.shape
+	weights = np.array([random.uniform(-0.1, 0.1) for _ in range(num_causal)])
+	weighted_sum = np.sum(np.multiply(causal_genotypes, weights), axis=1)
+	noise = np.array([random.uniform(-1, 1) for _ in range(num_subjects)])
+	phenotypes = 1.0 / (1 + np.exp(-1 * (weighted_sum + noise)))
+	return np.where(phenotypes >= 0.5, np.ones(phenotypes.shape), np.zeros(phenotypes.shape))
+
+
+# Open a gzipped VCF source for reading, which is either the name of a local file or a binary stream such as a
+# BlobStream reading directly from Cloud Storage
+def open_vcf_source(source):
+	if isinstance(source, str):
+		return gzip.open(source, 'rb')
+	return gzip.GzipFile(fileobj=source, mode='rb')
+
+
+# Remove a local input file once it has been converted (streams are left to the caller)
+def remove_source(source):
+	if isinstance(source, str):
+		os.remove(source)
+
+
+# Function for transforming a genotype VCF file into the pheno, geno, and pos text files used by the GWAS code
+# The gzipped VCF is streamed in blocks of block_size rows, so peak memory depends on the block size rather than the file size
+# An optional GenotypeDecoder controls how unphased, multi-allelic and missing calls are handled
+# An optional VariantFilter (see qc.py) drops variants that fail QC, and keeps count of what it dropped
+# In binary mode geno and pheno are written as geno.bin and pheno.bin in the compact format from binformat.py
+# Output files are written to out_dir, so that concurrent conversions can use separate directories
+def transform_genotype_data_vcf(fname, block_size=VCF_BLOCK_SIZE, decoder=None, binary=False, out_dir='.',
+								 variant_filter=None):
+	if decoder is None:
+		decoder = GenotypeDecoder()
+
+	fd, raw_fname = tempfile.mkstemp(suffix='.geno')
+	os.close(fd)
+
+	num_snps = 0
+	try:
+		with open_vcf_source(fname) as f, open(os.path.join(out_dir, 'pos.txt'), 'w') as pos_f, open(raw_fname, 'wb') as raw_f:
+			columns, offset_index = read_vcf_header(f)
+			subjects = columns[offset_index:]
+
+			# write the position data and spill the decoded genotypes to disk one block at a time
+			for lines in iter_vcf_blocks(f, block_size):
+				positions, dosages = parse_vcf_block(lines, offset_index, decoder)
+				if variant_filter is not None:
+					positions, dosages, counts = variant_filter.apply(positions, dosages)
+					variant_filter.record(counts)
+				write_positions(pos_f, positions)
+				raw_f.write(dosages.tobytes())
+				num_snps += dosages.shape[0]
+
+		# now create the genotype data by transposing the decoded genotypes into one row per subject
+		segments = [(raw_fname, num_snps)]
+		write_geno_file(segments, len(subjects), os.path.join(out_dir, matrix_fname('geno', binary)),
+						block_size * max(1, len(subjects)), binary)
+
+		# finally, simulate the phenotype data
+		phenotypes = simulate_phenotypes(sample_causal_genotypes(segments, len(subjects)))
+		save_int_matrix(os.path.join(out_dir, matrix_fname('pheno', binary)), phenotypes, binary)
+	finally:
+		os.remove(raw_fname)
+
+	# delete the file
+	remove_source(fname)
+
+	# return the list of subjects
+	return subjects
+
+
+# Function for transforming a tab separated covariate file into the cov file used by the GWAS code
+# The rows are aligned to the order of the subject ids from the genotype data (ids), and columns is a list of
+# CovariateColumn specifying which covariates to include and how to encode them (see covariates.py)
+# In binary mode the matrix is written as cov.bin in the compact format from binformat.py
+def transform_covariate_data(fname, ids, binary=False, out_dir='.', columns=None, id_column=ID_COLUMN):
+	if columns is None:
+		columns = parse_covariate_columns(DEFAULT_COVARIATE_COLUMNS)
+
+	table = read_covariate_table(fname, columns, id_column)
+	matrix = build_covariate_matrix(table, columns, ids, id_column)
+	save_int_matrix(os.path.join(out_dir, matrix_fname('cov', binary)), matrix, binary)
+	remove_source(fname)
+	return matrix.shape[1]
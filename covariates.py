@@ -0,0 +1,145 @@
+import numpy as np
+import pandas as pd
+
+
+# This file contains the covariate pipeline, which turns a table of per-subject covariates into the integer matrix used
+# by the GWAS code, with one row per genotyped subject in the same order as geno.txt
+# Only the subject ID column and the chosen covariate columns are read, categorical columns are read as pandas
+# categoricals, and their integer codes are written straight into a preallocated matrix instead of going through
+# get_dummies and a merge
+# Categories are taken from the chosen subjects only, so the matrix is the same as get_dummies of the merged table gave
+
+
+ID_COLUMN = 'Sample name'
+
+# Ways of encoding a covariate column
+# binary:  a column with at most two values, encoded as 0/1; values in BINARY_CODES keep their code (so a column of only
+#          males is still all 1), and any others take the remaining codes in sorted order
+# onehot:  one 0/1 column per distinct value, in sorted order
+# numeric: the column's values, which have to be integers
+COVARIATE_KINDS = ('binary', 'onehot', 'numeric')
+
+BINARY_CODES = {'female': 0, 'male': 1}
+
+DEFAULT_COVARIATE_COLUMNS = 'Sex:binary, Population code:onehot'
+
+
+class CovariateColumn:
+    def __init__(self, name, kind='onehot'):
+        if kind not in COVARIATE_KINDS:
+            raise ValueError('Unknown covariate encoding {} for column {}, expected one of {}'.format(
+                kind, name, ', '.join(COVARIATE_KINDS)))
+        self.name = name
+        self.kind = kind
+
+    def __repr__(self):
+        return '{}:{}'.format(self.name, self.kind)
+
+
+# Parse a comma separated list of covariate columns, each given as "name" or "name:kind"
+def parse_covariate_columns(text):
+    columns = []
+    for entry in text.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        name, _, kind = entry.rpartition(':') if ':' in entry else (entry, '', 'onehot')
+        columns.append(CovariateColumn(name.strip(), kind.strip()))
+    return columns
+
+
+# Read the subject IDs and the given covariate columns from a tab separated file (path or binary stream)
+def read_covariate_table(source, columns, id_column=ID_COLUMN):
+    dtypes = {id_column: str}
+    for column in columns:
+        dtypes[column.name] = 'float64' if column.kind == 'numeric' else 'category'
+    return pd.read_csv(source, delimiter='\t', encoding='utf-8', usecols=list(dtypes), dtype=dtypes)
+
+
+# Row of the table for every subject in ids, using a hash index on the ID column
+# Raises ValueError if a subject is missing from the table or the table lists a subject more than once
+def align_rows(table_ids, ids):
+    index = pd.Index(table_ids)
+    if not index.is_unique:
+        duplicated = index[index.duplicated()].unique()
+        raise ValueError('Covariate file lists subjects more than once: {}'.format(', '.join(map(str, duplicated[:10]))))
+    rows = index.get_indexer(ids)
+    if (rows < 0).any():
+        missing = [subject for subject, row in zip(ids, rows) if row < 0]
+        raise ValueError('Covariate file has no rows for {} genotyped subjects, e.g. {}'.format(
+            len(missing), ', '.join(missing[:10])))
+    return rows
+
+
+# Number of matrix columns each covariate column is encoded into
+def encoded_width(column, series):
+    if column.kind == 'onehot':
+        return len(series.cat.categories)
+    return 1
+
+
+# 0/1 code of every category of a binary column
+def binary_codes(column, categories):
+    if len(categories) > 2:
+        raise ValueError('Covariate column {} has more than two values, so it can not be encoded as binary: {}'.format(
+            column.name, ', '.join(map(str, categories[:10]))))
+    codes = [BINARY_CODES.get(str(category)) for category in categories]
+    free = sorted(set([0, 1]) - set(codes))
+    for index in sorted(range(len(categories)), key=lambda i: str(categories[i])):
+        if codes[index] is None:
+            codes[index] = free.pop(0)
+    if len(set(codes)) != len(codes):
+        raise ValueError('Covariate column {} has two values with the same binary code: {}'.format(
+            column.name, ', '.join(map(str, categories))))
+    return np.array(codes, dtype=np.int64)
+
+
+# Build the covariate matrix for the subjects in ids (all subjects in file order when ids is None)
+def build_covariate_matrix(table, columns, ids=None, id_column=ID_COLUMN):
+    if ids is None:
+        rows = np.arange(len(table))
+    else:
+        rows = align_rows(table[id_column].to_numpy(), list(ids))
+
+    # only the values of the chosen subjects make categories, like get_dummies of the merged table
+    selected = []
+    for column in columns:
+        series = table[column.name].iloc[rows]
+        if column.kind != 'numeric':
+            series = series.cat.remove_unused_categories()
+        selected.append(series)
+
+    widths = [encoded_width(column, series) for column, series in zip(columns, selected)]
+    numeric = any(column.kind == 'numeric' for column in columns)
+    matrix = np.zeros((len(rows), sum(widths)), dtype=np.int64 if numeric else np.int8)
+
+    offset = 0
+    for column, series, width in zip(columns, selected, widths):
+        if column.kind == 'numeric':
+            values = series.to_numpy()
+            if np.isnan(values).any():
+                raise ValueError('Covariate column {} has missing values'.format(column.name))
+            # the GWAS code reads integer covariates, so fractional values are an error rather than truncated
+            if (values != np.round(values)).any():
+                raise ValueError('Covariate column {} has values that are not integers, e.g. {}'.format(
+                    column.name, ', '.join(map(str, values[values != np.round(values)][:10]))))
+            matrix[:, offset] = values
+        else:
+            categories = series.cat.categories
+            codes = series.cat.codes.to_numpy()
+            present = codes >= 0
+
+            if column.kind == 'binary':
+                if not present.all():
+                    raise ValueError('Covariate column {} has missing values'.format(column.name))
+                matrix[:, offset] = binary_codes(column, categories)[codes]
+            else:
+                # sort the categories, so the encoding doesn't depend on the order subjects appear in
+                order = np.argsort(np.asarray(categories, dtype=str), kind='stable')
+                remap = np.empty(len(order), dtype=np.int64)
+                remap[order] = np.arange(len(order))
+                # subjects with a missing value get all zeros, like get_dummies
+                matrix[np.flatnonzero(present), offset + remap[codes[present]]] = 1
+        offset += width
+
+    return matrix
@@ -1,190 +1,82 @@
 import os
-import random
-import subprocess
+import shlex
 
-import psutil
-import numpy as np
-import pandas as pd
+from bundle import transfer_bundle_to_instance
+from converter import *
+from remote import get_remote_backend
+from schema import GwasConfig, ConfigError, convert_config_value, parse_config_file, validate_config
 
 
 # This file contains helper functions used by the main.py file
+# The data converters themselves live in converter.py, and are available from here as well
 
 
-# Schema for the config file used to initialize GWAS MPC protocol
+# Schema for the config file used to initialize GWAS MPC protocol (see GwasConfig in schema.py)
 def get_default_config_dict():
-	return {
-	    'IP_ADDR_P0': '',
-	    'IP_ADDR_P1': '',
-	    'IP_ADDR_P2': '',
-	    'NUM_S': 1,
-	    'CP_ROLE': None,
-	    'S_ROLE': None,
-	    'PROJ0': '',
-	    'PROJ1': '',
-	    'PROJ2': '',
-	    'PROJ3': [''],
-	    'NUM_INDS': [0],
-	    'NUM_SNPS': 0,
-	    'NUM_COVS': 0,
-	    'NUM_CHUNKS': [1],
-	    'NUM_THREADS': 1,
-	    'NTL_NUM_THREADS': 0
-	}
+	return GwasConfig().to_dict()
 
 
 # Add a new parameter key-value pair to the config dict using values from the UI text form or file inputted by user
+# Raises ConfigError for unknown parameters or values of the wrong type
 def update_config_dict(config_dict, kw, tokens):
-	schema = get_default_config_dict()
-
-	# Case 1: integer value parameters
-	if schema[kw] is None or type(schema[kw]) == 'int':
-		if len(tokens) > 0:
-			config_dict[kw] = int(tokens[0])
-		else:
-			config_dict[kw] = None
-
-	# Case 2: string value parameters
-	elif type(schema[kw]) == 'str':
-		if len(tokens) > 0:
-			config_dict[kw] = tokens[0]
-
-	# Case 3: list of string values
-	elif type(schema[kw]) == 'list' and type(schema[kw][0]) == 'str':
-		config_dict[kw] = tokens
-
-	# Case 4: list of integer values
-	elif type(schema[kw]) == 'list' and type(schema[kw][0]) == 'int':
-		config_dict[kw] = [int(x) for x in tokens]
+	config_dict[kw] = convert_config_value(kw, tokens)
 
 
 # Turn config file inputted by user into a dictionary fitting above schema
 def read_config_file(fname, config_dict):
-	with open(fname, 'r') as f:
-		for line in f:
-			tokens = line.split()
-			kw = tokens[0]
-
-			update_config_dict(config_dict, kw, tokens[1:])
+	config_dict.update(parse_config_file(fname).to_dict())
 
 
 # Copy file from local machine to Google Cloud Compute Instance
 def transfer_file_to_instance(project, instance, fname, path, delete_after=False):
+	return transfer_files_to_instance(project, instance, [fname], path, delete_after)
+
+
+# Copy several files from local machine into the same directory on Google Cloud Compute Instance in a single transfer
+def transfer_files_to_instance(project, instance, fnames, path, delete_after=False):
 	if path[-1] != '/':
 		path += '/'
-	cmd = 'gcloud compute scp --project {} "{}" {}:{}'.format(project, fname, instance, path)
-	os.system(cmd)
+	status = get_remote_backend().copy(project, instance, fnames, path)
 
 	if delete_after:
-		os.remove(fname)
+		for fname in fnames:
+			os.remove(fname)
+	return status
 
 
 # Execute series of shell commands on Google Cloud Compute Instance
 def execute_shell_script_on_instance(project, instance, cmds):
-	cmd = '; '.join(cmds)
-	script = 'gcloud compute ssh {} --project {} --command \'{}\''.format(instance, project, cmd)
-	os.system(script)
-
-
-# Execute series of shell commands on Google Cloud Compute Instance in a new process
-# Returns the PID of the created process
-def execute_shell_script_asynchronous(project, instance, cmds):
-	cmd = '; '.join(cmds)
-	script = 'gcloud compute ssh {} --project {} --command \'{}\''.format(instance, project, cmd)
-	return subprocess.Popen(script, shell=True, stdout=subprocess.PIPE)
-
-
-def kill_asynchronous_process(pid):
-    process = psutil.Process(pid)
-    for proc in process.children(recursive=True):
-        proc.kill()
-    process.kill()
-
-
-# Function for transforming a genotype VCF file into the pheno, geno, and pos text files used by the GWAS code
-def transform_genotype_data_vcf(fname):
-	# transforms a genotype of the form 0|1 into a genotype of the form 1
-	def genotype_mapper(gen):
-		alleles = gen.split('|')
-		if (alleles[0] != '0' and alleles[0] != '1') or (alleles[1] != '0' and alleles[1] != '1'):
-			return -1
-		else:
-			return int(alleles[0]) + int(alleles[1])
-
-	# decompress VCF file
-	cmd = 'gunzip -d {}'.format(fname)
-	os.system(cmd)
-	fname = fname[:-3]
-
-	columns = []
-	offset_index = 0
-	head_index = 0
-
-	# then, find header of file
-	with open(fname, 'r') as f:
-		line = f.readline()
-		
-		while line:
-			if line[0] == '#' and line[1] != '#':
-				columns = line.split()
-				for i in range(len(columns)):
-					if any(s.isdigit() for s in columns[i]):
-						offset_index = i
-						break
-				break
-
-			head_index += 1
-			line = f.readline()
-
-	# now, read the file starting from header
-	df = pd.read_csv(fname, delimiter='\t', encoding='utf-8', skiprows=head_index)
-
-	# create the position data by reading first 2 columns
-	position_columns = columns[:2]
-	df_position = sampled[position_columns]
-	np.savetxt('pos.txt', df_position.to_numpy().astype(int), fmt='%i')
-
-	# now create the genotype data
-	subject_columns = columns[offset_index:]
-	genotype_data = sampled[subject_columns].to_numpy()
-	genotype_data = genotype_data.transpose()
-	genotype_data_final = np.vectorize(genotype_mapper)(genotype_data)
-	np.savetxt('geno.txt', genotype_data_final.astype(int), fmt='%i')
-
-	# finally, simulate the phenotype data
-	snp_indices = random.sample(range(genotype_data_final.shape[1]), 10)
-	weights = np.array([random.uniform(-0.1, 0.1) for _ in range(10)])
-	weighted_sum = np.sum(np.multiply(genotype_data_final[:, snp_indices], weights), axis=1)
-	noise = np.array([random.uniform(-1, 1) for _ in range(genotype_data_final.shape[0])])
-	phenotypes = 1.0 / (1 + np.exp(-1 * (weighted_sum + noise)))
-	phenotypes = np.where(phenotypes >= 0.5, np.ones(phenotypes.shape), np.zeros(phenotypes.shape))
-	phenotype_data = phenotypes.transpose()
-	np.savetxt('pheno.txt', phenotype_data.astype(int), fmt='%i')
-
-	# delete the file
-	os.remove(fname)
-
-	# return the list of subjects
-	return columns[offset_index:]
-
-
-# Fucntion for transforming a covariate VCF file into the cov.txt file used by the GWAS code
-def transform_covariate_data(fname, ids):
-	df = pd.read_csv(fname, delimiter='\t', encoding='utf-8')[['Sample name', 'Sex', 'Population code']]
-
-	# if we need to filter down the subject ids, do that
-	if ids is not None:
-		df_filter = pd.DataFrame(ids, columns=['Sample name'])
-		df_joined = pd.merge(df, df_filter, on='Sample name', how='inner')
-	else:
-		df_joined = df
-
-	# turn gender into a 0/1 encoding
-	df1 = df_joined['Sex'].replace(['female', 'male'], [0, 1])
-
-	# turn population into a 1-hot encoding
-	df2 = pd.get_dummies(df_joined['Population code'])
-
-	# join and save the file
-	df_final = pd.concat([df1, df2], axis=1)
-	np.savetxt('cov.txt', df_final.to_numpy().astype(int), fmt='%i')
-	os.remove(fname)
+	return get_remote_backend().run(project, instance, '; '.join(cmds))
+
+
+# Number of vCPUs available on Google Cloud Compute Instance, or None if it can't be determined
+def get_instance_vcpus(project, instance):
+	try:
+		return int(get_remote_backend().check_output(project, instance, 'nproc').strip())
+	except Exception as e:
+		print('Failed to get the number of vCPUs on {}: {}'.format(instance, e))
+		return None
+
+
+# Convert matrices that were transferred in the compact binary format (e.g. geno.bin) into the text files (e.g. geno.txt)
+# read by the secure-gwas binaries, by running the converter on the Google Cloud Compute Instance itself
+def convert_binary_files_on_instance(project, instance, names, path):
+	if path[-1] != '/':
+		path += '/'
+	transfer_bundle_to_instance(project, instance, [os.path.join(os.path.dirname(os.path.abspath(__file__)), 'binformat.py')], path)
+	args = ' '.join('{} {}'.format(matrix_fname(name, True), matrix_fname(name)) for name in names)
+	bin_files = ' '.join(matrix_fname(name, True) for name in names)
+	execute_shell_script_on_instance(project, instance, ['cd {}'.format(path), 'python3 binformat.py {}'.format(args), 'rm {}'.format(bin_files)])
+
+
+# Reindex the geno.txt file on an S's Google Cloud Compute Instance to the merged positions of several S parties, given
+# the column map the CP wrote for this S's dataset (see posmerge.py), by running posmerge.py on the instance itself
+def reindex_geno_file_on_instance(project, instance, map_fname, num_merged, path):
+	if path[-1] != '/':
+		path += '/'
+	base = os.path.dirname(os.path.abspath(__file__))
+	transfer_bundle_to_instance(project, instance, [os.path.join(base, 'posmerge.py'), os.path.join(base, 'binformat.py'), map_fname], path)
+	status = execute_shell_script_on_instance(project, instance, ['cd {} && python3 posmerge.py reindex geno.txt {} {} geno.txt'.format(
+		path, shlex.quote(os.path.basename(map_fname)), num_merged)])
+	if status != 0:
+		raise RuntimeError('Reindexing geno.txt on {} failed with status {}'.format(instance, status))
@@ -0,0 +1,68 @@
+import numpy as np
+
+
+# This file contains the lookup-table based decoder that turns raw VCF genotype (GT) fields into allele dosages
+
+
+# Only the leading bytes of each field are needed to decode a single digit diploid call such as 0|1, 1/1 or 0|1:0.98
+GT_FIELD_WIDTH = 4
+
+# Allele codes used by the lookup tables: 0-9 are allele indices, followed by the missing allele '.' and anything else
+MISSING_ALLELE = 10
+INVALID_ALLELE = 11
+NUM_ALLELE_CODES = 12
+
+# Supported ways of handling calls that involve an allele index above 1
+MULTIALLELIC_MODES = ('missing', 'alt')
+
+
+# Decodes GT fields into dosages (number of non-reference alleles) using precomputed lookup tables
+# separators: phasing separators that are accepted, so '|' alone rejects unphased calls
+# multiallelic: 'missing' marks calls with an allele index above 1 as missing, 'alt' counts every non-reference allele
+# missing: dosage value written for missing, malformed or rejected calls
+# Calls with multi-digit allele indices or a ploidy other than 2 are treated as missing
+class GenotypeDecoder:
+    def __init__(self, separators='|/', multiallelic='missing', missing=-1):
+        if multiallelic not in MULTIALLELIC_MODES:
+            raise ValueError('multiallelic must be one of {}'.format(', '.join(MULTIALLELIC_MODES)))
+
+        self.separators = separators
+        self.multiallelic = multiallelic
+        self.missing = missing
+
+        # byte -> allele code
+        self.allele_codes = np.full(256, INVALID_ALLELE, dtype=np.uint8)
+        for i in range(10):
+            self.allele_codes[ord(str(i))] = i
+        self.allele_codes[ord('.')] = MISSING_ALLELE
+
+        # byte -> whether it may separate the two alleles
+        self.separator_ok = np.zeros(256, dtype=bool)
+        for c in separators:
+            self.separator_ok[ord(c)] = True
+
+        # byte -> whether it may follow the second allele (end of field, or the start of the next FORMAT value)
+        self.terminator_ok = np.zeros(256, dtype=bool)
+        self.terminator_ok[0] = True
+        self.terminator_ok[ord(':')] = True
+
+        # (allele code, allele code) -> dosage
+        self.dosages = np.full((NUM_ALLELE_CODES, NUM_ALLELE_CODES), missing, dtype=np.int8)
+        for a in range(10):
+            for b in range(10):
+                if a <= 1 and b <= 1:
+                    self.dosages[a, b] = a + b
+                elif multiallelic == 'alt':
+                    self.dosages[a, b] = int(a > 0) + int(b > 0)
+
+    # Decode a 2D array-like of raw GT fields (bytes) into an int8 dosage matrix of the same shape
+    def decode(self, cells):
+        gt = np.asarray(cells)
+        if gt.dtype.kind != 'S' or gt.dtype.itemsize != GT_FIELD_WIDTH:
+            gt = np.array(cells, dtype='S{}'.format(GT_FIELD_WIDTH))
+        raw = gt.view(np.uint8).reshape(gt.shape + (GT_FIELD_WIDTH,))
+
+        dosages = self.dosages[self.allele_codes[raw[..., 0]], self.allele_codes[raw[..., 2]]]
+        valid = self.separator_ok[raw[..., 1]] & self.terminator_ok[raw[..., 3]]
+        dosages[~valid] = self.missing
+        return dosages
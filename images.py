@@ -0,0 +1,163 @@
+import hashlib
+import os
+import threading
+import time
+import uuid
+
+from googleapiclient.errors import HttpError
+
+from cache import TTLCache
+from operations import backoff_delays, execute_and_wait
+
+
+# This file contains the logic for provisioning GWAS instances from a prebuilt ("baked") boot image
+# Installing the toolchain and compiling NTL and secure-gwas with startup.sh takes tens of minutes, so instead of doing
+# it on every new instance, it is done once per project on a temporary builder instance, whose disk is then saved as
+# an image; later instances boot straight from that image
+# Images are named after a hash of startup.sh, so changing the install script bakes a new image, and the self link of
+# every project's image is cached so that provisioning usually doesn't need an extra API call to find it
+# Another web server worker may be baking the same image; an image it is still saving is waited for rather than baked
+# again
+
+
+# Whether new instances boot from a baked image (baking it first if needed) rather than running startup.sh themselves
+USE_BAKED_IMAGE = os.environ.get('GWAS_USE_BAKED_IMAGE', '1') != '0'
+
+STARTUP_SCRIPT = 'startup.sh'
+IMAGE_FAMILY = 'secure-gwas'
+BASE_IMAGE = 'projects/debian-cloud/global/images/family/debian-9'
+
+# Boot disk size (in GB) of the builder instance, which is also the smallest disk an instance made from the image can have
+IMAGE_DISK_SIZE_GB = 10
+BUILDER_MACHINE_TYPE = 'n1-standard-4'
+
+# How long (in seconds) a looked up image self link is reused before checking that the image still exists
+IMAGE_CACHE_TTL = 3600
+
+# How long (in seconds) to wait for an image that is still being saved, e.g. by another worker, to become ready
+IMAGE_READY_TIMEOUT = 1800.0
+
+# Backoff settings (in seconds) between checks of an image that is still being saved
+IMAGE_POLL_INITIAL_DELAY = 5.0
+IMAGE_POLL_MAX_DELAY = 30.0
+
+image_cache = TTLCache(IMAGE_CACHE_TTL)
+
+# Makes sure only one job in this process bakes a given image at a time
+bake_locks = {}
+bake_locks_lock = threading.Lock()
+
+
+# Version of the image, taken from the contents of the install script
+def image_version(script=STARTUP_SCRIPT):
+    with open(script, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()[:12]
+
+
+def image_name(version):
+    return '{}-{}'.format(IMAGE_FAMILY, version)
+
+
+def bake_lock(project, version):
+    with bake_locks_lock:
+        return bake_locks.setdefault((project, version), threading.Lock())
+
+
+# Self link of the project's image with the given version, or None if it hasn't been baked
+# An image that is still being saved (e.g. by another worker baking it at the same time) is waited for until it is
+# ready, and one that is being deleted until it is gone; an image that failed to save raises a RuntimeError, since
+# baking it again under the same name would be turned away
+def find_image(compute, project, version, timeout=IMAGE_READY_TIMEOUT, sleep=time.sleep, clock=time.monotonic):
+    deadline = clock() + timeout
+    delays = backoff_delays(IMAGE_POLL_INITIAL_DELAY, IMAGE_POLL_MAX_DELAY)
+    while True:
+        try:
+            image = compute.images().get(project=project, image=image_name(version)).execute()
+        except HttpError as e:
+            if e.resp.status == 404:
+                return None
+            raise
+        status = image.get('status')
+        if status == 'READY':
+            return image['selfLink']
+        if status == 'FAILED':
+            raise RuntimeError('Image {} failed to save; delete it to bake it again'.format(image_name(version)))
+
+        remaining = deadline - clock()
+        if remaining <= 0:
+            raise RuntimeError('Image {} was still {} after {} seconds'.format(image_name(version), status, timeout))
+        print('Image {} is {}, waiting'.format(image_name(version), status))
+        sleep(min(next(delays), remaining))
+
+
+# Create a temporary instance from the base image, install everything on it with install(instance name), and save its
+# boot disk as the image with the given version, returning the image's self link
+def bake_image(compute, project, zone, subnetwork, version, install, report=print):
+    builder = 'secure-gwas-builder-{}-{}'.format(version, uuid.uuid4().hex[:6])
+    report('Creating builder instance {} for image {}'.format(builder, image_name(version)))
+    builder_body = {
+        'name': builder,
+        'machineType': 'zones/{}/machineTypes/{}'.format(zone, BUILDER_MACHINE_TYPE),
+        'networkInterfaces': [{'subnetwork': subnetwork}],
+        'disks': [{
+            'boot': True,
+            'autoDelete': True,
+            'initializeParams': {
+                'sourceImage': BASE_IMAGE,
+                'diskType': 'zones/{}/diskTypes/pd-ssd'.format(zone),
+                'diskSizeGb': IMAGE_DISK_SIZE_GB
+            }
+        }]
+    }
+    execute_and_wait(compute, project, compute.instances().insert(project=project, zone=zone, body=builder_body))
+
+    try:
+        report('Installing GWAS packages and code on builder instance {}'.format(builder))
+        install(builder)
+
+        # the disk has to be detached from a running instance before it can be imaged consistently
+        report('Saving image {}'.format(image_name(version)))
+        execute_and_wait(compute, project, compute.instances().stop(project=project, zone=zone, instance=builder))
+        builder_info = compute.instances().get(project=project, zone=zone, instance=builder).execute()
+        image_body = {
+            'name': image_name(version),
+            'family': IMAGE_FAMILY,
+            'sourceDisk': builder_info['disks'][0]['source'],
+            'labels': {'secure-gwas-version': version}
+        }
+        try:
+            execute_and_wait(compute, project, compute.images().insert(project=project, body=image_body))
+        except HttpError as e:
+            # another web server worker baked the same image in the meantime, which find_image waits for below
+            if e.resp.status != 409:
+                raise
+    finally:
+        execute_and_wait(compute, project, compute.instances().delete(project=project, zone=zone, instance=builder))
+
+    self_link = find_image(compute, project, version)
+    if self_link is None:
+        raise RuntimeError('Image {} was not ready after baking it'.format(image_name(version)))
+    return self_link
+
+
+# Self link of the project's image for the current install script, baking the image first if it doesn't exist yet
+def get_or_bake_image(compute, project, zone, subnetwork, install, version=None, report=print):
+    if version is None:
+        version = image_version()
+    key = (project, version)
+
+    self_link = image_cache.get(key)
+    if self_link is not None:
+        return self_link
+
+    with bake_lock(project, version):
+        self_link = find_image(compute, project, version)
+        if self_link is None:
+            self_link = bake_image(compute, project, zone, subnetwork, version, install, report)
+        image_cache.set(key, self_link)
+    return self_link
+
+
+# Forget the cached self link of a project's image, e.g. if an instance could not be created from it
+def invalidate_image(project, version=None):
+    image_cache.invalidate((project, version if version is not None else image_version()))
@@ -0,0 +1,85 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import TTLCache
+
+
+# This file contains helpers for listing the compute instances in a project
+# The inventory is built with a single aggregatedList call where possible, falling back to listing every zone
+# concurrently, and is cached per project so that repeated page loads don't hit the Compute API at all
+
+
+# How long (in seconds) a project's instance list is reused before it is fetched again
+INSTANCE_CACHE_TTL = 60
+
+# Number of zones listed at once when falling back to per-zone listing
+ZONE_LIST_WORKERS = 16
+
+instance_cache = TTLCache(INSTANCE_CACHE_TTL)
+
+
+# Execute a request, using a separate http object from http_factory if one is given
+# httplib2 connections are not thread-safe, so every thread listing zones needs its own
+def execute_request(request, http_factory=None):
+    if http_factory is None:
+        return request.execute()
+    return request.execute(http=http_factory())
+
+
+# List (instance name, zone name) pairs for every instance in the project with one paginated aggregatedList call
+def list_instances_aggregated(compute, project):
+    instances = []
+    request = compute.instances().aggregatedList(project=project)
+    while request is not None:
+        response = request.execute()
+        for scope, scoped_list in response.get('items', {}).items():
+            zone = scope.split('/')[-1]
+            for instance in scoped_list.get('instances', []):
+                instances.append((instance['name'], zone))
+        request = compute.instances().aggregatedList_next(previous_request=request, previous_response=response)
+    return instances
+
+
+# List the instances in a single zone, following pagination
+def list_zone_instances(compute, project, zone, http_factory=None):
+    instances = []
+    request = compute.instances().list(project=project, zone=zone)
+    while request is not None:
+        response = execute_request(request, http_factory)
+        instances += [(instance['name'], zone) for instance in response.get('items', [])]
+        request = compute.instances().list_next(previous_request=request, previous_response=response)
+    return instances
+
+
+# List (instance name, zone name) pairs by listing every zone of the project concurrently
+# A zone that fails to list is skipped rather than failing the whole inventory
+def list_instances_by_zone(compute, project, http_factory=None):
+    response = compute.zones().list(project=project).execute()
+    zones = [zone['name'] for zone in response.get('items', [])]
+
+    def list_zone(zone):
+        try:
+            return list_zone_instances(compute, project, zone, http_factory)
+        except Exception as e:
+            print('Failed to list instances in zone {}: {}'.format(zone, e))
+            return []
+
+    with ThreadPoolExecutor(max_workers=ZONE_LIST_WORKERS) as executor:
+        return [instance for instances in executor.map(list_zone, zones) for instance in instances]
+
+
+# Return the (instance name, zone name) pairs for all instances in the project, from the cache when possible
+def list_instances(compute, project, http_factory=None):
+    def fetch():
+        try:
+            instances = list_instances_aggregated(compute, project)
+        except Exception as e:
+            print('aggregatedList failed for project {}, listing zones instead: {}'.format(project, e))
+            instances = list_instances_by_zone(compute, project, http_factory)
+        return instances
+
+    return instance_cache.get_or_compute(project, fetch)
+
+
+# Forget the cached instance list of a project, e.g. after this UI starts or creates an instance in it
+def invalidate_instances(project):
+    instance_cache.invalidate(project)
@@ -0,0 +1,118 @@
+import os
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import psutil
+
+
+# This file contains the background job queue used to run slow work (instance setup, data preprocessing, config
+# updates) outside of the HTTP request that triggered it
+# Jobs run on a local thread pool, while their state is kept in a SQLite database so that any gunicorn worker can
+# report the status of a job started by another worker
+
+
+JOBS_DB = os.environ.get('GWAS_JOBS_DB', 'jobs.db')
+JOB_WORKERS = int(os.environ.get('GWAS_JOB_WORKERS', 4))
+
+# Possible job states
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+executor = ThreadPoolExecutor(max_workers=JOB_WORKERS)
+
+# Tracks which job the current worker thread is running, so that report_progress knows which job to update
+current_job = threading.local()
+
+
+def connect_jobs_db():
+    conn = sqlite3.connect(JOBS_DB, timeout=30)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+# Create the jobs table if it does not exist yet
+def init_jobs_db():
+    with connect_jobs_db() as conn:
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                            id TEXT PRIMARY KEY,
+                            kind TEXT,
+                            status TEXT,
+                            progress TEXT,
+                            error TEXT,
+                            pid INTEGER,
+                            created REAL,
+                            updated REAL,
+                            next_url TEXT)''')
+        # databases created before jobs had a follow-up page
+        columns = [row['name'] for row in conn.execute('PRAGMA table_info(jobs)')]
+        if 'next_url' not in columns:
+            conn.execute('ALTER TABLE jobs ADD COLUMN next_url TEXT')
+
+
+def update_job(job_id, **fields):
+    fields['updated'] = time.time()
+    assignments = ', '.join('{} = ?'.format(k) for k in fields)
+    with connect_jobs_db() as conn:
+        conn.execute('UPDATE jobs SET {} WHERE id = ?'.format(assignments), list(fields.values()) + [job_id])
+
+
+# Record a progress message for the job running on this thread (or just print it when called outside of a job)
+def report_progress(message):
+    print(message)
+    job_id = getattr(current_job, 'job_id', None)
+    if job_id is not None:
+        update_job(job_id, progress=message)
+
+
+def run_job(job_id, fn, args, kwargs):
+    current_job.job_id = job_id
+    update_job(job_id, status=JOB_RUNNING)
+    try:
+        fn(*args, **kwargs)
+        update_job(job_id, status=JOB_DONE)
+    except Exception as e:
+        traceback.print_exc()
+        update_job(job_id, status=JOB_FAILED, error='{}: {}'.format(type(e).__name__, e))
+    finally:
+        current_job.job_id = None
+
+
+# Queue fn(*args, **kwargs) to run in the background and return the ID of the new job
+# next_url is the page the job page moves on to once the job is done; it is kept with the job rather than passed around
+# in the job page's URL, so it can't be pointed anywhere else
+def submit_job(kind, fn, *args, next_url=None, **kwargs):
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    with connect_jobs_db() as conn:
+        conn.execute('INSERT INTO jobs (id, kind, status, progress, error, pid, created, updated, next_url) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                     (job_id, kind, JOB_QUEUED, 'Waiting to start', None, os.getpid(), now, now, next_url))
+    executor.submit(run_job, job_id, fn, args, kwargs)
+    return job_id
+
+
+# Return the state of a job as a dictionary, or None if there is no such job
+# Jobs whose owning process has exited without finishing them are reported as failed
+def get_job(job_id):
+    with connect_jobs_db() as conn:
+        row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+    if row is None:
+        return None
+
+    job = dict(row)
+    if job['status'] in (JOB_QUEUED, JOB_RUNNING) and not psutil.pid_exists(job['pid']):
+        job['status'] = JOB_FAILED
+        job['error'] = 'The server process running this job exited before it finished'
+        update_job(job_id, status=job['status'], error=job['error'])
+    finished = job['status'] in (JOB_DONE, JOB_FAILED)
+    job['elapsed'] = (job['updated'] if finished else time.time()) - job['created']
+    return job
+
+
+init_jobs_db()
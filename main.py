@@ -1,14 +1,35 @@
-from flask import Flask, g, session, flash, request, render_template, redirect, url_for, Response
+from flask import Flask, g, session, flash, request, render_template, redirect, url_for, Response, jsonify, abort
 import sys
 import os.path
 import pprint
+import shutil
+import tempfile
 import time
 
+import httplib2
 from googleapiclient import discovery
 from oauth2client.client import GoogleCredentials
 from google.cloud import storage
 
 from data import *
+from preprocess import transform_genotype_data_vcf_parallel
+from jobs import submit_job, get_job, report_progress
+from operations import execute_and_wait
+from inventory import list_instances, invalidate_instances
+from blobs import list_input_blobs, get_input_blob
+from blobstream import open_blob_stream
+from bundle import transfer_bundle_to_instance
+from params import get_gwas_roles, update_param_files
+from streaming import sse_event
+from scheduler import ProtocolRound, round_concurrency, ROUND_MAX_RETRIES
+from runs import RUN_DATA_SHARING, RUN_GWAS, RUN_RUNNING, get_run, list_runs, latest_run, launch_run, run_alive, follow_run, stop_run
+from peering import desired_peer_projects, reconcile_peerings
+from images import USE_BAKED_IMAGE, STARTUP_SCRIPT, BASE_IMAGE, get_or_bake_image
+from preprocache import get_preprocess_cache, blob_cache_key, list_digest
+from qc import VariantFilter
+from remoteprep import RemoteWorkerUnavailable, check_remote_worker, preprocess_on_instance, copy_file_from_instance
+from posmerge import MERGE_UNION, merge_pos_files
+from configstore import get_config_store, ConfigConflictError
 
 
 # This file contains all the endpoints for the secure GWAS UI
@@ -20,6 +41,9 @@ app.config.from_mapping(SECRET_KEY='dev')
 # Global Variables
 credentials = GoogleCredentials.get_application_default()
 compute = discovery.build('compute', 'v1', credentials=credentials)
+# Each thread that calls the Compute API concurrently needs its own authorized http object
+def new_authorized_http():
+    return credentials.authorize(httplib2.Http())
 role_to_id = {
     'CP0': 0,
     'CP1': 1,
@@ -34,36 +58,18 @@ default_machine_types = [('g1-small', '   (1 vCPU, 1.7 GB RAM)'), ('n1-standard-
                         ('n1-standard-4', '   (4 vCPU, 15 GB RAM)'), ('n1-standard-32', '   (32 vCPU, 120 GB RAM)'),
                         ('n1-highcpu-32', '   (32 vCPU, 28.8 GB RAM)')]
 
-# The all_gwas_configs dictionary contains a mapping from a user's selected Google Cloud project and instance IDs 
-# to the config dictionary that stores their GWAS parameter values
-# The config dictionary is used to 
-all_gwas_configs = {}
-def add_gwas_config(project, instance):
-    new_config = get_default_config_dict()
-    all_gwas_configs[project + instance] = new_config
-    return new_config
-def get_gwas_config(project, instance):
-    return all_gwas_configs[project + instance]
-
-# Simple helper functions to generate a series of non-overlapping port numbers used for inter-party GWAS communication
-# Since every dataset needs at least 5 ports (corresponding to the 5 channels CP0-CP1, CP0-CP2, CP1-CP2, CP1-SP, CP2-SP),
-# and since the GWAS code uses different ports for communication between different threads, we need to space out the ports
-# for 2 consecutive datasets by at at least 5 * num_threads
-def get_P0_P1_ports(num_S, num_threads):
-    return ' '.join([str(8000 + 5 * num_threads * i) for i in range(num_S)])
-def get_P0_P2_ports(num_S, num_threads):
-    return ' '.join([str(8001 + 5 * num_threads * i) for i in range(num_S)])
-def get_P1_P2_ports(num_S, num_threads):
-    return ' '.join([str(8002 + 5 * num_threads * i) for i in range(num_S)])
-def get_P1_P3_ports(num_S, num_threads):
-    return ' '.join([str(8003 + 5 * num_threads * i) for i in range(num_S)])
-def get_P2_P3_ports(num_S, num_threads):
-    return ' '.join([str(8004 + 5 * num_threads * i) for i in range(num_S)])
-
-# Simple helper function to generate a series of cache file prefixes corresponding to the different GWAS datasets
-# These cache file prefixes are used to locate the directory where all GWAS secret-shared and intermediate data is written
-def get_cache_file_prefixes(num_S, role):
-    return ' '.join(['../cache/data{}_P{}'.format(i, role) for i in range(num_S)])
+# Each user's GWAS parameter values are kept in the config store, keyed by their selected Google Cloud project and
+# instance IDs, so that every web server worker sees the same config
+# Every save is kept as a new version of the config
+def save_gwas_config(project, instance, gwas_config, expected_version=None):
+    version = get_config_store().save(project, instance, gwas_config, expected_version)
+    print('Saved version {} of the config for {} {}'.format(version, project, instance))
+    return version
+def get_gwas_config(project, instance, version=None):
+    gwas_config = get_config_store().load(project, instance, version)
+    if gwas_config is None:
+        abort(404, 'No config has been loaded for instance {} in project {}'.format(instance, project))
+    return gwas_config
 
 # Helper functions for Google Cloud specific behavior
 # The default network/subnetwork names are based on GWAS-specific conventions
@@ -109,22 +115,15 @@ def choose_instance(project):
 
             # actually start the instance
             compute.instances().start(project=project, zone=zone, instance=instance).execute()
+            invalidate_instances(project)
 
             return redirect(url_for('choose_bucket', project=project, zone=zone, instance=instance))
 
         flash(error)
 
     # generate a list of all existing instances within this project
-    all_instances = []
     try:
-        response = compute.zones().list(project=project).execute()
-        all_zones = response['items'] if 'items' in response else []
-        for zone in all_zones:
-            new_response = compute.instances().list(
-                project=project, zone=zone['name']).execute()
-            instances = new_response['items'] if 'items' in new_response else []
-            for instance in instances:
-                all_instances.append((instance['name'], zone['name']))
+        all_instances = list_instances(compute, project, http_factory=new_authorized_http)
         return render_template('instance.html', project=project, instances=all_instances)
     
     except:
@@ -162,14 +161,9 @@ def create_instance(project):
     return render_template('create.html', all_zones=default_all_zones, all_machine_types=default_machine_types)
 
 
-# After the user has entered their desired specifications for a new GWAS instance, the UI navigates to this success page
-# In the background, this endpoint actually sets up the GWAS network, creates the new instance, and installs the
-# necessary packages to run GWAS code
-@app.route('/setup/<string:project>/<string:name>/<string:zone>/<string:machine_type>/<int:disk_size>', methods=['GET', 'POST'])
-def setup_instance(project, name, zone, machine_type, disk_size):
-    if request.method == 'POST':
-        return redirect(url_for('choose_instance', project=project))
-
+# Background job that sets up the GWAS network, creates the new instance, and installs the necessary packages
+# to run GWAS code
+def provision_instance(project, name, zone, machine_type, disk_size):
     # first, create a private GWAS-specific VPC network if necessary
     net_name = default_network_name(project)
     existing_nets = compute.networks().list(project=project).execute()['items']
@@ -178,29 +172,25 @@ def setup_instance(project, name, zone, machine_type, disk_size):
         if net['name'] == net_name:
             need_to_create = False
     if need_to_create:
-        print('creating network')
+        report_progress('Creating network {}'.format(net_name))
         req_body = {
             'name': net_name,
             'autoCreateSubnetworks': False,
             'routingConfig': {'routingMode': 'GLOBAL'}
         }
-        compute.networks().insert(project=project, body=req_body).execute()
-
-        # now add a subnet to this VPC network
-        # add 30 second delay cause it takes time to create a network
-        time.sleep(30)
-        nets = compute.networks().list(project=project).execute()['items']
-        network_url = ''
-        for net in nets:
-            if net['name'] == net_name:
-                network_url = net['selfLink']
+        operation = execute_and_wait(compute, project, compute.networks().insert(project=project, body=req_body))
+
+        # now add a subnet to this VPC network, once the network has actually been created
+        network_url = operation['targetLink']
         req_body = {
             'name': default_subnetwork_name(net_name),
             'network': network_url,
             'ipCidrRange': '10.{}.{}.0/24'.format(random.randint(0, 255), random.randint(0, 255)), 
-            'region': zone_to_region(zone)
+            'region': zone_to_region(zone),
+            # instances have no external IP, so this lets them reach Cloud Storage for remote preprocessing
+            'privateIpGoogleAccess': True
         }
-        compute.subnetworks().insert(project=project, region=zone_to_region(zone), body=req_body).execute()
+        execute_and_wait(compute, project, compute.subnetworks().insert(project=project, region=zone_to_region(zone), body=req_body))
 
         # finally, add a firewall rule allowing ingress
         firewall_body = {
@@ -210,47 +200,198 @@ def setup_instance(project, name, zone, machine_type, disk_size):
             'sourceRanges': ['0.0.0.0/0'],
             'allowed': [{'IPProtocol': 'all'}]
         }
-        compute.firewalls().insert(project=project, body=firewall_body).execute()
+        execute_and_wait(compute, project, compute.firewalls().insert(project=project, body=firewall_body))
+
+    # install the necessary packages and codebase on an instance using a startup shell script
+    def install(instance):
+        transfer_file_to_instance(project, instance, STARTUP_SCRIPT, '~/', delete_after=False)
+        execute_shell_script_on_instance(project, instance, ['chmod u+x {}'.format(STARTUP_SCRIPT), './{}'.format(STARTUP_SCRIPT)])
+
+    # boot from the project's baked image, so the install only ever runs once per project (and version of startup.sh)
+    subnetwork = "regions/{}/subnetworks/{}".format(zone_to_region(zone), default_subnetwork_name(net_name))
+    source_image = BASE_IMAGE
+    if USE_BAKED_IMAGE:
+        source_image = get_or_bake_image(compute, project, zone, subnetwork, install, report=report_progress)
 
     # now, actually create the instance and attach it to this GWAS network
+    report_progress('Creating instance {}'.format(name))
     instance_body = {
         "name": name,
         "machineType": "zones/{}/machineTypes/{}".format(zone, machine_type),
         "networkInterfaces": [{
-            "subnetwork": "regions/{}/subnetworks/{}".format(zone_to_region(zone), default_subnetwork_name(net_name))
+            "subnetwork": subnetwork
         }],
         "disks": [{
             "boot": True,
             "initializeParams": {
-                "sourceImage": "projects/debian-cloud/global/images/family/debian-9",
+                "sourceImage": source_image,
                 "diskType": "zones/{}/diskTypes/pd-ssd".format(zone),
                 "diskSizeGb": disk_size
             }
+        }],
+        # read access to Cloud Storage, so input data can be preprocessed on the instance itself
+        "serviceAccounts": [{
+            "email": "default",
+            "scopes": ["https://www.googleapis.com/auth/devstorage.read_only"]
         }]
     }
-    compute.instances().insert(project=project, zone=zone, body=instance_body).execute()
-    time.sleep(10)
+    execute_and_wait(compute, project, compute.instances().insert(project=project, zone=zone, body=instance_body))
+    invalidate_instances(project)
+
+    # the code is installed in the home directory of whoever baked the image, so fall back to installing it here if
+    # that isn't us
+    if source_image == BASE_IMAGE or execute_shell_script_on_instance(project, name, ['test -x ~/secure-gwas/code/bin/DataSharingClient']) != 0:
+        report_progress('Installing GWAS packages and code on {}'.format(name))
+        install(name)
+    report_progress('Finished setting up {}'.format(name))
+
 
-    # setup the new GWAS instnace with the necessary packages and codebase using a startup shell script
-    transfer_file_to_instance(project, name, 'startup.sh', '~/', delete_after=False)
-    execute_shell_script_on_instance(project, name, ['chmod u+x startup.sh', './startup.sh'])
+# After the user has entered their desired specifications for a new GWAS instance, the UI navigates to this success page
+# In the background, this endpoint queues a job that actually sets up the GWAS network, creates the new instance, and
+# installs the necessary packages to run GWAS code
+@app.route('/setup/<string:project>/<string:name>/<string:zone>/<string:machine_type>/<int:disk_size>', methods=['GET', 'POST'])
+def setup_instance(project, name, zone, machine_type, disk_size):
+    if request.method == 'POST':
+        return redirect(url_for('choose_instance', project=project))
+
+    job_id = submit_job('setup_instance', provision_instance, project, name, zone, machine_type, disk_size)
+    return render_template('setup.html', job=get_job(job_id))
 
-    return render_template('setup.html')
+
+# Background job that converts the chosen genotype and covariate blobs into the GWAS input files and transfers them
+# to the compute instance
+# The blobs are streamed straight into the converters, and every job writes its output to its own directory so that
+# several sessions can prepare data at the same time
+def prepare_input_data(project, instance, gen_blob, cov_blob, binary, cov_columns=None, variant_filter=None, remote=False):
+    # in remote mode the instance reads the blobs and converts them itself, unless it isn't able to
+    if remote:
+        try:
+            return prepare_input_data_on_instance(project, instance, gen_blob, cov_blob, cov_columns, variant_filter)
+        except RemoteWorkerUnavailable as e:
+            report_progress('Cannot preprocess the data on {} ({}), so preprocessing it locally instead'.format(instance, e))
+
+    # in binary mode the data is sent in the compact binary format and converted to text on the instance
+    binary_names = []
+    workdir = tempfile.mkdtemp(prefix='gwas-data-')
+    cache = get_preprocess_cache()
+
+    try:
+        fnames = []
+        subject_ids = None
+        if gen_blob:
+            # if user specifies genotype data, convert it from VCF to text file format, unless the same version of the
+            # blob has already been converted
+            # variants failing QC are dropped during the conversion when a variant_filter is given
+            def convert_genotypes(out_dir):
+                report_progress('Downloading and converting genotype data {}'.format(gen_blob.name))
+                with open_blob_stream(gen_blob) as stream:
+                    subjects = transform_genotype_data_vcf_parallel(stream, binary=binary, out_dir=out_dir,
+                                                                    variant_filter=variant_filter)
+                return {'subjects': subjects, 'qc': variant_filter.summary() if variant_filter is not None else None}
+
+            gen_files = [matrix_fname('geno', binary), matrix_fname('pheno', binary), 'pos.txt']
+            result, cached = cache.get_or_convert(blob_cache_key('genotype', gen_blob, binary, variant_filter), workdir,
+                                                  gen_files, convert_genotypes)
+            if cached:
+                report_progress('Using previously converted genotype data {}'.format(gen_blob.name))
+            subject_ids = result['subjects']
+            if result['qc'] is not None:
+                report_progress('Variant QC {}'.format(result['qc']))
+                record_qc_num_snps(project, instance, count_lines(os.path.join(workdir, 'pos.txt')))
+            elif os.path.isfile(qc_num_snps_fname(instance)):
+                os.remove(qc_num_snps_fname(instance))
+            fnames += [os.path.join(workdir, fname) for fname in gen_files]
+            binary_names += ['geno', 'pheno']
+
+            # keep a local copy of the positions, which need to be shared with the CPs
+            shutil.copy(os.path.join(workdir, 'pos.txt'), '{}-pos.txt'.format(instance))
+
+        if cov_blob:
+            # if user specifies covariate data, convert it to text file format, aligned to the genotype subjects
+            def convert_covariates(out_dir):
+                report_progress('Downloading and converting covariate data {}'.format(cov_blob.name))
+                with open_blob_stream(cov_blob) as stream:
+                    return transform_covariate_data(stream, subject_ids, binary=binary, out_dir=out_dir, columns=cov_columns)
+
+            key = blob_cache_key('covariates', cov_blob, binary, cov_columns,
+                                 list_digest(subject_ids) if subject_ids is not None else None)
+            num_covs, cached = cache.get_or_convert(key, workdir, [matrix_fname('cov', binary)], convert_covariates)
+            if cached:
+                report_progress('Using previously converted covariate data {}'.format(cov_blob.name))
+            report_progress('Encoded covariates {} into {} columns (NUM_COVS)'.format(cov_columns, num_covs))
+            fnames.append(os.path.join(workdir, matrix_fname('cov', binary)))
+            binary_names.append('cov')
+
+        # then transfer all of the data to compute instance as one compressed bundle
+        report_progress('Transferring data to {}'.format(instance))
+        sent = transfer_bundle_to_instance(project, instance, fnames, '~/secure-gwas/gwas_data/')
+        report_progress('Transferred {} to {}'.format(', '.join(sent) or 'nothing (already up to date)', instance))
+
+        if binary and binary_names:
+            report_progress('Converting binary data to text on {}'.format(instance))
+            convert_binary_files_on_instance(project, instance, binary_names, '~/secure-gwas/gwas_data/')
+    finally:
+        shutil.rmtree(workdir)
+
+
+# Preprocess the input data on the compute instance, which reads the blobs straight from Cloud Storage and writes the
+# text files in place, so the data never passes through this machine (see prepworker.py)
+# Raises RemoteWorkerUnavailable, before anything is converted, if the instance can't do this
+def prepare_input_data_on_instance(project, instance, gen_blob, cov_blob, cov_columns=None, variant_filter=None):
+    report_progress('Sending the preprocessing worker to {}'.format(instance))
+    summary = check_remote_worker(project, instance, [blob for blob in (gen_blob, cov_blob) if blob], report_progress)
+    report_progress('Preprocessing on {} with {} CPUs'.format(instance, summary['cpus']))
+
+    # the keys identify the exact conversions, so the instance can skip one whose output it already has
+    gen_key = blob_cache_key('genotype', gen_blob, False, variant_filter) if gen_blob else None
+    cov_key = blob_cache_key('covariates', cov_blob, False, cov_columns, gen_key) if cov_blob else None
+    result = preprocess_on_instance(project, instance, gen_blob, cov_blob, report_progress, gen_key, cov_key,
+                                    cov_columns, variant_filter)
+
+    if gen_blob:
+        genotypes = result['genotype']
+        if genotypes['qc'] is not None:
+            report_progress('Variant QC {}'.format(genotypes['qc']))
+            record_qc_num_snps(project, instance, genotypes['num_snps'])
+        elif os.path.isfile(qc_num_snps_fname(instance)):
+            os.remove(qc_num_snps_fname(instance))
+
+        # keep a local copy of the positions, which need to be shared with the CPs
+        copy_file_from_instance(project, instance, '~/secure-gwas/gwas_data/pos.txt', '{}-pos.txt'.format(instance))
+
+    if cov_blob:
+        report_progress('Encoded covariates {} into {} columns (NUM_COVS)'.format(cov_columns, result['covariates']['num_covs']))
+
+
+def count_lines(fname):
+    with open(fname, 'rb') as f:
+        return sum(block.count(b'\n') for block in iter(lambda: f.read(1024 * 1024), b''))
+
+
+# After variant QC, NUM_SNPS is the number of variants that were kept rather than the number in the VCF
+# The count is kept in a local file for when the config is loaded later, and applied to the current config if one has
+# been loaded already
+def qc_num_snps_fname(instance):
+    return '{}-qc-num-snps.txt'.format(instance)
+def record_qc_num_snps(project, instance, num_snps):
+    with open(qc_num_snps_fname(instance), 'w') as f:
+        f.write('{}\n'.format(num_snps))
+    gwas_config = get_config_store().load(project, instance)
+    if gwas_config is not None and gwas_config['NUM_SNPS'] != num_snps:
+        gwas_config['NUM_SNPS'] = num_snps
+        save_gwas_config(project, instance, gwas_config)
+    report_progress('NUM_SNPS is {} after variant QC'.format(num_snps))
+def apply_qc_num_snps(instance, gwas_config):
+    if os.path.isfile(qc_num_snps_fname(instance)):
+        with open(qc_num_snps_fname(instance)) as f:
+            gwas_config['NUM_SNPS'] = int(f.read())
 
 
 # This endpoint allows users to specify a cloud storage bucket that contains the input data for GWAS
+# The chosen data is preprocessed and transferred to the instance by a background job
 @app.route('/data/<string:project>/<string:zone>/<string:instance>', methods=['GET', 'POST'])
 def choose_bucket(project, zone, instance):
-    # first, generate a flattened view of all storage blobs in this project
     client = storage.Client(project=project)
-    all_blobs = {}
-    for bucket in client.list_buckets():
-        try: 
-            for blob in client.list_blobs(bucket):
-                if blob.name[-1] != '/':
-                    all_blobs[blob.name] = blob
-        except:
-            continue
 
     if request.method == 'POST':
         gen_key = request.form['gen_blob']
@@ -261,37 +402,41 @@ def choose_bucket(project, zone, instance):
             error = "Please choose your data sources before proceeding. If you are not playing the role of S, simply choose 'No Input Data'"
 
         if not error:
-            gen_blob = all_blobs[gen_key] if (gen_key != 'None' and gen_key != 'Done') else None
-            cov_blob = all_blobs[cov_key] if (cov_key != 'None' and cov_key != 'Done') else None
+            # look up the chosen blobs directly by bucket and name
+            gen_blob = get_input_blob(client, gen_key) if (gen_key != 'None' and gen_key != 'Done') else None
+            cov_blob = get_input_blob(client, cov_key) if (cov_key != 'None' and cov_key != 'Done') else None
+
+            if (gen_blob is None and gen_key not in ('None', 'Done')) or (cov_blob is None and cov_key not in ('None', 'Done')):
+                error = 'The chosen data source no longer exists. Please choose again.'
+
+        if not error:
+            try:
+                cov_columns = parse_covariate_columns(request.form.get('cov_columns', DEFAULT_COVARIATE_COLUMNS))
+                variant_filter = None
+                if 'qc' in request.form:
+                    variant_filter = VariantFilter(float(request.form['min_maf']), float(request.form['max_missing']),
+                                                   float(request.form['min_hwe_p']))
+            except ValueError as e:
+                error = str(e)
 
+        if not error:
             is_S = (gen_blob is not None) or (gen_key == 'Done')
 
-            subject_ids = None
-            if gen_blob:
-                # if user specifies genotype data, convert it from VCF to text file format
-                # then transfer the data to compute instance
-                fname = 'base-genotypes.gz'
-                with open(fname, 'xb') as f:
-                    client.download_blob_to_file(gen_blob, f)
-                subject_ids = transform_genotype_data_vcf(fname)
-                transfer_file_to_instance(project, instance, 'geno.txt', '~/secure-gwas/gwas_data/', delete_after=True)
-                transfer_file_to_instance(project, instance, 'pheno.txt', '~/secure-gwas/gwas_data/', delete_after=True)
-                transfer_file_to_instance(project, instance, 'pos.txt', '~/secure-gwas/gwas_data/', delete_after=False)
-            
-            if cov_blob:
-                # if user specifies covariate data, convert it from VCF to text file format
-                # then transfer the data to compute instance
-                fname = 'base-covariates'
-                with open(fname, 'xb') as f:
-                    client.download_blob_to_file(cov_blob, f)
-                transform_covariate_data(fname, subject_ids)
-                transfer_file_to_instance(project, instance, 'cov.txt', '~/secure-gwas/gwas_data/', delete_after=True)
-
-            return redirect(url_for('load_config', project=project, zone=zone, instance=instance))
+            next_url = url_for('load_config', project=project, zone=zone, instance=instance)
+            if gen_blob is None and cov_blob is None:
+                return redirect(next_url)
+
+            job_id = submit_job('choose_bucket', prepare_input_data, project, instance, gen_blob, cov_blob,
+                                'binary' in request.form, cov_columns, variant_filter, 'remote' in request.form,
+                                next_url=next_url)
+            return redirect(url_for('job_page', job_id=job_id))
 
         flash(error)
 
-    return render_template('bucket.html', blobs=list(all_blobs.keys())[:5])
+    # generate a view of the storage blobs in this project that can hold input data, optionally filtered by prefix
+    prefix = request.args.get('prefix', '')
+    return render_template('bucket.html', blobs=list_input_blobs(client, project, prefix), prefix=prefix,
+                           cov_columns=DEFAULT_COVARIATE_COLUMNS, qc=VariantFilter())
 
 
 # This endpoint allows users to input the location of a shared config.txt file
@@ -316,149 +461,110 @@ def load_config(project, zone, instance):
             error = 'Please give an absolute path to a file that exists on your local machine.'
 
         if error is None:
-            gwas_config = add_gwas_config(project, instance)
-            read_config_file(fname, gwas_config)
+            # check the whole config before saving it, so mistakes show up now rather than partway through the protocol
+            try:
+                gwas_config = parse_config_file(fname)
+                errors = validate_config(gwas_config)
+            except ConfigError as e:
+                errors = e.errors
+
+            if not errors:
+                gwas_config = gwas_config.to_dict()
+                apply_qc_num_snps(instance, gwas_config)
+                save_gwas_config(project, instance, gwas_config)
+                return redirect(url_for('customize_config', project=project, zone=zone, instance=instance))
+            error = 'Invalid config file: {}'.format('; '.join(errors))
 
-            return redirect(url_for('customize_config', project=project, zone=zone, instance=instance))
+        flash(error)
 
     return render_template('load_config.html')
 
 
+# Background job that writes the finalized GWAS config to the parameter files on the instance, and creates the VPC
+# peering connections between communicating instances
+def apply_gwas_config(project, instance, gwas_config):
+    roles = get_gwas_roles(gwas_config)
+    print("All machine IDs for this server: {}".format(roles))
+
+    # for each role (CP0, CP1, CP2, S) that this user is enacting, update their corresponding GWAS parameter file
+    report_progress('Updating parameter files for roles {}'.format(roles))
+    diffs = update_param_files(project, instance, gwas_config)
+    for role, diff in diffs.items():
+        print('\n'.join(diff))
+    report_progress('Updated parameter files for roles {}'.format(sorted(diffs)) if diffs else 'Parameter files already up to date')
+
+    # now create the VPC peering connections between communicating instances
+    # this allows instances in distinct projects/networks to communicate freely with each other
+    peer_gcp_projects = desired_peer_projects(gwas_config, roles, project)
+    print(peer_gcp_projects)
+    reconcile_peerings(compute, project, peer_gcp_projects, default_network_name, http_factory=new_authorized_http,
+                       report=report_progress)
+
+
 # Once the user provides the config.txt file location, the UI loads the data and displays it in an editable
 # text form view to the user, so they can review and finalize all settings before proceeding
 @app.route('/customizeConfig/<string:project>/<string:zone>/<string:instance>', methods=['GET', 'POST'])
 def customize_config(project, zone, instance):
-    # get the gwas config dictionary for this user
-    gwas_config = get_gwas_config(project, instance)
-
+    # get the gwas config dictionary for this user; a submitted form is applied to the version it was rendered from,
+    # which the form carries along, so an edit saved by another request in the meantime is not silently overwritten
+    version = get_config_store().latest_version(project, instance)
     if request.method == 'POST':
-        error = None
-
-        if gwas_config['S_ROLE'] is not None and (gwas_config['S_ROLE'] < 0 or gwas_config['S_ROLE'] >= gwas_config['NUM_S']):
-            error = "Make sure that the S role is a number between 0 and Num_S - 1"
+        try:
+            version = int(request.form.get('config_version', ''))
+        except ValueError:
+            flash('The form did not say which version of the config it edits, please review it and try again')
+            return redirect(url_for('customize_config', project=project, zone=zone, instance=instance))
+    gwas_config = get_gwas_config(project, instance, version or None)
 
-        if error is None:
-            # first, update the gwas config dictionary with any updated settings 
+    if request.method == 'POST':
+        # first, update the gwas config dictionary with any updated settings, and check the result as a whole
+        try:
             for key in request.form:
+                if key == 'config_version':
+                    continue
                 tokens = request.form[key].split()
                 update_config_dict(gwas_config, key, tokens)
+            errors = validate_config(GwasConfig.from_dict(gwas_config))
+        except ConfigError as e:
+            errors = e.errors
 
+        if not errors:
             print("Is acting as S: {}".format(gwas_config['S_ROLE'] is not None))
-            
-            # generate the commands to update the parameter files that are actually stored on the instance
-            def gen_command(search_and_replace_text_pairs, role):
-                cmds = []
-                for k, v in search_and_replace_text_pairs:
-                    cmds.append('sed -i "s|^{k}.*$|{k} {v}|g" ~/secure-gwas/par/test.par.{role}.txt'.format(k=k, v=v, role=role))
-                return cmds
-
-            num_S = gwas_config['NUM_S']
-            roles = []
-            if gwas_config['CP_ROLE'] is not None:
-                roles.append(gwas_config['CP_ROLE'])
-            if gwas_config['S_ROLE']is not None:
-                roles.append(3)
-
-            print("All machine IDs for this server: {}".format(roles))
-                
-            # for each role (CP0, CP1, CP2, S) that this user is enacting, update their corresponding GWAS parameter file
-            # to do this, we first generate a list of parameter key-value pairs
-            for role in roles:
-                pairs = []
-
-                # GWAS Parameters
-                pairs.append(('NUM_INDS', ' '.join([str(x) for x in gwas_config['NUM_INDS']])))
-                pairs.append(('NUM_SNPS', gwas_config['NUM_SNPS']))
-                pairs.append(('NUM_COVS', gwas_config['NUM_COVS']))
-                pairs.append(('NUM_CHUNKS', ' '.join([str(x) for x in gwas_config['NUM_CHUNKS']])))
-                pairs.append(('NUM_THREADS', gwas_config['NUM_THREADS']))
-                pairs.append(('NTL_NUM_THREADS', gwas_config['NTL_NUM_THREADS']))
-
-                # IP Addresses and Ports
-                if role == 0:
-                    pairs.append(('PORT_P0_P1', get_P0_P1_ports(num_S, gwas_config['NUM_THREADS'])))
-                    pairs.append(('PORT_P0_P2', get_P0_P2_ports(num_S, gwas_config['NUM_THREADS'])))
-                elif role == 1:
-                    pairs.append(('PORT_P0_P1', get_P0_P1_ports(num_S, gwas_config['NUM_THREADS'])))
-                    pairs.append(('PORT_P1_P2', get_P1_P2_ports(num_S, gwas_config['NUM_THREADS'])))
-                    pairs.append(('PORT_P1_P3', get_P1_P3_ports(num_S, gwas_config['NUM_THREADS'])))
-                    pairs.append(('IP_ADDR_P0', gwas_config['IP_ADDR_P0']))
-                elif role == 2:          
-                    pairs.append(('PORT_P0_P2', get_P0_P2_ports(num_S, gwas_config['NUM_THREADS'])))
-                    pairs.append(('PORT_P1_P2', get_P1_P2_ports(num_S, gwas_config['NUM_THREADS'])))
-                    pairs.append(('PORT_P2_P3', get_P2_P3_ports(num_S, gwas_config['NUM_THREADS'])))
-                    pairs.append(('IP_ADDR_P0', gwas_config['IP_ADDR_P0']))
-                    pairs.append(('IP_ADDR_P1', gwas_config['IP_ADDR_P1']))
-                elif role == 3:
-                    pairs.append(('PORT_P1_P2', get_P1_P2_ports(num_S, gwas_config['NUM_THREADS'])))
-                    pairs.append(('PORT_P2_P3', get_P2_P3_ports(num_S, gwas_config['NUM_THREADS'])))
-                    pairs.append(('IP_ADDR_P1', gwas_config['IP_ADDR_P1']))
-                    pairs.append(('IP_ADDR_P2', gwas_config['IP_ADDR_P2']))
-
-                # Filenames
-                if role < 3:
-                    pairs.append(('SNP_POS_FILE', '../gwas_data/pos.txt'))
-                    pairs.append(('CACHE_FILE_PREFIX', get_cache_file_prefixes(num_S, role)))
-
-                # we then execute shell commands on the compute instance to edit the parameter file
-                execute_shell_script_on_instance(project, instance, gen_command(pairs, role))
-
-            # now create the VPC peering connections between communicating instances
-            # this allows instances in distinct projects/networks to communicate freely with each other
-            peer_gcp_projects = set([])
-            for role in roles:
-                if role == 0:
-                    peer_gcp_projects.add(gwas_config['PROJ1'])
-                    peer_gcp_projects.add(gwas_config['PROJ2'])
-                elif role == 1:
-                    peer_gcp_projects.add(gwas_config['PROJ0'])
-                    peer_gcp_projects.add(gwas_config['PROJ2'])
-                    for proj in gwas_config['PROJ3']:
-                        peer_gcp_projects.add(proj)
-                elif role == 2:
-                    peer_gcp_projects.add(gwas_config['PROJ0'])
-                    peer_gcp_projects.add(gwas_config['PROJ1'])
-                    for proj in gwas_config['PROJ3']:
-                        peer_gcp_projects.add(proj)
-                else:
-                    peer_gcp_projects.add(gwas_config['PROJ0'])
-                    peer_gcp_projects.add(gwas_config['PROJ2'])
-
-            # remove your own project, since networks shouldn't peer with themselves
-            if project in peer_gcp_projects:
-                peer_gcp_projects.remove(project)
-
-            # remove all projects that have already been peered to
-            network_info = compute.networks().get(project=project, network=default_network_name(project)).execute()
-            if 'peerings' in network_info:
-                for peering in network_info['peerings']:
-                    project_name = peering['name'].replace('peering-', '')
-                    if project_name in peer_gcp_projects:
-                        peer_gcp_projects.remove(project_name)
-
-            print(peer_gcp_projects)
-            
-            for other_proj in peer_gcp_projects:
-                body = {
-                    'networkPeering': {
-                        'name': 'peering-{}'.format(other_proj),
-                        'network': 'https://www.googleapis.com/compute/v1/projects/{}/global/networks/{}'.format(other_proj, default_network_name(other_proj)),
-                        'exchangeSubnetRoutes': True
-                    }
-                }
-                compute.networks().addPeering(project=project, network=default_network_name(project), body=body).execute()
-                time.sleep(20) # need delay between successive operations
-            
-            return redirect(url_for('upload_pos', project=project, zone=zone, instance=instance))
 
-        flash(error)
+            # only save on top of the version the form was rendered from, in case another request changed it meanwhile
+            try:
+                save_gwas_config(project, instance, gwas_config, expected_version=version)
+            except ConfigConflictError:
+                flash('The config was changed by another request while saving, please review it and try again')
+                return redirect(url_for('customize_config', project=project, zone=zone, instance=instance))
+
+            next_url = url_for('upload_pos', project=project, zone=zone, instance=instance)
+            job_id = submit_job('customize_config', apply_gwas_config, project, instance, gwas_config, next_url=next_url)
+            return redirect(url_for('job_page', job_id=job_id))
 
-    return render_template('customize_config.html', config=gwas_config, num_inds=[str(x) for x in gwas_config['NUM_INDS']], 
+        for error in errors:
+            flash(error)
+
+    return render_template('customize_config.html', config=gwas_config, version=version, num_inds=[str(x) for x in gwas_config['NUM_INDS']],
                             num_chunks=[str(x) for x in gwas_config['NUM_CHUNKS']])
 
 
+# Reindex an S's genotypes on its instance to the merged positions, and make its parameter files match them
+def reindex_genotypes(project, instance, map_fname, num_snps):
+    report_progress('Reindexing geno.txt on {} to {} merged positions'.format(instance, num_snps))
+    reindex_geno_file_on_instance(project, instance, map_fname, num_snps, '~/secure-gwas/gwas_data/')
+    gwas_config = get_gwas_config(project, instance)
+    if gwas_config['NUM_SNPS'] != num_snps:
+        gwas_config['NUM_SNPS'] = num_snps
+        save_gwas_config(project, instance, gwas_config)
+        update_param_files(project, instance, gwas_config)
+    report_progress('Reindexed geno.txt on {}'.format(instance))
+
+
 # This endpoint allows CPs to upload the pos.txt file that they need to run GWAS to their compute instnace
 # They should receive this pos.txt file from SP, although the logic for this is left outside of the codebase
+# When the S parties have different positions, the CP gives all of their pos.txt files, which are merged, and every S
+# then gives the column map and number of merged positions it received from the CP, to reindex its genotypes
 @app.route('/pos/<string:project>/<string:zone>/<string:instance>', methods=['GET', 'POST'])
 def upload_pos(project, zone, instance):
     gwas_config = get_gwas_config(project, instance)
@@ -466,29 +572,74 @@ def upload_pos(project, zone, instance):
 
     if request.method == 'POST':
         if is_S:
-            return redirect(url_for('start_gwas', project=project, zone=zone, instance=instance))
+            map_fname = request.form.get('map_fname', '').strip()
+            if not map_fname:
+                return redirect(url_for('start_gwas', project=project, zone=zone, instance=instance))
+
+            try:
+                num_snps = int(request.form.get('num_snps', ''))
+            except ValueError:
+                num_snps = 0
+            if not os.path.isfile(map_fname):
+                flash('Please give the absolute path of a column map that exists on your local machine ({} does not).'.format(map_fname))
+            elif num_snps < 1:
+                flash('Please give the number of merged positions you received along with the column map.')
+            else:
+                next_url = url_for('start_gwas', project=project, zone=zone, instance=instance)
+                job_id = submit_job('reindex_genotypes', reindex_genotypes, project, instance, map_fname, num_snps,
+                                    next_url=next_url)
+                return redirect(url_for('job_page', job_id=job_id))
+            return render_template('pos.html', is_S=is_S)
 
         else:
-            fname = request.form['fname']
+            # CPs may give the pos.txt files of several S parties, whose positions are then merged
+            fnames = request.form['fname'].split()
+            mode = request.form.get('mode', MERGE_UNION)
             error = None
 
-            if not fname:
+            if not fnames:
                 error = 'Please enter a file path before proceeding.'
 
-            if not fname.endswith('pos.txt'):
-                error = 'Please give full path to the pos.txt file, not just a path to its directory.'
-
-            elif fname.startswith('~'):
-                error = 'Please give absolute path to the pos.txt file, not a relative path.'
-
-            elif not os.path.isfile(fname):
-                error = 'Please give an absolute path to a file that exists on your local machine.'
+            for fname in fnames:
+                if not fname.endswith('pos.txt'):
+                    error = 'Please give full paths to the pos.txt files, not just paths to their directories.'
+
+                elif fname.startswith('~'):
+                    error = 'Please give absolute paths to the pos.txt files, not relative paths.'
+
+                elif not os.path.isfile(fname):
+                    error = 'Please give absolute paths to files that exist on your local machine ({} does not).'.format(fname)
+
+            if error is None and len(fnames) == 1:
+                num_snps = count_lines(fnames[0])
+                transfer_file_to_instance(project, instance, fnames[0], '~/secure-gwas/gwas_data/pos.txt', delete_after=False)
+
+            elif error is None:
+                # merge the positions of every dataset, and write the map from each dataset's columns to the merged
+                # columns, which the S that provided the dataset needs to reindex its genotypes
+                workdir = tempfile.mkdtemp(prefix='gwas-pos-')
+                try:
+                    merged_fname = os.path.join(workdir, 'pos.txt')
+                    map_fnames = ['{}-pos-map-{}.txt'.format(instance, i) for i in range(len(fnames))]
+                    num_snps = merge_pos_files(fnames, merged_fname, map_fnames, mode)
+                    transfer_file_to_instance(project, instance, merged_fname, '~/secure-gwas/gwas_data/pos.txt', delete_after=False)
+                except ValueError as e:
+                    error = str(e)
+                finally:
+                    shutil.rmtree(workdir)
+
+                if error is None:
+                    for fname, map_fname in zip(fnames, map_fnames):
+                        flash('Share {} and the number of merged positions ({}) with the S that provided {}, who gives '
+                              'both on its pos.txt page to reindex its genotypes'.format(os.path.abspath(map_fname), num_snps, fname))
 
             if error is None:
-                # To Do: should probably take union of all inputted pos.txt files across datasets/SPs here
-                # for now, we assume all SPs use the same set of genotypes, so all pos.txt files are identical
-                transfer_file_to_instance(project, instance, fname, '~/secure-gwas/gwas_data/pos.txt', delete_after=False)
-                
+                # the parameter files need to match the number of positions
+                if gwas_config['NUM_SNPS'] != num_snps:
+                    gwas_config['NUM_SNPS'] = num_snps
+                    save_gwas_config(project, instance, gwas_config)
+                    update_param_files(project, instance, gwas_config)
+
                 return redirect(url_for('start_gwas', project=project, zone=zone, instance=instance))
 
         flash(error)
@@ -497,93 +648,159 @@ def upload_pos(project, zone, instance):
 
 
 # This endpoint is the entry point for users to actually begin running the GWAS protocol
+# The Data Sharing Protocol is launched as a detached run on the instance, unless one is still running there already
 @app.route('/start/<string:project>/<string:zone>/<string:instance>', methods=['GET', 'POST'])
 def start_gwas(project, zone, instance):
     if request.method == 'POST':
-        return redirect(url_for('gwas_output', project=project, zone=zone, instance=instance))
-
-    return render_template('start.html')
+        rounds, concurrency = data_sharing_rounds(project, instance, get_gwas_config(project, instance))
+        run_id = ensure_run(project, instance, RUN_DATA_SHARING, rounds, concurrency, ROUND_MAX_RETRIES)
+        return redirect(url_for('gwas_output', project=project, zone=zone, instance=instance, run=run_id))
 
+    return render_template('start.html', runs=list_runs(project, instance, RUN_DATA_SHARING))
 
-# This endpoint takes care of the logic for running the Data Sharing Protocol on cloud instances
-@app.route('/gwas/<string:project>/<string:zone>/<string:instance>', methods=['GET', 'POST'])
-def gwas_output(project, zone, instance):
-    if request.method == 'POST':
-        return redirect(url_for('gwas_output2', project=project, zone=zone, instance=instance))
 
-    gwas_config = get_gwas_config(project, instance)
+# Generate the commands that run the Data Sharing Protocol for every role and round this user is enacting, as a list of
+# (tag, commands) pairs where the tag names the role and round
+def data_sharing_commands(gwas_config):
     all_cmds = []
 
     if gwas_config['S_ROLE'] is not None:
-        all_cmds.append([
+        all_cmds.append(('S{}'.format(gwas_config['S_ROLE']), [
             'cd ~/secure-gwas/code',
-            'bin/DataSharingClient 3 ../par/test.par.3.txt {} ../gwas_data'.format(gwas_config['S_ROLE']),
-            'echo completed'
-        ])
+            'bin/DataSharingClient 3 ../par/test.par.3.txt {} ../gwas_data && echo completed'.format(gwas_config['S_ROLE'])
+        ]))
     if gwas_config['CP_ROLE']is not None:
         for i in range(gwas_config['NUM_S']):
-            all_cmds.append([
+            all_cmds.append(('CP{} round {}'.format(gwas_config['CP_ROLE'], i), [
                 'cd ~/secure-gwas/code',
-                'bin/DataSharingClient {role} ../par/test.par.{role}.txt {round}'.format(role=gwas_config['CP_ROLE'], round=i),
-                'echo completed'
-            ])
-
-    # function for executing commands on the remote machine asynchronously and writing the standard out to the UI
-    def run_cmds():
-        procs = []
-        for cmd in all_cmds:
-            procs.append(execute_shell_script_asynchronous(project, instance, cmd))
-        
-        # stream the stdout output for just the first process to the webpage in real time
-        for line in iter(procs[0].stdout.readline, ''):
-            line_formatted = line.decode('utf-8').rstrip()
-            if line_formatted == 'completed':
-                break
-            if len(line_formatted) > 0:
-                yield line_formatted + '<br>\n'
-                print(line_formatted)
-
-        # kill the spawned processes
-        for proc in procs:
-            proc.terminate()
-            # kill_asynchronous_process(proc.pid)
-
-        yield '<form method="post"><input type="submit" value="Next" /></form>'
-
-    return Response(run_cmds(), mimetype='text/html')
-
-
-# This endpoint takes care of the logic for running the GWAS Protocol on cloud instances
-@app.route('/gwas2/<string:project>/<string:zone>/<string:instance>', methods=['GET', 'POST'])
+                'bin/DataSharingClient {role} ../par/test.par.{role}.txt {round} && echo completed'.format(role=gwas_config['CP_ROLE'], round=i)
+            ]))
+
+    return all_cmds
+
+
+# The rounds of the Data Sharing Protocol, and how many of them may run at once
+# The S round starts right away, while the CP rounds run in order with a bounded number at once (NUM_PARALLEL_ROUNDS,
+# or as many as the instance's vCPUs allow given NUM_THREADS), and failed rounds are retried
+def data_sharing_rounds(project, instance, gwas_config):
+    rounds = [ProtocolRound(tag, cmds, limited=not tag.startswith('S')) for tag, cmds in data_sharing_commands(gwas_config)]
+
+    concurrency = gwas_config['NUM_PARALLEL_ROUNDS']
+    if concurrency is None:
+        num_vcpus = get_instance_vcpus(project, instance)
+        concurrency = round_concurrency(num_vcpus, gwas_config['NUM_THREADS']) if num_vcpus else len(rounds)
+    print('Running up to {} data sharing rounds at once'.format(concurrency))
+    return rounds, concurrency
+
+
+# Launch a detached run of the given kind on the instance and return its ID, or return the ID of the latest run of
+# that kind if it is still running, so that submitting a form twice never starts the protocol twice
+def ensure_run(project, instance, kind, rounds, concurrency, max_retries):
+    run = latest_run(project, instance, kind)
+    if run is not None and run['status'] == RUN_RUNNING and run_alive(run):
+        return run['id']
+    return launch_run(project, instance, kind, rounds, concurrency, max_retries)
+
+
+# Render the page following a run, which is either the one given in the query string or the latest one of its kind
+def render_run_page(project, instance, kind, title, next_url=None):
+    run = get_run(request.args['run']) if 'run' in request.args else latest_run(project, instance, kind)
+    if run is None or run['project'] != project or run['instance'] != instance:
+        return None
+    return render_template('gwas_output.html', title=title, run=run, runs=list_runs(project, instance, kind),
+                           events_url=url_for('run_events', run_id=run['id']),
+                           stop_url=url_for('stop_protocol_run', run_id=run['id']), next_url=next_url)
+
+
+# This endpoint follows the run of the Data Sharing Protocol on cloud instances, and moves on to the GWAS protocol
+# The page itself only displays the output, which is streamed from run_events
+@app.route('/gwas/<string:project>/<string:zone>/<string:instance>', methods=['GET', 'POST'])
+def gwas_output(project, zone, instance):
+    gwas_config = get_gwas_config(project, instance)
+    if request.method == 'POST':
+        if gwas_config['CP_ROLE'] is not None:
+            rounds = [ProtocolRound('CP{} GWAS'.format(gwas_config['CP_ROLE']), [
+                'cd ~/secure-gwas/code',
+                'bin/GwasClient {role} ../par/test.par.{role}.txt && echo completed'.format(role=gwas_config['CP_ROLE'])
+            ], limited=False)]
+            # a failed GWAS run takes hours to get to, so it is not retried automatically
+            ensure_run(project, instance, RUN_GWAS, rounds, 1, 0)
+        return redirect(url_for('gwas_output2', project=project, zone=zone, instance=instance))
+
+    page = render_run_page(project, instance, RUN_DATA_SHARING, 'Data Sharing Protocol',
+                           next_url=url_for('gwas_output', project=project, zone=zone, instance=instance))
+    if page is None:
+        return redirect(url_for('start_gwas', project=project, zone=zone, instance=instance))
+    return page
+
+
+# This endpoint follows the run of the GWAS Protocol on cloud instances
+@app.route('/gwas2/<string:project>/<string:zone>/<string:instance>', methods=['GET'])
 def gwas_output2(project, zone, instance):
     gwas_config = get_gwas_config(project, instance)
-    if gwas_config['CP_ROLE'] is not None: 
-        # create the commands to run the GWAS protocol
-        cmds = [
-            'cd ~/secure-gwas/code',
-            'bin/GwasClient {role} ../par/test.par.{role}.txt'.format(role=gwas_config['CP_ROLE']),
-            'echo completed'
-        ]
-        
-        # execute the commands on the remote machine asynchronously and write standard out to the UI
-        def run_cmds():
-            proc = execute_shell_script_asynchronous(project, instance, cmds)
-            
-            # stream the stdout output to the webpage in real time
-            for line in iter(proc.stdout.readline, ''):
-                line_formatted = line.decode('utf-8').rstrip()
-                if line_formatted == 'completed':
-                    yield '<h>Completed GWAS Protocol Successfully!</h>'
-                    break
-                if len(line_formatted) > 0:
-                    yield line_formatted + '<br>\n'
-                    print('{}: {}'.format(gwas_config['CP_ROLE'], line_formatted))
-                    
-        return Response(run_cmds(), mimetype='text/html')
-
-    else:
+    if gwas_config['CP_ROLE'] is None:
         return '<h>Completed Data Sharing Protocol Successfully!</h>'
 
+    page = render_run_page(project, instance, RUN_GWAS, 'GWAS Protocol')
+    if page is None:
+        return redirect(url_for('gwas_output', project=project, zone=zone, instance=instance))
+    return page
+
+
+# Byte offset of a run's event log given by a client, falling back to the start of the log for anything malformed
+def parse_event_offset(value):
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return 0
+
+
+# This endpoint streams the events of a run to the browser as server-sent events, from its event log on the instance
+# Every event's ID is the byte offset in the log just after it, so a browser that reconnects (e.g. after a network
+# hiccup or a web server restart) resumes right where it left off, and a new visitor can replay the run from the start
+@app.route('/runs/<string:run_id>/events', methods=['GET'])
+def run_events(run_id):
+    run = get_run(run_id)
+    if run is None:
+        abort(404)
+    offset = parse_event_offset(request.headers.get('Last-Event-ID') or request.args.get('offset'))
+
+    def stream():
+        for event_offset, event in follow_run(run, offset):
+            yield sse_event(event['event'], event, event_offset)
+
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+# This endpoint stops a run, along with every client process it started on the instance
+@app.route('/runs/<string:run_id>/stop', methods=['POST'])
+def stop_protocol_run(run_id):
+    run = get_run(run_id)
+    if run is None:
+        abort(404)
+    stop_run(run)
+    return redirect(request.referrer or url_for('choose_project'))
+
+
+# Page shown while a background job runs, which polls the job status and moves on to the next page once it is done
+@app.route('/job/<string:job_id>', methods=['GET'])
+def job_page(job_id):
+    job = get_job(job_id)
+    if job is None:
+        abort(404)
+
+    return render_template('job.html', job=job, next_url=job['next_url'])
+
+
+# Endpoint polled by the job pages for the current status and progress of a background job
+@app.route('/job/<string:job_id>/status', methods=['GET'])
+def job_status_json(job_id):
+    job = get_job(job_id)
+    if job is None:
+        abort(404)
+
+    return jsonify(job)
+
 
 if __name__ == '__main__':
     app.run(host='127.0.0.1', port=8080)
@@ -0,0 +1,73 @@
+import random
+import time
+
+
+# This file contains helpers for waiting on long running Compute Engine operations
+# Calls such as networks().insert or instances().insert return an operation resource right away; instead of sleeping
+# for a fixed amount of time, we poll that operation with capped exponential backoff until it is DONE
+
+
+# Default backoff settings (in seconds) used while polling an operation
+OPERATION_INITIAL_DELAY = 0.5
+OPERATION_MAX_DELAY = 10.0
+OPERATION_TIMEOUT = 600.0
+
+
+# Raised when an operation finishes with errors, or does not finish before the timeout
+class OperationError(Exception):
+    def __init__(self, operation, message):
+        super().__init__(message)
+        self.operation = operation
+
+
+# Extract the last path component of a resource URL, e.g. the zone name from a zone URL
+def resource_name(url):
+    return url.rstrip('/').split('/')[-1]
+
+
+# Build the request that fetches the current state of an operation, based on whether it is a zonal, regional or
+# global operation
+def get_operation_request(compute, project, operation):
+    if operation.get('zone'):
+        return compute.zoneOperations().get(project=project, zone=resource_name(operation['zone']),
+                                            operation=operation['name'])
+    if operation.get('region'):
+        return compute.regionOperations().get(project=project, region=resource_name(operation['region']),
+                                              operation=operation['name'])
+    return compute.globalOperations().get(project=project, operation=operation['name'])
+
+
+# Sequence of delays between polls: exponential growth capped at max_delay, with full jitter
+def backoff_delays(initial_delay=OPERATION_INITIAL_DELAY, max_delay=OPERATION_MAX_DELAY):
+    delay = initial_delay
+    while True:
+        yield random.uniform(0, delay)
+        delay = min(max_delay, delay * 2)
+
+
+# Wait until the given operation is DONE and return its final state
+# Raises OperationError if the operation reports errors or is still running after timeout seconds
+# sleep and clock can be replaced, e.g. when testing against a fake compute client
+# http is the http object to poll with, which threads polling concurrently need their own of
+def wait_for_operation(compute, project, operation, timeout=OPERATION_TIMEOUT, initial_delay=OPERATION_INITIAL_DELAY,
+                       max_delay=OPERATION_MAX_DELAY, sleep=time.sleep, clock=time.monotonic, http=None):
+    deadline = clock() + timeout
+    delays = backoff_delays(initial_delay, max_delay)
+    while operation.get('status') != 'DONE':
+        remaining = deadline - clock()
+        if remaining <= 0:
+            raise OperationError(operation, 'Timed out waiting for operation {} ({})'.format(
+                operation['name'], operation.get('operationType', 'unknown')))
+        sleep(min(next(delays), remaining))
+        operation = get_operation_request(compute, project, operation).execute(http=http)
+
+    if 'error' in operation:
+        messages = [e.get('message', e.get('code', '')) for e in operation['error'].get('errors', [])]
+        raise OperationError(operation, 'Operation {} ({}) failed: {}'.format(
+            operation['name'], operation.get('operationType', 'unknown'), '; '.join(messages)))
+    return operation
+
+
+# Execute a request that returns an operation (e.g. compute.networks().insert(...)) and wait for the operation to finish
+def execute_and_wait(compute, project, request, http=None, **kwargs):
+    return wait_for_operation(compute, project, request.execute(http=http), http=http, **kwargs)
@@ -0,0 +1,156 @@
+import base64
+import difflib
+
+from remote import get_remote_backend
+
+
+# This file contains the logic for rendering the secure-gwas parameter files (test.par.{role}.txt) from a GWAS config
+# The files on the instance are read once, rendered locally, diffed, and only the files that changed are written
+# back, each with an atomic rename, all in a single remote command
+
+
+PAR_FILE = '~/secure-gwas/par/test.par.{role}.txt'
+
+# Simple helper functions to generate a series of non-overlapping port numbers used for inter-party GWAS communication
+# Since every dataset needs at least 5 ports (corresponding to the 5 channels CP0-CP1, CP0-CP2, CP1-CP2, CP1-SP, CP2-SP),
+# and since the GWAS code uses different ports for communication between different threads, we need to space out the ports
+# for 2 consecutive datasets by at at least 5 * num_threads
+def get_P0_P1_ports(num_S, num_threads):
+    return ' '.join([str(8000 + 5 * num_threads * i) for i in range(num_S)])
+def get_P0_P2_ports(num_S, num_threads):
+    return ' '.join([str(8001 + 5 * num_threads * i) for i in range(num_S)])
+def get_P1_P2_ports(num_S, num_threads):
+    return ' '.join([str(8002 + 5 * num_threads * i) for i in range(num_S)])
+def get_P1_P3_ports(num_S, num_threads):
+    return ' '.join([str(8003 + 5 * num_threads * i) for i in range(num_S)])
+def get_P2_P3_ports(num_S, num_threads):
+    return ' '.join([str(8004 + 5 * num_threads * i) for i in range(num_S)])
+
+# Simple helper function to generate a series of cache file prefixes corresponding to the different GWAS datasets
+# These cache file prefixes are used to locate the directory where all GWAS secret-shared and intermediate data is written
+def get_cache_file_prefixes(num_S, role):
+    return ' '.join(['../cache/data{}_P{}'.format(i, role) for i in range(num_S)])
+
+
+# Machine IDs (0-2 for CP0-CP2, 3 for S) of all the roles this user is enacting
+def get_gwas_roles(gwas_config):
+    roles = []
+    if gwas_config['CP_ROLE'] is not None:
+        roles.append(gwas_config['CP_ROLE'])
+    if gwas_config['S_ROLE'] is not None:
+        roles.append(3)
+    return roles
+
+
+# Generate the list of parameter key-value pairs that the given role's parameter file needs from the GWAS config
+def param_pairs(gwas_config, role):
+    num_S = gwas_config['NUM_S']
+    pairs = []
+
+    # GWAS Parameters
+    pairs.append(('NUM_INDS', gwas_config['NUM_INDS']))
+    pairs.append(('NUM_SNPS', gwas_config['NUM_SNPS']))
+    pairs.append(('NUM_COVS', gwas_config['NUM_COVS']))
+    pairs.append(('NUM_CHUNKS', gwas_config['NUM_CHUNKS']))
+    pairs.append(('NUM_THREADS', gwas_config['NUM_THREADS']))
+    pairs.append(('NTL_NUM_THREADS', gwas_config['NTL_NUM_THREADS']))
+
+    # IP Addresses and Ports
+    if role == 0:
+        pairs.append(('PORT_P0_P1', get_P0_P1_ports(num_S, gwas_config['NUM_THREADS'])))
+        pairs.append(('PORT_P0_P2', get_P0_P2_ports(num_S, gwas_config['NUM_THREADS'])))
+    elif role == 1:
+        pairs.append(('PORT_P0_P1', get_P0_P1_ports(num_S, gwas_config['NUM_THREADS'])))
+        pairs.append(('PORT_P1_P2', get_P1_P2_ports(num_S, gwas_config['NUM_THREADS'])))
+        pairs.append(('PORT_P1_P3', get_P1_P3_ports(num_S, gwas_config['NUM_THREADS'])))
+        pairs.append(('IP_ADDR_P0', gwas_config['IP_ADDR_P0']))
+    elif role == 2:
+        pairs.append(('PORT_P0_P2', get_P0_P2_ports(num_S, gwas_config['NUM_THREADS'])))
+        pairs.append(('PORT_P1_P2', get_P1_P2_ports(num_S, gwas_config['NUM_THREADS'])))
+        pairs.append(('PORT_P2_P3', get_P2_P3_ports(num_S, gwas_config['NUM_THREADS'])))
+        pairs.append(('IP_ADDR_P0', gwas_config['IP_ADDR_P0']))
+        pairs.append(('IP_ADDR_P1', gwas_config['IP_ADDR_P1']))
+    elif role == 3:
+        pairs.append(('PORT_P1_P2', get_P1_P2_ports(num_S, gwas_config['NUM_THREADS'])))
+        pairs.append(('PORT_P2_P3', get_P2_P3_ports(num_S, gwas_config['NUM_THREADS'])))
+        pairs.append(('IP_ADDR_P1', gwas_config['IP_ADDR_P1']))
+        pairs.append(('IP_ADDR_P2', gwas_config['IP_ADDR_P2']))
+
+    # Filenames
+    if role < 3:
+        pairs.append(('SNP_POS_FILE', '../gwas_data/pos.txt'))
+        pairs.append(('CACHE_FILE_PREFIX', get_cache_file_prefixes(num_S, role)))
+
+    return pairs
+
+
+# Format a config value the way the parameter files expect it: lists are separated by spaces and None is left empty
+def format_param_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, (list, tuple)):
+        return ' '.join(str(x) for x in value)
+    return str(value)
+
+
+# Render a parameter file by replacing the line of every key in pairs with its new value, keeping all other lines
+# (comments, parameters not managed by the UI) as they are; keys that are missing from the file are appended
+def render_param_file(text, pairs):
+    values = dict((k, format_param_value(v)) for k, v in pairs)
+    lines = []
+    seen = set()
+    for line in text.splitlines():
+        tokens = line.split(None, 1)
+        if tokens and tokens[0] in values:
+            lines.append('{} {}'.format(tokens[0], values[tokens[0]]).rstrip())
+            seen.add(tokens[0])
+        else:
+            lines.append(line)
+    for k, v in pairs:
+        if k not in seen:
+            lines.append('{} {}'.format(k, values[k]).rstrip())
+            seen.add(k)
+    return '\n'.join(lines) + '\n'
+
+
+# Read the parameter files of the given roles from the instance in one command, returning a dictionary from role to
+# file contents (empty if the file doesn't exist)
+def read_remote_param_files(backend, project, instance, roles):
+    cmds = ['(base64 -w0 {} 2>/dev/null; echo)'.format(PAR_FILE.format(role=role)) for role in roles]
+    lines = backend.check_output(project, instance, '; '.join(cmds)).split('\n')
+    return dict((role, base64.b64decode(lines[i]).decode('utf-8') if i < len(lines) else '') for i, role in enumerate(roles))
+
+
+# Write the given files (a dictionary from role to file contents) to the instance in one command
+# Every file is written to a temporary file first and then renamed over the old one, so it is never left half written
+def write_remote_param_files(backend, project, instance, files):
+    cmds = []
+    for role, text in files.items():
+        fname = PAR_FILE.format(role=role)
+        encoded = base64.b64encode(text.encode('utf-8')).decode('ascii')
+        cmds.append('echo {} | base64 -d > {f}.tmp && mv {f}.tmp {f}'.format(encoded, f=fname))
+    return backend.run(project, instance, ' && '.join(cmds))
+
+
+# Bring the parameter files on the instance up to date with the GWAS config
+# Returns a dictionary from role to the unified diff of every file that changed; unchanged files are not written
+def update_param_files(project, instance, gwas_config, backend=None):
+    if backend is None:
+        backend = get_remote_backend()
+    roles = get_gwas_roles(gwas_config)
+    if not roles:
+        return {}
+
+    current = read_remote_param_files(backend, project, instance, roles)
+    changed = {}
+    diffs = {}
+    for role in roles:
+        rendered = render_param_file(current[role], param_pairs(gwas_config, role))
+        if rendered != current[role]:
+            changed[role] = rendered
+            diffs[role] = list(difflib.unified_diff(current[role].splitlines(), rendered.splitlines(),
+                                                    PAR_FILE.format(role=role), PAR_FILE.format(role=role), lineterm=''))
+
+    if changed and write_remote_param_files(backend, project, instance, changed) != 0:
+        raise RuntimeError('Failed to write parameter files for roles {} on {}'.format(sorted(changed), instance))
+    return diffs
@@ -0,0 +1,137 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from googleapiclient.errors import HttpError
+
+from operations import OperationError, backoff_delays, execute_and_wait, resource_name
+
+
+# This file contains the reconciler that sets up the VPC peerings between this user's network and the networks of the
+# other parties in the study
+# The desired set of peerings is worked out from the config, compared against the peerings that already exist on the
+# network (by the network they point at, not by their name), and only the missing ones are added, so running it again
+# does nothing; additions are issued concurrently, and any that the API turns away, or whose operation fails, because
+# another peering operation is still running on one of the networks are retried with backoff
+
+
+# Number of addPeering calls in flight at once
+PEERING_WORKERS = 4
+
+# Seconds an addPeering call keeps being retried for before giving up, long enough for the other peerings of the
+# network to finish one after another
+PEERING_RETRY_TIMEOUT = 600.0
+
+# Backoff settings (in seconds) between attempts of an addPeering call that was turned away
+PEERING_INITIAL_DELAY = 1.0
+PEERING_MAX_DELAY = 15.0
+
+# Projects whose networks each role has to communicate with
+ROLE_PEERS = {
+    0: ['PROJ1', 'PROJ2'],
+    1: ['PROJ0', 'PROJ2', 'PROJ3'],
+    2: ['PROJ0', 'PROJ1', 'PROJ3'],
+    3: ['PROJ0', 'PROJ2']
+}
+
+
+def network_url(project, network):
+    return 'https://www.googleapis.com/compute/v1/projects/{}/global/networks/{}'.format(project, network)
+
+
+# Projects whose networks need to be peered with the network of project, given the roles it is enacting
+def desired_peer_projects(gwas_config, roles, project):
+    peers = set()
+    for role in roles:
+        for key in ROLE_PEERS[role]:
+            value = gwas_config[key]
+            peers.update(value if isinstance(value, list) else [value])
+    # networks shouldn't peer with themselves
+    peers.discard(project)
+    peers.discard('')
+    return peers
+
+
+# Dictionary from the project of every network that project's network is peered with, to the peering
+# http is the http object to make the request with, which threads need their own of
+def existing_peerings(compute, project, network, http=None):
+    network_info = compute.networks().get(project=project, network=network).execute(http=http)
+    peerings = {}
+    for peering in network_info.get('peerings', []):
+        # the peer network URL looks like .../projects/{project}/global/networks/{network}
+        parts = peering['network'].split('/')
+        peer_project = parts[parts.index('projects') + 1] if 'projects' in parts else resource_name(peering['network'])
+        peerings[peer_project] = peering
+    return peerings
+
+
+# Whether a failed addPeering call is worth retrying, e.g. because another peering operation was still running on one
+# of the two networks, or because of rate limiting
+def is_retryable(error):
+    status = error.resp.status
+    if status in (409, 429) or status >= 500:
+        return True
+    content = error.content.decode('utf-8', 'replace') if isinstance(error.content, bytes) else str(error.content)
+    return status == 400 and 'in progress' in content.lower()
+
+
+def add_peering(compute, project, network, peer_project, peer_network, http_factory=None, sleep=time.sleep,
+                clock=time.monotonic):
+    body = {
+        'networkPeering': {
+            'name': 'peering-{}'.format(peer_project),
+            'network': network_url(peer_project, peer_network),
+            'exchangeSubnetRoutes': True
+        }
+    }
+    deadline = clock() + PEERING_RETRY_TIMEOUT
+    delays = backoff_delays(PEERING_INITIAL_DELAY, PEERING_MAX_DELAY)
+    http = http_factory() if http_factory is not None else None
+    operation_failed = False
+    while True:
+        try:
+            request = compute.networks().addPeering(project=project, network=network, body=body)
+            return execute_and_wait(compute, project, request, http=http)
+        except HttpError as e:
+            # an operation that timed out can still have added the peering before the retry
+            if operation_failed and peer_project in existing_peerings(compute, project, network, http):
+                return None
+            if clock() >= deadline or not is_retryable(e):
+                raise
+            print('Peering with {} was turned away ({}), retrying'.format(peer_project, e.resp.status))
+        except OperationError as e:
+            # a peering that conflicts with another peering operation is often accepted, and only its operation fails
+            if clock() >= deadline:
+                raise
+            operation_failed = True
+            print('Peering with {} failed ({}), retrying'.format(peer_project, e))
+        sleep(next(delays))
+
+
+# Make sure the network of project is peered with the network of every project in peer_projects
+# network_name maps a project to the name of its network, and report is called with progress messages
+# Returns the projects that were newly peered with; peerings that exist but aren't needed are only reported, since they
+# may belong to another study
+def reconcile_peerings(compute, project, peer_projects, network_name, http_factory=None, report=print,
+                       num_workers=PEERING_WORKERS):
+    network = network_name(project)
+    existing = existing_peerings(compute, project, network)
+
+    to_add = sorted(set(peer_projects) - set(existing))
+    for peer_project in sorted(set(existing) - set(peer_projects)):
+        print('Leaving peering {} with {} in place'.format(existing[peer_project]['name'], peer_project))
+    if not to_add:
+        report('Network {} is already peered with {}'.format(network, sorted(peer_projects)))
+        return []
+
+    # report is only called from this thread, since it may rely on thread-local state (e.g. jobs.report_progress)
+    report('Peering network with {}'.format(to_add))
+
+    def add(peer_project):
+        print('Peering network with {}'.format(peer_project))
+        add_peering(compute, project, network, peer_project, network_name(peer_project), http_factory)
+        return peer_project
+
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+        added = list(executor.map(add, to_add))
+    report('Peered network {} with {}'.format(network, added))
+    return added
@@ -0,0 +1,194 @@
+import itertools
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+from binformat import write_int_matrix
+
+
+# This file contains the reconciliation of the pos.txt files of several S parties, whose datasets may cover different
+# sets of genomic positions
+# The sorted pos files are merged with a streaming k-way merge into either the union or the intersection of their
+# positions, so memory only holds a chunk of each file at a time, and for every dataset a column index map is written
+# alongside, giving for each of its geno.txt columns the column it moves to in the merged order (or -1 if dropped), so
+# that each S can reindex its geno matrix row by row (the UI ships this file and binformat.py to the S's instance and
+# runs the reindexing there):
+#   python3 posmerge.py merge union merged-pos.txt pos1.txt map1.txt [pos2.txt map2.txt ...]
+#   python3 posmerge.py reindex geno.txt map.txt NUM_MERGED_SNPS out-geno.txt
+# The output of reindex may be the input file itself, which is only replaced once the reindexed file is complete
+
+
+MERGE_UNION = 'union'
+MERGE_INTERSECTION = 'intersection'
+
+
+# Number of lines read from each pos file at a time
+POS_CHUNK_LINES = 1 << 20
+
+# Positions are packed into int64 keys ordered by chromosome, then position, then occurrence number
+POSITION_BITS = 40
+OCCURRENCE_BITS = 12
+
+
+def pack_keys(chroms, positions):
+    return (chroms << (POSITION_BITS + OCCURRENCE_BITS)) | (positions << OCCURRENCE_BITS)
+
+
+def unpack_keys(keys):
+    return keys >> (POSITION_BITS + OCCURRENCE_BITS), (keys >> OCCURRENCE_BITS) & ((1 << POSITION_BITS) - 1)
+
+
+# Reads the keys of a sorted pos file a chunk of lines at a time
+# Repeated positions (e.g. the rows of a split multi-allelic site) are told apart by their occurrence number, so the
+# k-th copy of a position in one file matches the k-th copy in another, and the keys of a file are strictly increasing
+class PosChunkReader:
+    def __init__(self, fname, chunk_lines=POS_CHUNK_LINES):
+        self.fname = fname
+        self.f = open(fname, 'rb')
+        self.chunk_lines = chunk_lines
+        self.done = False
+        self.previous = -1
+        self.previous_occurrence = 0
+
+    # Return the next chunk of keys, which is empty once the file has been read
+    def read(self):
+        data = b''.join(itertools.islice(self.f, self.chunk_lines))
+        if not data:
+            self.done = True
+            self.f.close()
+            return np.zeros(0, dtype=np.int64)
+        values = np.fromstring(data, dtype=np.int64, sep=' ')
+        if len(values) % 2 != 0:
+            raise ValueError('{} has a line without both a chromosome and a position'.format(self.fname))
+        base = pack_keys(values[0::2], values[1::2])
+        if base[0] < self.previous or np.any(base[1:] < base[:-1]):
+            raise ValueError('{} is not sorted by chromosome and position'.format(self.fname))
+
+        # number every position by how many times it has already appeared, carrying runs over from the last chunk
+        index = np.arange(len(base))
+        starts = np.ones(len(base), dtype=bool)
+        starts[1:] = base[1:] != base[:-1]
+        occurrence = index - np.maximum.accumulate(np.where(starts, index, 0))
+        if base[0] == self.previous:
+            occurrence[:np.argmax(starts[1:]) + 1 if starts[1:].any() else len(base)] += self.previous_occurrence + 1
+        if occurrence.max() >= 1 << OCCURRENCE_BITS:
+            raise ValueError('{} repeats a position too many times'.format(self.fname))
+
+        self.previous = base[-1]
+        self.previous_occurrence = occurrence[-1]
+        return base | occurrence
+
+    def close(self):
+        self.f.close()
+
+
+# Merge the sorted pos files into out_fname, keeping the union or the intersection of their positions, and write a
+# column index map for every pos file to the corresponding name in map_fnames
+# The files are merged a batch at a time: every batch holds all keys up to the smallest last key read from any file
+# that isn't finished yet, which no file can have any more keys below, so each batch can be merged with a stable sort
+# and at most one chunk per file is held in memory
+# Returns the number of positions in the merged file
+def merge_pos_files(fnames, out_fname, map_fnames, mode=MERGE_UNION, chunk_lines=POS_CHUNK_LINES):
+    if mode not in (MERGE_UNION, MERGE_INTERSECTION):
+        raise ValueError('Unknown merge mode {}'.format(mode))
+
+    readers = [PosChunkReader(fname, chunk_lines) for fname in fnames]
+    buffers = [np.zeros(0, dtype=np.int64) for _ in fnames]
+    map_files = [open(map_fname, 'w') for map_fname in map_fnames]
+    num_merged = 0
+    try:
+        with open(out_fname, 'w') as out_f:
+            while True:
+                for i, reader in enumerate(readers):
+                    if len(buffers[i]) == 0 and not reader.done:
+                        buffers[i] = reader.read()
+                unfinished = [buffers[i][-1] for i, reader in enumerate(readers) if not reader.done]
+                if not any(len(buffer) for buffer in buffers):
+                    break
+                frontier = min(unfinished) if unfinished else None
+
+                # take every key up to the frontier from each file
+                batch_keys = []
+                batch_datasets = []
+                for i, buffer in enumerate(buffers):
+                    n = len(buffer) if frontier is None else np.searchsorted(buffer, frontier, side='right')
+                    batch_keys.append(buffer[:n])
+                    batch_datasets.append(np.full(n, i, dtype=np.int32))
+                    buffers[i] = buffer[n:]
+                keys = np.concatenate(batch_keys)
+                datasets = np.concatenate(batch_datasets)
+                order = np.argsort(keys, kind='stable')
+                keys = keys[order]
+                datasets = datasets[order]
+
+                # group equal keys, and give every kept group the next column of the merged order
+                group_starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+                group_sizes = np.diff(np.r_[group_starts, len(keys)])
+                group_keys = keys[group_starts]
+                if mode == MERGE_INTERSECTION:
+                    kept = group_sizes == len(fnames)
+                else:
+                    kept = np.ones(len(group_keys), dtype=bool)
+                columns = np.where(kept, num_merged + np.cumsum(kept) - 1, -1)
+                num_merged += int(kept.sum())
+
+                chroms, positions = unpack_keys(group_keys[kept])
+                out_f.write(''.join('{} {}\n'.format(c, p) for c, p in zip(chroms.tolist(), positions.tolist())))
+
+                # each dataset's keys stay in order within the batch, so its map is written sequentially
+                entry_columns = np.repeat(columns, group_sizes)
+                for i, map_f in enumerate(map_files):
+                    dataset_columns = entry_columns[datasets == i]
+                    if len(dataset_columns):
+                        map_f.write('\n'.join(map(str, dataset_columns.tolist())) + '\n')
+    finally:
+        for reader in readers:
+            reader.close()
+        for f in map_files:
+            f.close()
+    return num_merged
+
+
+def load_column_map(map_fname):
+    return np.loadtxt(map_fname, dtype=np.int64, ndmin=1)
+
+
+# Rewrite a (subjects x SNPs) geno text file so that its columns follow the merged positions, one row at a time
+# Positions the dataset doesn't have are written as missing (-1)
+# The rows are written to a temporary file next to out_fname that replaces it at the end, so out_fname may be geno_fname
+def reindex_geno_file(geno_fname, map_fname, num_merged, out_fname):
+    column_map = load_column_map(map_fname)
+    kept = column_map >= 0
+    targets = column_map[kept]
+    if targets.size and targets.max() >= num_merged:
+        raise ValueError('{} maps columns up to {}, but there are only {} merged positions'.format(
+            map_fname, targets.max(), num_merged))
+
+    fd, tmp_fname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(out_fname)), prefix='.reindex-')
+    try:
+        with open(geno_fname, 'rb') as f, os.fdopen(fd, 'wb') as out_f:
+            for line in f:
+                row = np.array(line.split(), dtype=np.int8)
+                if len(row) != len(column_map):
+                    raise ValueError('{} has {} columns, but the column map has {}'.format(geno_fname, len(row), len(column_map)))
+                merged = np.full((1, num_merged), -1, dtype=np.int8)
+                merged[0, targets] = row[kept]
+                write_int_matrix(out_f, merged)
+        os.replace(tmp_fname, out_fname)
+    except BaseException:
+        os.remove(tmp_fname)
+        raise
+
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 6 and sys.argv[1] == 'merge' and len(sys.argv) % 2 == 0:
+        num_merged = merge_pos_files(sys.argv[4::2], sys.argv[3], sys.argv[5::2], sys.argv[2])
+        print(num_merged)
+    elif len(sys.argv) == 6 and sys.argv[1] == 'reindex':
+        reindex_geno_file(sys.argv[2], sys.argv[3], int(sys.argv[4]), sys.argv[5])
+    else:
+        print('usage: python3 posmerge.py merge union|intersection MERGED_POS POS MAP [POS MAP ...]')
+        print('       python3 posmerge.py reindex GENO MAP NUM_MERGED_SNPS OUT_GENO')
+        sys.exit(1)
@@ -0,0 +1,170 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+
+# This file contains the on-disk cache of converted input data
+# Converting a VCF or covariate blob is slow, so the converted files are kept in a local cache directory, keyed by the
+# blob's bucket, name, generation and md5 hash, the conversion options, and a hash of the converter code itself, so an
+# entry is only ever reused for exactly the same input converted by exactly the same code
+# Entries are written to a temporary directory and renamed into place, so a half written entry is never used, and the
+# least recently used entries are evicted once the cache grows past its size budget
+# The cache is shared by every web server worker on the machine; a lock file serializes adding and evicting entries
+
+
+PREPROCESS_CACHE_DIR = os.environ.get('GWAS_PREPROCESS_CACHE', os.path.join(tempfile.gettempdir(), 'gwas-preprocess-cache'))
+
+# Total size (in bytes) the cached entries may take up before the least recently used ones are evicted
+PREPROCESS_CACHE_BYTES = int(os.environ.get('GWAS_PREPROCESS_CACHE_BYTES', 20 * 1024 ** 3))
+
+# Source files whose contents determine the converted output
+CONVERTER_SOURCES = ['converter.py', 'preprocess.py', 'genotype.py', 'covariates.py', 'binformat.py', 'qc.py']
+
+META_FILE = 'meta.json'
+LOCK_FILE = '.lock'
+
+
+def converter_version():
+    h = hashlib.sha256()
+    base = os.path.dirname(os.path.abspath(__file__))
+    for source in CONVERTER_SOURCES:
+        with open(os.path.join(base, source), 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()[:16]
+
+
+CONVERTER_VERSION = converter_version()
+
+
+# Cache key for converting a blob with the given options, or None if the blob's exact version can't be identified
+def blob_cache_key(kind, blob, *options):
+    if blob.generation is None:
+        return None
+    parts = [kind, blob.bucket.name, blob.name, str(blob.generation), blob.md5_hash or '', CONVERTER_VERSION]
+    parts += [repr(option) for option in options]
+    return hashlib.sha256('\0'.join(parts).encode('utf-8')).hexdigest()
+
+
+# Hash of a potentially long list of strings (e.g. subject ids), for use as a cache key option
+def list_digest(values):
+    h = hashlib.sha256()
+    for value in values:
+        h.update(value.encode('utf-8') + b'\0')
+    return h.hexdigest()
+
+
+class PreprocessCache:
+    def __init__(self, cache_dir=PREPROCESS_CACHE_DIR, max_bytes=PREPROCESS_CACHE_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    # Lock held while entries are added or evicted, across threads and processes
+    def lock(self):
+        return CacheLock(os.path.join(self.cache_dir, LOCK_FILE))
+
+    # Link (or copy) the files of a cached entry into out_dir and return its metadata, or return None on a miss
+    def get(self, key, out_dir):
+        entry = self.entry_dir(key)
+        with self.lock():
+            try:
+                with open(os.path.join(entry, META_FILE)) as f:
+                    meta = json.load(f)
+            except FileNotFoundError:
+                return None
+            for name in meta['files']:
+                link_or_copy(os.path.join(entry, name), os.path.join(out_dir, name))
+            # the metadata file's modification time records when the entry was last used
+            os.utime(os.path.join(entry, META_FILE))
+        return meta['result']
+
+    # Store the given files from out_dir in the cache along with result, a JSON serializable value
+    def put(self, key, out_dir, files, result):
+        staging = tempfile.mkdtemp(dir=self.cache_dir, prefix='.staging-')
+        try:
+            for name in files:
+                link_or_copy(os.path.join(out_dir, name), os.path.join(staging, name))
+            with open(os.path.join(staging, META_FILE), 'w') as f:
+                json.dump({'files': list(files), 'result': result, 'created': time.time()}, f)
+
+            with self.lock():
+                if not os.path.exists(self.entry_dir(key)):
+                    os.rename(staging, self.entry_dir(key))
+                    staging = None
+                self.evict()
+        finally:
+            if staging is not None:
+                shutil.rmtree(staging, ignore_errors=True)
+
+    # Remove the least recently used entries until the cache fits in its size budget (call with the lock held)
+    def evict(self):
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            meta = os.path.join(self.cache_dir, key, META_FILE)
+            if key.startswith('.') or not os.path.isfile(meta):
+                continue
+            size = sum(os.path.getsize(os.path.join(self.cache_dir, key, name)) for name in os.listdir(os.path.join(self.cache_dir, key)))
+            entries.append((os.path.getmtime(meta), size, key))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            print('Evicting preprocessed data {} ({} bytes) from the cache'.format(key, size))
+            shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+            total -= size
+
+    # Return the result of converting into out_dir with convert(out_dir), which must write the given files and return
+    # a JSON serializable result, taking the files and result from the cache when possible
+    # Returns (result, whether it came from the cache)
+    def get_or_convert(self, key, out_dir, files, convert):
+        if key is not None:
+            result = self.get(key, out_dir)
+            if result is not None:
+                return result, True
+
+        result = convert(out_dir)
+        if key is not None:
+            self.put(key, out_dir, files, result)
+        return result, False
+
+
+class CacheLock:
+    def __init__(self, fname):
+        self.fname = fname
+
+    def __enter__(self):
+        self.f = open(self.fname, 'a')
+        fcntl.flock(self.f, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.f, fcntl.LOCK_UN)
+        self.f.close()
+
+
+# Hard link src to dst when they are on the same file system, since cached files are never modified in place
+def link_or_copy(src, dst):
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+preprocess_cache = None
+
+
+def get_preprocess_cache():
+    global preprocess_cache
+    if preprocess_cache is None:
+        preprocess_cache = PreprocessCache()
+    return preprocess_cache
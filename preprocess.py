@@ -0,0 +1,105 @@
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from converter import *
+from genotype import GenotypeDecoder
+from qc import QC_COUNTERS
+
+
+# This file contains the multi-process version of the VCF preprocessing done by transform_genotype_data_vcf
+# The VCF is split into shards of consecutive rows (i.e. consecutive genomic regions of a sorted VCF), each shard is
+# decoded by a worker process into its own pos and SNP-major geno block, and the blocks are assembled in order into
+# the exact same geno.txt and pos.txt files that the serial converter writes
+
+
+# Number of VCF rows handed to a worker process at a time
+VCF_SHARD_SIZE = 8 * VCF_BLOCK_SIZE
+
+
+# Decode one shard of raw VCF lines inside a worker process, writing its positions and SNP-major dosages to shard_dir
+# Returns the number of SNPs written for the shard, and the QC counts if a variant_filter is given
+def convert_vcf_shard(shard_dir, shard_index, data, offset_index, decoder, block_size, variant_filter=None):
+    num_snps = 0
+    qc_counts = dict.fromkeys(QC_COUNTERS, 0)
+    pos_fname = os.path.join(shard_dir, '{}.pos'.format(shard_index))
+    raw_fname = os.path.join(shard_dir, '{}.geno'.format(shard_index))
+    with open(pos_fname, 'w') as pos_f, open(raw_fname, 'wb') as raw_f:
+        for lines in iter_vcf_blocks(data.splitlines(), block_size):
+            positions, dosages = parse_vcf_block(lines, offset_index, decoder)
+            if variant_filter is not None:
+                positions, dosages, counts = variant_filter.apply(positions, dosages)
+                for name in QC_COUNTERS:
+                    qc_counts[name] += counts[name]
+            write_positions(pos_f, positions)
+            raw_f.write(dosages.tobytes())
+            num_snps += dosages.shape[0]
+    return num_snps, qc_counts
+
+
+# Yield shards of at most shard_size raw VCF lines, each joined into a single bytes object so it is cheap to send
+# to a worker process
+def iter_vcf_shards(f, shard_size=VCF_SHARD_SIZE):
+    for lines in iter_vcf_blocks(f, shard_size):
+        yield b''.join(lines)
+
+
+# Add the QC counts of a converted shard to variant_filter and return the number of SNPs written for it
+def record_shard(result, variant_filter):
+    num_snps, qc_counts = result
+    if variant_filter is not None:
+        variant_filter.record(qc_counts)
+    return num_snps
+
+
+# Parallel version of transform_genotype_data_vcf that decodes shards of the VCF across num_workers processes
+# Produces byte-identical geno and pos files, and likewise returns the list of subjects
+# QC counts from the workers are added to variant_filter, like the serial converter does
+def transform_genotype_data_vcf_parallel(fname, num_workers=None, shard_size=VCF_SHARD_SIZE,
+                                         block_size=VCF_BLOCK_SIZE, decoder=None, binary=False, out_dir='.',
+                                         variant_filter=None):
+    if decoder is None:
+        decoder = GenotypeDecoder()
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+
+    shard_dir = tempfile.mkdtemp(suffix='-shards')
+    try:
+        shard_sizes = []
+        with open_vcf_source(fname) as f, ProcessPoolExecutor(max_workers=num_workers) as executor:
+            columns, offset_index = read_vcf_header(f)
+            subjects = columns[offset_index:]
+
+            # only keep a couple of shards per worker in flight, so that reading the (serial) gzip stream never runs
+            # too far ahead of the decoding and memory stays bounded by the shard size
+            pending = []
+            for shard_index, data in enumerate(iter_vcf_shards(f, shard_size)):
+                pending.append(executor.submit(convert_vcf_shard, shard_dir, shard_index, data, offset_index,
+                                               decoder, block_size, variant_filter))
+                if len(pending) >= 2 * num_workers:
+                    shard_sizes.append(record_shard(pending.pop(0).result(), variant_filter))
+            for future in pending:
+                shard_sizes.append(record_shard(future.result(), variant_filter))
+
+        # now assemble the shards in order
+        with open(os.path.join(out_dir, 'pos.txt'), 'wb') as pos_f:
+            for shard_index in range(len(shard_sizes)):
+                with open(os.path.join(shard_dir, '{}.pos'.format(shard_index)), 'rb') as f:
+                    shutil.copyfileobj(f, pos_f)
+
+        segments = [(os.path.join(shard_dir, '{}.geno'.format(i)), n) for i, n in enumerate(shard_sizes)]
+        write_geno_file(segments, len(subjects), os.path.join(out_dir, matrix_fname('geno', binary)),
+                        block_size * max(1, len(subjects)), binary)
+
+        # finally, simulate the phenotype data
+        phenotypes = simulate_phenotypes(sample_causal_genotypes(segments, len(subjects)))
+        save_int_matrix(os.path.join(out_dir, matrix_fname('pheno', binary)), phenotypes, binary)
+    finally:
+        shutil.rmtree(shard_dir)
+
+    # delete the file
+    remove_source(fname)
+
+    # return the list of subjects
+    return subjects
@@ -0,0 +1,314 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from blobstream import open_blob_stream
+
+
+# This file contains the remote-side preprocessing mode, where the input data is converted on the compute instance
+# rather than on the machine running the UI
+# The converter modules are shipped to the instance along with this file, which then runs there as a worker: it reads
+# the chosen blobs straight from Cloud Storage over the instance's own network (authenticated as the instance's service
+# account through the metadata server), and writes geno, pheno, pos and cov text files in place in gwas_data, so local
+# bandwidth and CPU drop out of the preprocessing entirely and the UI only relays the worker's progress
+# The worker talks to the UI over its output: every line is a progress message, except a final "result" line with the
+# JSON summary of what was converted; the UI side that ships and runs the worker is in remoteprep.py
+# Instances run the Python 3.5 of their Debian 9 image, so the worker and the converter modules it imports (see
+# remoteprep.WORKER_SOURCES) must stay compatible with it, and must not import any of the web server's modules
+# Run on an instance (or locally, with --gcs-root pointing at a directory laid out as BUCKET/NAME that stands in for
+# Cloud Storage) with:
+#   python3 prepworker.py check [--gcs-root DIR] URI...
+#   python3 prepworker.py convert --out DIR [--genotype URI [--gen-key KEY]] [--covariates URI [--cov-key KEY]]
+#                                 [--cov-columns COLUMNS] [--qc MIN_MAF MAX_MISSING MIN_HWE_P] [--gcs-root DIR]
+# where blobs are given as gs://BUCKET/NAME, optionally followed by #GENERATION to pin the exact version
+
+
+RESULT_PREFIX = 'result '
+
+METADATA_TOKEN_URL = 'http://metadata.google.internal/computeMetadata/v1/instance/service-accounts/default/token'
+GCS_OBJECT_URL = 'https://storage.googleapis.com/storage/v1/b/{}/o/{}'
+
+# Attempts at a Cloud Storage request that fails with a transient error before giving up
+GCS_RETRIES = 5
+
+GENOTYPE_FILES = ['geno.txt', 'pheno.txt', 'pos.txt']
+COVARIATE_FILES = ['cov.txt']
+
+
+class PreprocessWorkerError(Exception):
+    pass
+
+
+# Access token of the instance's service account, refreshed from the metadata server shortly before it expires
+class MetadataToken:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.token = None
+        self.expires = 0
+
+    def get(self):
+        with self.lock:
+            if self.token is None or time.time() > self.expires - 60:
+                request = urllib.request.Request(METADATA_TOKEN_URL, headers={'Metadata-Flavor': 'Google'})
+                with urllib.request.urlopen(request, timeout=10) as response:
+                    data = json.loads(response.read().decode('utf-8'))
+                self.token = data['access_token']
+                self.expires = time.time() + data['expires_in']
+            return self.token
+
+
+# A Cloud Storage object read through the JSON API, providing the parts of storage.Blob that BlobStream uses
+# Every ranged download is pinned to the generation seen by reload, so the object can't change while it is read
+class GCSBlob:
+    def __init__(self, bucket, name, generation=None, token=None):
+        self.bucket = bucket
+        self.name = name
+        self.generation = generation
+        self.token = token if token is not None else MetadataToken()
+        self.size = None
+
+    def __repr__(self):
+        return 'gs://{}/{}'.format(self.bucket, self.name)
+
+    def request(self, params, headers=None):
+        url = GCS_OBJECT_URL.format(urllib.parse.quote(self.bucket, safe=''), urllib.parse.quote(self.name, safe=''))
+        url += '?' + urllib.parse.urlencode(params)
+        for attempt in range(GCS_RETRIES):
+            try:
+                request = urllib.request.Request(url, headers=dict(headers or {}, Authorization='Bearer ' + self.token.get()))
+                with urllib.request.urlopen(request, timeout=60) as response:
+                    return response.read()
+            except urllib.error.HTTPError as e:
+                if (e.code != 429 and e.code < 500) or attempt == GCS_RETRIES - 1:
+                    raise PreprocessWorkerError('Failed to read {}: HTTP {} {}'.format(self, e.code, e.reason))
+            except urllib.error.URLError as e:
+                if attempt == GCS_RETRIES - 1:
+                    raise PreprocessWorkerError('Failed to read {}: {}'.format(self, e.reason))
+            time.sleep(2 ** attempt)
+
+    def reload(self):
+        meta = json.loads(self.request({'fields': 'size,generation'}).decode('utf-8'))
+        generation = int(meta['generation'])
+        if self.generation is not None and generation != self.generation:
+            raise PreprocessWorkerError('{} changed since it was chosen (generation {}, expected {})'.format(
+                self, generation, self.generation))
+        self.generation = generation
+        self.size = int(meta['size'])
+
+    def download_as_bytes(self, start, end):
+        return self.request({'alt': 'media', 'generation': self.generation},
+                            {'Range': 'bytes={}-{}'.format(start, end)})
+
+
+# A file in a local directory standing in for a Cloud Storage object, at ROOT/BUCKET/NAME
+class LocalBlob:
+    def __init__(self, root, bucket, name, generation=None):
+        self.fname = os.path.join(root, bucket, name)
+        self.generation = generation
+        self.size = None
+
+    def __repr__(self):
+        return self.fname
+
+    def reload(self):
+        if not os.path.isfile(self.fname):
+            raise PreprocessWorkerError('{} does not exist'.format(self.fname))
+        self.size = os.path.getsize(self.fname)
+
+    def download_as_bytes(self, start, end):
+        with open(self.fname, 'rb') as f:
+            f.seek(start)
+            return f.read(end - start + 1)
+
+
+# Parse a gs://BUCKET/NAME[#GENERATION] URI into the blob it names
+def open_uri(uri, gcs_root=None, token=None):
+    if not uri.startswith('gs://'):
+        raise PreprocessWorkerError('Expected a gs:// URI, got {}'.format(uri))
+    path, _, generation = uri[len('gs://'):].partition('#')
+    bucket, _, name = path.partition('/')
+    if not bucket or not name:
+        raise PreprocessWorkerError('Expected gs://BUCKET/NAME, got {}'.format(uri))
+    generation = int(generation) if generation else None
+    if gcs_root is not None:
+        return LocalBlob(gcs_root, bucket, name, generation)
+    return GCSBlob(bucket, name, generation, token)
+
+
+def emit(message):
+    print(message, flush=True)
+
+
+def emit_result(result):
+    print(RESULT_PREFIX + json.dumps(result), flush=True)
+
+
+def file_stamps(out_dir, names):
+    stamps = {}
+    for name in names:
+        st = os.stat(os.path.join(out_dir, name))
+        stamps[name] = [st.st_size, st.st_mtime_ns]
+    return stamps
+
+
+# Result of an earlier conversion into out_dir with the same key, if its output files are still exactly the ones it wrote
+# Each conversion leaves a marker file with its key, result and the size and modification time of its output files,
+# so anything that replaces those files afterwards (e.g. a later local preprocessing run) invalidates the marker
+def previous_result(out_dir, kind, key):
+    if key is None:
+        return None
+    try:
+        with open(os.path.join(out_dir, '.preprocessed-{}.json'.format(kind))) as f:
+            marker = json.load(f)
+        if marker['key'] == key and file_stamps(out_dir, marker['files']) == marker['files']:
+            return marker['result']
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+
+# Convert into a staging directory with convert(staging_dir), then move the files into out_dir and record the marker
+def convert_in_place(out_dir, kind, key, files, convert):
+    marker_fname = os.path.join(out_dir, '.preprocessed-{}.json'.format(kind))
+    if os.path.exists(marker_fname):
+        os.remove(marker_fname)
+
+    staging = tempfile.mkdtemp(dir=out_dir, prefix='.staging-')
+    try:
+        result = convert(staging)
+        for name in files:
+            os.replace(os.path.join(staging, name), os.path.join(out_dir, name))
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+    if key is not None:
+        with open(marker_fname, 'w') as f:
+            json.dump({'key': key, 'result': result, 'files': file_stamps(out_dir, files)}, f)
+    return result
+
+
+def count_lines(fname):
+    with open(fname, 'rb') as f:
+        return sum(block.count(b'\n') for block in iter(lambda: f.read(1024 * 1024), b''))
+
+
+# Check that this machine can run the converter and read every given blob, returning a summary of the machine
+# The converter modules are only imported here and in convert_inputs, so that an instance whose Python or packages
+# can't run them still gets a clear answer from check
+def check_worker(uris, gcs_root=None):
+    try:
+        import converter
+        import preprocess
+    except Exception as e:
+        raise PreprocessWorkerError('The converter cannot run with Python {} here: {!r}'.format(
+            '.'.join(map(str, sys.version_info[:3])), e))
+
+    token = MetadataToken() if gcs_root is None else None
+    for uri in uris:
+        open_uri(uri, gcs_root, token).reload()
+    return {'cpus': os.cpu_count(), 'python': '.'.join(map(str, sys.version_info[:3]))}
+
+
+# Convert the genotype and/or covariate blobs into out_dir, skipping conversions whose output is already in place
+def convert_inputs(out_dir, gen_uri=None, gen_key=None, cov_uri=None, cov_key=None, cov_columns=None, qc=None,
+                   gcs_root=None, num_workers=None):
+    from converter import transform_covariate_data
+    from preprocess import transform_genotype_data_vcf_parallel
+    from covariates import DEFAULT_COVARIATE_COLUMNS, parse_covariate_columns
+    from qc import VariantFilter
+
+    out_dir = os.path.expanduser(out_dir)
+    os.makedirs(out_dir, exist_ok=True)
+    token = MetadataToken() if gcs_root is None else None
+    result = {}
+
+    subject_ids = None
+    if gen_uri:
+        variant_filter = VariantFilter(*qc) if qc else None
+
+        def convert_genotypes(staging):
+            emit('Reading and converting genotype data {}'.format(gen_uri))
+            with open_blob_stream(open_uri(gen_uri, gcs_root, token)) as stream:
+                subjects = transform_genotype_data_vcf_parallel(stream, num_workers=num_workers, out_dir=staging,
+                                                                variant_filter=variant_filter)
+            return {'subjects': subjects, 'num_snps': count_lines(os.path.join(staging, 'pos.txt')),
+                    'qc': variant_filter.summary() if variant_filter is not None else None}
+
+        genotypes = previous_result(out_dir, 'genotype', gen_key)
+        if genotypes is not None:
+            emit('Genotype data {} was already converted on this instance'.format(gen_uri))
+        else:
+            genotypes = convert_in_place(out_dir, 'genotype', gen_key, GENOTYPE_FILES, convert_genotypes)
+        subject_ids = genotypes['subjects']
+        result['genotype'] = {'subjects': len(subject_ids), 'num_snps': genotypes['num_snps'], 'qc': genotypes['qc']}
+        emit('Converted {} SNPs for {} subjects'.format(genotypes['num_snps'], len(subject_ids)))
+
+    if cov_uri:
+        columns = parse_covariate_columns(cov_columns or DEFAULT_COVARIATE_COLUMNS)
+
+        def convert_covariates(staging):
+            emit('Reading and converting covariate data {}'.format(cov_uri))
+            with open_blob_stream(open_uri(cov_uri, gcs_root, token)) as stream:
+                return transform_covariate_data(stream, subject_ids, out_dir=staging, columns=columns)
+
+        # the covariates are aligned to the subjects, so the same blob converted for other subjects is a different entry
+        if cov_key is not None:
+            h = hashlib.sha256(cov_key.encode('utf-8'))
+            for subject in subject_ids or []:
+                h.update(subject.encode('utf-8') + b'\0')
+            cov_key = h.hexdigest()
+
+        num_covs = previous_result(out_dir, 'covariates', cov_key)
+        if num_covs is not None:
+            emit('Covariate data {} was already converted on this instance'.format(cov_uri))
+        else:
+            num_covs = convert_in_place(out_dir, 'covariates', cov_key, COVARIATE_FILES, convert_covariates)
+        result['covariates'] = {'num_covs': num_covs}
+
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Preprocess GWAS input data on a compute instance')
+    subparsers = parser.add_subparsers(dest='command')
+    check = subparsers.add_parser('check', help='check that the converter can run here and read the given blobs')
+    check.add_argument('uris', nargs='*')
+    check.add_argument('--gcs-root', help='local directory standing in for Cloud Storage')
+    convert = subparsers.add_parser('convert', help='convert blobs into gwas_data text files')
+    convert.add_argument('--out', required=True, help='directory to write the converted files to')
+    convert.add_argument('--genotype', help='gzipped VCF blob')
+    convert.add_argument('--gen-key', help='identifies the exact genotype conversion, to skip repeating it')
+    convert.add_argument('--covariates', help='tab separated covariate blob')
+    convert.add_argument('--cov-key', help='identifies the exact covariate conversion, to skip repeating it')
+    convert.add_argument('--cov-columns', help='covariate columns to include (see covariates.py)')
+    convert.add_argument('--qc', nargs=3, type=float, metavar=('MIN_MAF', 'MAX_MISSING', 'MIN_HWE_P'),
+                         help='drop variants that fail QC')
+    convert.add_argument('--gcs-root', help='local directory standing in for Cloud Storage')
+    convert.add_argument('--workers', type=int, help='number of conversion processes (default: one per CPU)')
+    args = parser.parse_args()
+
+    try:
+        if args.command == 'check':
+            emit_result(check_worker(args.uris, args.gcs_root))
+        elif args.command == 'convert':
+            emit_result(convert_inputs(args.out, args.genotype, args.gen_key, args.covariates, args.cov_key,
+                                       args.cov_columns, args.qc, args.gcs_root, args.workers))
+        else:
+            parser.print_usage()
+            sys.exit(2)
+    except (PreprocessWorkerError, ValueError) as e:
+        emit('Error: {}'.format(e))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
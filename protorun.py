@@ -0,0 +1,103 @@
+import json
+import os
+import re
+import signal
+import subprocess
+import sys
+import time
+
+from scheduler import ProtocolRound, schedule_rounds, ROUND_COMPLETED
+
+
+# This file contains the runner that executes a protocol run on the compute instance itself, detached from the ssh
+# session and the web server that started it (see runs.py)
+# The run is described by run.json in its run directory; the runner schedules its rounds with the same scheduler the
+# web server used to, and appends every event (output lines, rounds starting and finishing, stage changes, and the
+# final outcome) as one JSON object per line to events.log, which the UI tails by byte offset
+# Every event records the seconds since the runner started, measured on the instance's own clock (so clock skew
+# between the instance and the web server doesn't matter), and lines of client output that mark the start of a stage of
+# the protocol (given as patterns in run.json) add a stage event, so progress can be shown at a glance
+# Run on the instance with: python3 protorun.py RUN_DIR
+
+
+EVENTS_LOG = 'events.log'
+RUN_SPEC = 'run.json'
+
+# Longest piece of a line of client output written as one event; longer lines are split into several events, so that
+# every event stays well within the bytes the UI reads from the log at once (see runs.RUN_LOG_READ_BYTES), even with
+# every character escaped in JSON
+MAX_LINE_CHARS = 16 * 1024
+
+
+class EventLog:
+    def __init__(self, fname, start):
+        self.f = open(fname, 'a')
+        self.start = start
+
+    def write(self, event, **payload):
+        payload['event'] = event
+        payload['t'] = round(time.time() - self.start, 3)
+        self.f.write(json.dumps(payload, sort_keys=True) + '\n')
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+# Tracks the stage every round is in, from patterns (regular expression, stage name) in the order the stages happen
+# A round only ever moves forward through the stages, so a later line that happens to match an earlier pattern is ignored
+class StageTracker:
+    def __init__(self, stages):
+        self.stages = [(re.compile(pattern, re.IGNORECASE), name) for pattern, name in stages]
+        self.current = {}
+
+    # Return the index of the stage the line starts, or None if it doesn't start a new one
+    def match(self, tag, line):
+        for index in range(self.current.get(tag, -1) + 1, len(self.stages)):
+            if self.stages[index][0].search(line):
+                self.current[tag] = index
+                return index
+        return None
+
+
+def launch(r):
+    return subprocess.Popen(['bash', '-c', '; '.join(r.cmds)], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+
+def run(run_dir):
+    with open(os.path.join(run_dir, RUN_SPEC)) as f:
+        spec = json.load(f)
+    rounds = [ProtocolRound(r['tag'], r['cmds'], r['limited']) for r in spec['rounds']]
+    stages = StageTracker(spec.get('stages', []))
+    log = EventLog(os.path.join(run_dir, EVENTS_LOG), time.time())
+
+    # stopping the run (SIGTERM to the runner's process group) still leaves a final event in the log
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(143))
+    done = False
+    try:
+        for event, r, payload in schedule_rounds(rounds, launch, spec['concurrency'], spec['max_retries']):
+            if event == 'line':
+                for start in range(0, max(1, len(payload)), MAX_LINE_CHARS):
+                    log.write('line', tag=r.tag, line=payload[start:start + MAX_LINE_CHARS])
+                index = stages.match(r.tag, payload)
+                if index is not None:
+                    log.write('stage', tag=r.tag, stage=stages.stages[index][1], index=index, total=len(stages.stages))
+            elif event == 'started':
+                log.write('started', tag=r.tag, attempt=payload)
+            else:
+                log.write(event, tag=r.tag, status=r.status, duration=payload)
+
+        log.write('done', failed=[r.tag for r in rounds if r.status != ROUND_COMPLETED],
+                  durations=dict((r.tag, r.durations) for r in rounds))
+        done = True
+    finally:
+        if not done:
+            log.write('stopped', failed=[r.tag for r in rounds if r.status != ROUND_COMPLETED])
+        log.close()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print('usage: python3 protorun.py RUN_DIR')
+        sys.exit(1)
+    run(sys.argv[1])
@@ -0,0 +1,92 @@
+import math
+
+import numpy as np
+
+
+# This file contains the variant quality control applied while converting genotype data
+# Every SNP that goes into geno.txt adds to the runtime and communication of the MPC protocol, so variants that carry
+# no information (monomorphic or very rare ones), have too many missing calls, or are far out of Hardy-Weinberg
+# equilibrium are dropped before the data is secret shared
+# The statistics for a whole block of SNPs are computed together from one count of each genotype value per SNP
+
+
+# Names of the counters kept by VariantFilter, in order
+QC_COUNTERS = ('seen', 'kept', 'missing', 'maf', 'hwe')
+
+DEFAULT_MIN_MAF = 0.01
+DEFAULT_MAX_MISSING = 0.1
+DEFAULT_MIN_HWE_P = 1e-6
+
+chi2_1df_sf = np.frompyfunc(lambda x: math.erfc(math.sqrt(x / 2)), 1, 1)
+
+
+# Per SNP counts of each dosage value in a (SNPs x subjects) int8 block, as a (SNPs x 4) array of counts of missing
+# (-1), 0, 1 and 2
+def genotype_counts(dosages):
+    num_snps = dosages.shape[0]
+    keys = dosages.astype(np.int64) + 1 + 4 * np.arange(num_snps, dtype=np.int64)[:, None]
+    return np.bincount(keys.ravel(), minlength=4 * num_snps).reshape(num_snps, 4)
+
+
+# Alternate allele frequency, missing rate and Hardy-Weinberg equilibrium p-value (chi-square test with 1 degree of
+# freedom) of every SNP in a (SNPs x subjects) block of dosages
+def variant_stats(dosages):
+    counts = genotype_counts(dosages).astype(np.float64)
+    missing, n0, n1, n2 = counts.T
+    called = n0 + n1 + n2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        alt_freq = np.where(called > 0, (n1 + 2 * n2) / (2 * called), 0.0)
+        missing_rate = missing / max(1, dosages.shape[1])
+
+        p, q = alt_freq, 1 - alt_freq
+        expected = np.stack([called * q * q, 2 * called * p * q, called * p * p], axis=1)
+        observed = np.stack([n0, n1, n2], axis=1)
+        chi2 = np.where(expected > 0, (observed - expected) ** 2 / expected, 0.0).sum(axis=1)
+    # monomorphic SNPs are trivially in equilibrium
+    chi2[(p == 0) | (q == 0)] = 0.0
+    hwe_p = chi2_1df_sf(chi2).astype(np.float64) if len(chi2) > 0 else chi2
+    return alt_freq, missing_rate, hwe_p
+
+
+class VariantFilter:
+    def __init__(self, min_maf=DEFAULT_MIN_MAF, max_missing=DEFAULT_MAX_MISSING, min_hwe_p=DEFAULT_MIN_HWE_P):
+        self.min_maf = min_maf
+        self.max_missing = max_missing
+        self.min_hwe_p = min_hwe_p
+        self.counters = dict.fromkeys(QC_COUNTERS, 0)
+
+    def __repr__(self):
+        return 'VariantFilter(min_maf={}, max_missing={}, min_hwe_p={})'.format(self.min_maf, self.max_missing, self.min_hwe_p)
+
+    # Boolean mask of the SNPs in the block that pass QC, along with the counts of SNPs seen, kept and dropped for
+    # each reason (a SNP failing several checks is counted under the first one)
+    # Monomorphic SNPs always fail the minor allele frequency check, even with min_maf = 0
+    def check(self, dosages):
+        alt_freq, missing_rate, hwe_p = variant_stats(dosages)
+        maf = np.minimum(alt_freq, 1 - alt_freq)
+
+        bad_missing = missing_rate > self.max_missing
+        bad_maf = ~bad_missing & ((maf < self.min_maf) | (maf == 0))
+        bad_hwe = ~bad_missing & ~bad_maf & (hwe_p < self.min_hwe_p)
+        keep = ~(bad_missing | bad_maf | bad_hwe)
+
+        counts = {'seen': len(keep), 'kept': int(keep.sum()), 'missing': int(bad_missing.sum()),
+                  'maf': int(bad_maf.sum()), 'hwe': int(bad_hwe.sum())}
+        return keep, counts
+
+    # Add the counts returned by check, possibly from another process, to this filter's totals
+    def record(self, counts):
+        for name in QC_COUNTERS:
+            self.counters[name] += counts[name]
+
+    # Drop the SNPs of a block that fail QC, returning the remaining positions and dosages along with the counts
+    def apply(self, positions, dosages):
+        keep, counts = self.check(dosages)
+        if counts['kept'] < counts['seen']:
+            positions = [position for position, k in zip(positions, keep) if k]
+            dosages = dosages[keep]
+        return positions, dosages, counts
+
+    def summary(self):
+        return 'kept {kept} of {seen} variants (dropped {missing} for missingness, {maf} for allele frequency, ' \
+               '{hwe} for Hardy-Weinberg equilibrium)'.format(**self.counters)
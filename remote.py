@@ -0,0 +1,206 @@
+import os
+import shlex
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+from operations import backoff_delays
+
+
+# This file contains the layer used to run shell commands on, and copy files to, Google Cloud Compute Instances
+# Rather than paying for gcloud startup, key lookup and an SSH handshake on every call, the default backend resolves
+# the ssh command line for an instance once, and then keeps a multiplexed (ControlMaster) SSH connection open per
+# (project, instance) that all later commands and transfers reuse; connections are closed after being idle
+# The backend can be swapped out, e.g. for LocalBackend, which runs everything as local subprocesses
+
+
+# Seconds an idle multiplexed SSH connection is kept open
+SSH_IDLE_TIMEOUT = 300
+
+# Seconds to keep retrying the first connection to an instance, which may not accept SSH connections yet right after
+# its insert operation is DONE, and the backoff (in seconds) between attempts
+SSH_READY_TIMEOUT = 300
+SSH_READY_INITIAL_DELAY = 2.0
+SSH_READY_MAX_DELAY = 20.0
+
+# Seconds a single connection attempt may take
+SSH_CONNECT_TIMEOUT = 20
+
+# Python interpreter used to run the helper scripts shipped to an instance (e.g. prepworker.py and protorun.py)
+REMOTE_PYTHON = os.environ.get('GWAS_REMOTE_PYTHON', 'python3')
+
+# Directory holding the SSH control sockets
+SSH_CONTROL_DIR = os.environ.get('GWAS_SSH_CONTROL_DIR', os.path.join(tempfile.gettempdir(), 'gwas-ssh'))
+
+
+# A resolved ssh command line for one instance, plus the control socket its multiplexed connection uses
+class SSHConnection:
+    def __init__(self, target, options, control_path, idle_timeout):
+        self.target = target
+        self.options = options
+        self.control_path = control_path
+        self.idle_timeout = idle_timeout
+        self.last_used = time.monotonic()
+
+    def control_options(self):
+        return ['-o', 'ControlMaster=auto', '-o', 'ControlPath={}'.format(self.control_path),
+                '-o', 'ControlPersist={}'.format(self.idle_timeout)]
+
+    def ssh_argv(self, command):
+        return ['ssh'] + self.options + self.control_options() + [self.target, command]
+
+    def scp_argv(self, fnames, path):
+        return ['scp'] + self.options + self.control_options() + list(fnames) + ['{}:{}'.format(self.target, path)]
+
+    def exit_argv(self):
+        return ['ssh', '-o', 'ControlPath={}'.format(self.control_path), '-O', 'exit', self.target]
+
+
+# Backend that reaches instances over SSH, set up through the gcloud CLI
+class GcloudSSHBackend:
+    def __init__(self, idle_timeout=SSH_IDLE_TIMEOUT, control_dir=SSH_CONTROL_DIR, ready_timeout=SSH_READY_TIMEOUT,
+                 sleep=time.sleep, clock=time.monotonic):
+        self.idle_timeout = idle_timeout
+        self.control_dir = control_dir
+        self.ready_timeout = ready_timeout
+        self.sleep = sleep
+        self.clock = clock
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    # Open a multiplexed connection to the instance through gcloud (which also makes sure our SSH key has been added
+    # to the instance), then ask gcloud for the equivalent plain ssh command line so later calls can skip gcloud
+    # A freshly created instance's operation is DONE before sshd accepts connections, so failed attempts to connect are
+    # retried with backoff for up to ready_timeout seconds before giving up
+    def resolve(self, project, instance):
+        os.makedirs(self.control_dir, exist_ok=True)
+        control_path = os.path.join(self.control_dir, '{}-{}'.format(project, instance))
+        control_flags = ['--ssh-flag=-oControlMaster=auto', '--ssh-flag=-oControlPath={}'.format(control_path),
+                         '--ssh-flag=-oControlPersist={}'.format(self.idle_timeout),
+                         '--ssh-flag=-oConnectTimeout={}'.format(SSH_CONNECT_TIMEOUT)]
+        gcloud_ssh = ['gcloud', 'compute', 'ssh', instance, '--project', project]
+
+        deadline = self.clock() + self.ready_timeout
+        delays = backoff_delays(SSH_READY_INITIAL_DELAY, SSH_READY_MAX_DELAY)
+        while True:
+            try:
+                subprocess.run(gcloud_ssh + control_flags + ['--command', 'true'], check=True)
+                break
+            except subprocess.CalledProcessError:
+                remaining = deadline - self.clock()
+                if remaining <= 0:
+                    raise
+                print('{} is not accepting SSH connections yet, retrying'.format(instance))
+                self.sleep(min(next(delays), remaining))
+        dry_run = subprocess.run(gcloud_ssh + ['--dry-run'], check=True, stdout=subprocess.PIPE, universal_newlines=True)
+
+        argv = shlex.split(dry_run.stdout.strip().splitlines()[-1])
+        options = [arg for arg in argv[1:-1] if arg not in ('-t', '-T')]
+        return SSHConnection(argv[-1], options, control_path, self.idle_timeout)
+
+    def close_connection(self, connection):
+        subprocess.run(connection.exit_argv(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    # Close connections that have not been used for longer than the idle timeout
+    def evict_idle(self):
+        now = time.monotonic()
+        with self.lock:
+            idle = [key for key, conn in self.connections.items() if now - conn.last_used > self.idle_timeout]
+            evicted = [self.connections.pop(key) for key in idle]
+        for connection in evicted:
+            self.close_connection(connection)
+
+    def connection(self, project, instance):
+        self.evict_idle()
+        key = (project, instance)
+        with self.lock:
+            connection = self.connections.get(key)
+        if connection is None:
+            connection = self.resolve(project, instance)
+            with self.lock:
+                self.connections[key] = connection
+        connection.last_used = time.monotonic()
+        return connection
+
+    # Run a shell command on the instance and return its exit code, optionally feeding it a local file as stdin
+    def run(self, project, instance, command, stdin=None):
+        return subprocess.run(self.connection(project, instance).ssh_argv(command), stdin=stdin).returncode
+
+    # Run a shell command on the instance and return its standard output
+    def check_output(self, project, instance, command):
+        return subprocess.run(self.connection(project, instance).ssh_argv(command), check=True,
+                              stdout=subprocess.PIPE, universal_newlines=True).stdout
+
+    # Start a shell command on the instance without waiting for it, returning the local Popen object
+    def popen(self, project, instance, command, **kwargs):
+        return subprocess.Popen(self.connection(project, instance).ssh_argv(command), **kwargs)
+
+    # Copy local files into the given path on the instance in a single transfer, returning the exit code
+    def copy(self, project, instance, fnames, path):
+        return subprocess.run(self.connection(project, instance).scp_argv(fnames, path)).returncode
+
+    def close_all(self):
+        with self.lock:
+            connections = list(self.connections.values())
+            self.connections = {}
+        for connection in connections:
+            self.close_connection(connection)
+
+
+# Backend that stands in for compute instances with local directories, one per (project, instance), which act as the
+# instance's home directory
+class LocalBackend:
+    def __init__(self, root):
+        self.root = root
+
+    def home(self, project, instance):
+        home = os.path.join(self.root, project, instance)
+        os.makedirs(home, exist_ok=True)
+        return home
+
+    def local_path(self, project, instance, path):
+        home = self.home(project, instance)
+        if path == '~' or path.startswith('~/'):
+            return home + path[1:]
+        return os.path.join(home, path)
+
+    def env(self, project, instance):
+        return dict(os.environ, HOME=self.home(project, instance))
+
+    def run(self, project, instance, command, stdin=None):
+        return subprocess.run(['bash', '-c', command], cwd=self.home(project, instance),
+                              env=self.env(project, instance), stdin=stdin).returncode
+
+    def check_output(self, project, instance, command):
+        return subprocess.run(['bash', '-c', command], cwd=self.home(project, instance), env=self.env(project, instance),
+                              check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+
+    def popen(self, project, instance, command, **kwargs):
+        return subprocess.Popen(['bash', '-c', command], cwd=self.home(project, instance),
+                                env=self.env(project, instance), **kwargs)
+
+    def copy(self, project, instance, fnames, path):
+        dest = self.local_path(project, instance, path)
+        for fname in fnames:
+            shutil.copy(fname, dest)
+        return 0
+
+    def close_all(self):
+        pass
+
+
+remote_backend = GcloudSSHBackend()
+
+
+def get_remote_backend():
+    return remote_backend
+
+
+# Replace the backend used for all remote commands and transfers, returning the previous one
+def set_remote_backend(backend):
+    global remote_backend
+    previous = remote_backend
+    remote_backend = backend
+    return previous
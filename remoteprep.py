@@ -0,0 +1,117 @@
+import collections
+import json
+import os
+import shlex
+import subprocess
+
+from bundle import transfer_bundle_to_instance
+from prepworker import RESULT_PREFIX, PreprocessWorkerError
+from remote import REMOTE_PYTHON, get_remote_backend
+
+
+# This file contains the UI side of the remote-side preprocessing mode: it ships the worker (prepworker.py) and the
+# converter modules to a compute instance, runs it there, and relays its progress
+
+
+# Directory on the instance the worker and converter modules are shipped to
+REMOTE_WORKER_DIR = '~/gwas-prep/'
+
+# Local directory standing in for Cloud Storage on the instance, for testing against LocalBackend
+REMOTE_GCS_ROOT = os.environ.get('GWAS_REMOTE_GCS_ROOT')
+
+# Source files the worker needs on the instance, which are everything it imports (see tests/test_prepworker.py)
+WORKER_SOURCES = ['prepworker.py', 'converter.py', 'preprocess.py', 'genotype.py', 'binformat.py', 'covariates.py',
+                  'qc.py', 'blobstream.py']
+
+
+# Raised when the instance can't run the worker, e.g. because its Python is too old or it has no access to the blobs,
+# in which case the data can still be preprocessed locally
+class RemoteWorkerUnavailable(Exception):
+    pass
+
+
+# URI of a storage.Blob, pinned to its generation when known
+def blob_uri(blob):
+    uri = 'gs://{}/{}'.format(blob.bucket.name, blob.name)
+    if blob.generation is not None:
+        uri += '#{}'.format(blob.generation)
+    return uri
+
+
+def ship_worker(project, instance, backend):
+    base = os.path.dirname(os.path.abspath(__file__))
+    transfer_bundle_to_instance(project, instance, [os.path.join(base, source) for source in WORKER_SOURCES],
+                                REMOTE_WORKER_DIR, backend)
+
+
+# Run the worker on the instance with the given arguments, passing each progress line to report
+# Returns the worker's exit status, its result (or None), and the last lines it printed
+def run_worker(project, instance, args, report, backend, gcs_root=REMOTE_GCS_ROOT):
+    if gcs_root is not None:
+        args = args + ['--gcs-root', gcs_root]
+    command = 'cd {} && {} prepworker.py {} 2>&1'.format(REMOTE_WORKER_DIR, REMOTE_PYTHON,
+                                                         ' '.join(shlex.quote(arg) for arg in args))
+    process = backend.popen(project, instance, command, stdout=subprocess.PIPE, universal_newlines=True)
+    result = None
+    tail = collections.deque(maxlen=20)
+    for line in process.stdout:
+        line = line.rstrip('\n')
+        if line.startswith(RESULT_PREFIX):
+            result = json.loads(line[len(RESULT_PREFIX):])
+        elif line:
+            tail.append(line)
+            report(line)
+    return process.wait(), result, list(tail)
+
+
+# Ship the worker to the instance and check that it can convert the given blobs there
+# Raises RemoteWorkerUnavailable if it can't, and returns the worker's summary of the instance otherwise
+def check_remote_worker(project, instance, blobs, report, backend=None, gcs_root=REMOTE_GCS_ROOT):
+    if backend is None:
+        backend = get_remote_backend()
+    try:
+        ship_worker(project, instance, backend)
+    except Exception as e:
+        raise RemoteWorkerUnavailable('failed to ship the preprocessing worker: {}'.format(e))
+    status, result, tail = run_worker(project, instance, ['check'] + [blob_uri(blob) for blob in blobs],
+                                      report, backend, gcs_root)
+    if status != 0 or result is None:
+        raise RemoteWorkerUnavailable(tail[-1] if tail else 'worker exited with status {}'.format(status))
+    return result
+
+
+# Convert the given blobs into the instance's gwas_data directory with the worker, which must already be shipped
+# gen_key and cov_key identify the exact conversions (see preprocache.blob_cache_key), so the worker can skip a
+# conversion whose output is already in place; cov_columns is a list of CovariateColumn and variant_filter an optional
+# VariantFilter
+def preprocess_on_instance(project, instance, gen_blob, cov_blob, report, gen_key=None, cov_key=None,
+                           cov_columns=None, variant_filter=None, backend=None, gcs_root=REMOTE_GCS_ROOT):
+    if backend is None:
+        backend = get_remote_backend()
+    args = ['convert', '--out', '~/secure-gwas/gwas_data']
+    if gen_blob is not None:
+        args += ['--genotype', blob_uri(gen_blob)]
+        if gen_key is not None:
+            args += ['--gen-key', gen_key]
+        if variant_filter is not None:
+            args += ['--qc'] + [repr(value) for value in (variant_filter.min_maf, variant_filter.max_missing,
+                                                          variant_filter.min_hwe_p)]
+    if cov_blob is not None:
+        args += ['--covariates', blob_uri(cov_blob)]
+        if cov_key is not None:
+            args += ['--cov-key', cov_key]
+        if cov_columns is not None:
+            args += ['--cov-columns', ', '.join(repr(column) for column in cov_columns)]
+
+    status, result, tail = run_worker(project, instance, args, report, backend, gcs_root)
+    if status != 0 or result is None:
+        raise PreprocessWorkerError('Preprocessing on {} failed: {}'.format(instance, tail[-1] if tail else status))
+    return result
+
+
+# Copy a (small) file from the instance to a local file
+def copy_file_from_instance(project, instance, path, fname, backend=None):
+    if backend is None:
+        backend = get_remote_backend()
+    with open(fname, 'w') as f:
+        f.write(backend.check_output(project, instance, 'cat {}'.format(path)))
@@ -0,0 +1,233 @@
+import base64
+import json
+import os
+import sqlite3
+import time
+import uuid
+
+from bundle import transfer_bundle_to_instance
+from remote import REMOTE_PYTHON, get_remote_backend
+
+
+# This file contains the run registry, which keeps track of the protocol runs (DataSharingClient and GwasClient)
+# launched on compute instances
+# Runs used to be children of the ssh process behind the streaming HTTP response, so a browser disconnect or a web
+# server restart lost or orphaned a run that can take hours; now every run is launched detached on the instance (see
+# protorun.py), its events are written to a log file there, and the registry remembers which runs belong to which
+# instance, so their output can be viewed again, and followed from any byte offset without repeating anything
+
+
+RUNS_DB = os.environ.get('GWAS_RUNS_DB', 'runs.db')
+
+# Directory on the instance holding the runner and one directory per run
+REMOTE_RUNS_DIR = '~/gwas-runs/'
+
+RUNNER_SOURCES = ['protorun.py', 'scheduler.py']
+
+# Maximum number of bytes of a run's event log read in one go
+RUN_LOG_READ_BYTES = 1024 * 1024
+
+# Seconds to wait before checking a run's event log again when nothing new was written
+RUN_POLL_INTERVAL = 2
+
+# Kinds of runs
+RUN_DATA_SHARING = 'data_sharing'
+RUN_GWAS = 'gwas'
+
+# Possible run states
+RUN_RUNNING = 'running'
+RUN_COMPLETED = 'completed'
+RUN_FAILED = 'failed'
+RUN_STOPPED = 'stopped'
+RUN_LOST = 'lost'
+
+# Patterns (case insensitive regular expressions) marking the start of each stage of a run in the clients' output, in
+# the order the stages happen; they only drive the progress display
+RUN_STAGES = {
+    RUN_DATA_SHARING: [
+        ('connect', 'Connecting to the other parties'),
+        ('shar|mask', 'Secret sharing the data'),
+        ('done|finish|complete', 'Finishing')
+    ],
+    RUN_GWAS: [
+        ('connect', 'Connecting to the other parties'),
+        ('initial|load|read', 'Loading the shared data'),
+        ('missing|filter|hwe', 'Quality control filters'),
+        ('pca|power iteration|eigen', 'Population stratification'),
+        ('assoc|linear|regression', 'Association statistics'),
+        ('output|saved|result', 'Writing the results')
+    ]
+}
+
+
+def connect_runs_db():
+    conn = sqlite3.connect(RUNS_DB, timeout=30)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+# Create the runs table if it does not exist yet
+def init_runs_db():
+    with connect_runs_db() as conn:
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('''CREATE TABLE IF NOT EXISTS runs (
+                            id TEXT PRIMARY KEY,
+                            project TEXT,
+                            instance TEXT,
+                            kind TEXT,
+                            tags TEXT,
+                            status TEXT,
+                            started REAL,
+                            finished REAL)''')
+        conn.execute('CREATE INDEX IF NOT EXISTS runs_by_instance ON runs (project, instance, kind, started)')
+
+
+def update_run(run_id, **fields):
+    assignments = ', '.join('{} = ?'.format(k) for k in fields)
+    with connect_runs_db() as conn:
+        conn.execute('UPDATE runs SET {} WHERE id = ?'.format(assignments), list(fields.values()) + [run_id])
+
+
+def run_from_row(row):
+    run = dict(row)
+    run['tags'] = json.loads(run['tags'])
+    run['elapsed'] = (run['finished'] or time.time()) - run['started']
+    return run
+
+
+# Return a run as a dictionary, or None if there is no such run
+def get_run(run_id):
+    with connect_runs_db() as conn:
+        row = conn.execute('SELECT * FROM runs WHERE id = ?', (run_id,)).fetchone()
+    return run_from_row(row) if row is not None else None
+
+
+# Return the runs of the given kind on an instance, most recent first
+def list_runs(project, instance, kind):
+    with connect_runs_db() as conn:
+        rows = conn.execute('SELECT * FROM runs WHERE project = ? AND instance = ? AND kind = ? ORDER BY started DESC',
+                            (project, instance, kind)).fetchall()
+    return [run_from_row(row) for row in rows]
+
+
+def latest_run(project, instance, kind):
+    runs = list_runs(project, instance, kind)
+    return runs[0] if runs else None
+
+
+def remote_run_dir(run_id):
+    return REMOTE_RUNS_DIR + run_id
+
+
+# Launch the rounds (a list of ProtocolRound) on the instance as a detached run, and return the ID of the new run
+def launch_run(project, instance, kind, rounds, concurrency, max_retries, backend=None):
+    if backend is None:
+        backend = get_remote_backend()
+    base = os.path.dirname(os.path.abspath(__file__))
+    transfer_bundle_to_instance(project, instance, [os.path.join(base, source) for source in RUNNER_SOURCES],
+                                REMOTE_RUNS_DIR, backend)
+
+    run_id = '{}-{}'.format(time.strftime('%Y%m%d-%H%M%S'), uuid.uuid4().hex[:8])
+    started = time.time()
+    spec = {
+        'kind': kind,
+        'rounds': [{'tag': r.tag, 'cmds': r.cmds, 'limited': r.limited} for r in rounds],
+        'concurrency': concurrency,
+        'max_retries': max_retries,
+        'stages': RUN_STAGES.get(kind, [])
+    }
+    encoded = base64.b64encode(json.dumps(spec).encode('utf-8')).decode('ascii')
+
+    # setsid puts the runner and the clients it starts in their own process group, which outlives the ssh session
+    # and can be stopped as a whole
+    status = backend.run(project, instance, ' && '.join([
+        'mkdir -p {d}',
+        'echo {spec} | base64 -d > {d}/run.json',
+        'cd {runs}',
+        '(nohup setsid {python} protorun.py {id} > {id}/runner.out 2>&1 < /dev/null & echo $! > {id}/pid)'
+    ]).format(d=remote_run_dir(run_id), spec=encoded, runs=REMOTE_RUNS_DIR, python=REMOTE_PYTHON, id=run_id))
+    if status != 0:
+        raise RuntimeError('Failed to launch run {} on {}'.format(run_id, instance))
+
+    with connect_runs_db() as conn:
+        conn.execute('INSERT INTO runs (id, project, instance, kind, tags, status, started, finished) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                     (run_id, project, instance, kind, json.dumps([r.tag for r in rounds]), RUN_RUNNING, started, None))
+    return run_id
+
+
+def runner_alive_command(run_id):
+    return 'kill -0 "$(cat {}/pid 2>/dev/null)" 2>/dev/null'.format(remote_run_dir(run_id))
+
+
+# Whether the runner of a run is still running on the instance
+def run_alive(run, backend=None):
+    if backend is None:
+        backend = get_remote_backend()
+    return backend.run(run['project'], run['instance'], runner_alive_command(run['id'])) == 0
+
+
+# Read the events of a run written from byte offset onwards, along with whether the runner is still alive
+# Returns (alive, events), where events is a list of (offset after the event, event) pairs covering only complete lines
+# If max_bytes doesn't reach the end of the first event, more is read, so a long event can't stall the run's events
+def read_run_log(run, offset, max_bytes=RUN_LOG_READ_BYTES, backend=None):
+    if backend is None:
+        backend = get_remote_backend()
+    while True:
+        # the runner's state is checked before the log is read, so a runner that has exited has nothing left to add
+        output = backend.check_output(run['project'], run['instance'],
+                                      '({} && echo alive || echo exited); tail -c +{} {}/events.log 2>/dev/null | head -c {}'.format(
+                                          runner_alive_command(run['id']), offset + 1, remote_run_dir(run['id']), max_bytes))
+        state, _, data = output.partition('\n')
+        if len(data) < max_bytes or '\n' in data:
+            break
+        max_bytes *= 2
+
+    # events are written as ASCII JSON, so string lengths are byte lengths
+    events = []
+    for line in data.splitlines(True):
+        if not line.endswith('\n'):
+            break
+        offset += len(line)
+        events.append((offset, json.loads(line)))
+    return state == 'alive', events
+
+
+# Status of a run given its final event
+def final_status(event):
+    if event['event'] == 'done':
+        return RUN_FAILED if event['failed'] else RUN_COMPLETED
+    return RUN_STOPPED
+
+
+# Yield (offset, event) pairs for every event of a run from byte offset onwards as they are written, until the run ends
+# The time of every event is in seconds since the runner started on the instance, so the time the run finished is
+# recorded as its start on this machine's clock plus the duration the instance measured
+# A run whose runner exited without a final event (e.g. because the instance restarted) ends with a 'lost' event
+# The registry is brought up to date once the end of the run is seen
+def follow_run(run, offset=0, poll_interval=RUN_POLL_INTERVAL, backend=None):
+    while True:
+        alive, events = read_run_log(run, offset, backend=backend)
+        for offset, event in events:
+            yield offset, event
+            if event['event'] in ('done', 'stopped'):
+                if run['status'] == RUN_RUNNING:
+                    update_run(run['id'], status=final_status(event), finished=run['started'] + event['t'])
+                return
+
+        if not alive and not events:
+            if run['status'] == RUN_RUNNING:
+                update_run(run['id'], status=RUN_LOST, finished=time.time())
+            yield offset, {'event': 'lost'}
+            return
+        if not events:
+            time.sleep(poll_interval)
+
+
+# Stop a run by terminating its runner's whole process group
+def stop_run(run, backend=None):
+    if backend is None:
+        backend = get_remote_backend()
+    backend.run(run['project'], run['instance'], 'kill -TERM -- -"$(cat {}/pid)" 2>/dev/null'.format(remote_run_dir(run['id'])))
+
+
+init_runs_db()
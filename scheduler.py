@@ -0,0 +1,146 @@
+import collections
+import os
+import selectors
+import time
+
+
+# This file contains the scheduler that runs the rounds of the Data Sharing Protocol (one DataSharingClient per
+# dataset) with bounded concurrency, instead of launching all NUM_S rounds at once
+# Rounds are started in order, so that every party works through the datasets in the same order, failed rounds are
+# retried, and the duration of every attempt is recorded
+# The stdout of every running round is read concurrently through a selector, so no round can stall on a full pipe while
+# we are waiting on another one
+
+
+# Number of times a failed round is retried before giving up on it
+ROUND_MAX_RETRIES = 1
+
+# Maximum number of bytes read from a round's output at once
+READ_SIZE = 64 * 1024
+
+# Possible round states
+ROUND_PENDING = 'pending'
+ROUND_RUNNING = 'running'
+ROUND_COMPLETED = 'completed'
+ROUND_FAILED = 'failed'
+
+
+class ProtocolRound:
+    # limited is False for rounds that must start right away regardless of the concurrency limit, such as the S round,
+    # which the CPs of every other party are waiting on
+    def __init__(self, tag, cmds, limited=True):
+        self.tag = tag
+        self.cmds = cmds
+        self.limited = limited
+        self.status = ROUND_PENDING
+        self.attempts = 0
+        self.durations = []
+
+
+# Reads the stdout of a changing set of processes concurrently; processes can be added while others are being read
+class ProcessOutputMultiplexer:
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.buffers = {}
+        self.procs = {}
+
+    def add(self, tag, proc):
+        self.selector.register(proc.stdout, selectors.EVENT_READ, tag)
+        self.buffers[tag] = b''
+        self.procs[tag] = proc
+
+    # Number of processes whose output is still being read
+    def __len__(self):
+        return len(self.procs)
+
+    # Wait for output from any of the processes and yield (tag, line) pairs for every complete line read
+    # When a process closes its output, it is waited on and (tag, None) is yielded, with its exit code left in
+    # proc.returncode
+    def read(self, timeout=None):
+        for key, _ in self.selector.select(timeout):
+            tag = key.data
+            data = os.read(key.fileobj.fileno(), READ_SIZE)
+            if not data:
+                self.selector.unregister(key.fileobj)
+                rest = self.buffers.pop(tag)
+                if rest:
+                    yield tag, rest.decode('utf-8', 'replace').rstrip()
+                self.procs.pop(tag).wait()
+                yield tag, None
+                continue
+
+            lines = (self.buffers[tag] + data).split(b'\n')
+            self.buffers[tag] = lines.pop()
+            for line in lines:
+                yield tag, line.decode('utf-8', 'replace').rstrip()
+
+    def close(self):
+        self.selector.close()
+
+
+# Number of rounds to run at once on an instance with num_vcpus vCPUs, when every round runs num_threads threads
+def round_concurrency(num_vcpus, num_threads):
+    return max(1, num_vcpus // max(1, num_threads))
+
+
+# Run the rounds, starting each one with launch(round), which must return a Popen object whose stdout is a pipe
+# A round succeeds if it printed a line reading 'completed' and exited with status 0
+# Yields (event, round, payload) tuples, where event is one of
+#   'started'  payload is the attempt number
+#   'line'     payload is a line of output
+#   'finished' payload is the duration of the attempt in seconds, and round.status says whether it succeeded
+#   'retry'    payload is the duration of the failed attempt in seconds
+def schedule_rounds(rounds, launch, concurrency, max_retries=ROUND_MAX_RETRIES, clock=time.monotonic):
+    pending = collections.deque(rounds)
+    running = {}
+    mux = ProcessOutputMultiplexer()
+
+    # start every round that may start now, keeping the original order among the rounds that count towards the limit
+    def start_ready():
+        num_limited = sum(1 for r, _, _, _ in running.values() if r.limited)
+        for r in list(pending):
+            if r.limited and num_limited >= concurrency:
+                continue
+            pending.remove(r)
+            r.attempts += 1
+            r.status = ROUND_RUNNING
+            proc = launch(r)
+            mux.add(r.tag, proc)
+            running[r.tag] = (r, proc, clock(), set())
+            if r.limited:
+                num_limited += 1
+            yield 'started', r, r.attempts
+
+    try:
+        for event in start_ready():
+            yield event
+
+        while running:
+            for tag, line in mux.read():
+                r, proc, start, seen = running[tag]
+                if line is not None:
+                    if line == 'completed':
+                        seen.add(line)
+                    elif len(line) > 0:
+                        yield 'line', r, line
+                    continue
+
+                # the round's process has exited
+                del running[tag]
+                duration = clock() - start
+                r.durations.append(duration)
+                if 'completed' in seen and proc.returncode == 0:
+                    r.status = ROUND_COMPLETED
+                    yield 'finished', r, duration
+                elif r.attempts <= max_retries:
+                    r.status = ROUND_PENDING
+                    pending.appendleft(r)
+                    yield 'retry', r, duration
+                else:
+                    r.status = ROUND_FAILED
+                    yield 'finished', r, duration
+
+                for event in start_ready():
+                    yield event
+    finally:
+        mux.close()
@@ -0,0 +1,181 @@
+import dataclasses
+import typing
+from dataclasses import dataclass, field
+
+from params import get_P0_P1_ports
+
+
+# This file contains the schema of the GWAS config, along with the parser for config.txt files and UI form values, and
+# the checks that a config has to pass before it is written to the parameter files on the instances
+# Every field's converter is worked out once from its type, so parsing a file is a single pass over its lines, and
+# consistency problems (list lengths that don't match NUM_S, roles out of range, ports past the highest port) are reported
+# right away rather than when the MPC protocol fails
+
+
+# Number of communication channels every dataset needs ports for (CP0-CP1, CP0-CP2, CP1-CP2, CP1-SP, CP2-SP)
+NUM_CHANNELS = 5
+MAX_PORT = 65535
+
+
+@dataclass
+class GwasConfig:
+    IP_ADDR_P0: str = ''
+    IP_ADDR_P1: str = ''
+    IP_ADDR_P2: str = ''
+    NUM_S: int = 1
+    CP_ROLE: typing.Optional[int] = None
+    S_ROLE: typing.Optional[int] = None
+    PROJ0: str = ''
+    PROJ1: str = ''
+    PROJ2: str = ''
+    PROJ3: typing.List[str] = field(default_factory=lambda: [''])
+    NUM_INDS: typing.List[int] = field(default_factory=lambda: [0])
+    NUM_SNPS: int = 0
+    NUM_COVS: int = 0
+    NUM_CHUNKS: typing.List[int] = field(default_factory=lambda: [1])
+    NUM_THREADS: int = 1
+    NTL_NUM_THREADS: int = 0
+    NUM_PARALLEL_ROUNDS: typing.Optional[int] = None
+
+    def to_dict(self):
+        return dataclasses.asdict(self)
+
+    @classmethod
+    def from_dict(cls, config_dict):
+        return cls(**{name: config_dict[name] for name in FIELD_NAMES if name in config_dict})
+
+
+# Raised for config values that can't be parsed, or configs that fail validation
+class ConfigError(ValueError):
+    def __init__(self, errors):
+        super().__init__('; '.join(errors))
+        self.errors = errors
+
+
+def parse_int(kw, token):
+    try:
+        return int(token)
+    except ValueError:
+        raise ConfigError(['{} must be an integer, got {!r}'.format(kw, token)])
+
+
+def convert_str(kw, tokens):
+    return tokens[0] if tokens else ''
+
+def convert_int(kw, tokens):
+    if not tokens:
+        raise ConfigError(['{} needs a value'.format(kw)])
+    return parse_int(kw, tokens[0])
+
+def convert_optional_int(kw, tokens):
+    return parse_int(kw, tokens[0]) if tokens else None
+
+def convert_str_list(kw, tokens):
+    return list(tokens)
+
+def convert_int_list(kw, tokens):
+    return [parse_int(kw, token) for token in tokens]
+
+
+CONVERTERS_BY_TYPE = {
+    str: convert_str,
+    int: convert_int,
+    typing.Optional[int]: convert_optional_int,
+    typing.List[str]: convert_str_list,
+    typing.List[int]: convert_int_list
+}
+
+# Converter from whitespace separated tokens to a value, for every field of the config
+FIELD_CONVERTERS = {f.name: CONVERTERS_BY_TYPE[f.type] for f in dataclasses.fields(GwasConfig)}
+FIELD_NAMES = tuple(FIELD_CONVERTERS)
+
+
+# Convert the tokens given for a parameter in a config file or UI form into its value
+def convert_config_value(kw, tokens):
+    converter = FIELD_CONVERTERS.get(kw)
+    if converter is None:
+        raise ConfigError(['Unknown config parameter {}'.format(kw)])
+    return converter(kw, tokens)
+
+
+# Parse the lines of a config file into a GwasConfig, with defaults for the parameters it leaves out
+# Blank lines and lines starting with # are skipped, and every bad line is reported at once
+def parse_config_lines(lines):
+    values = {}
+    errors = []
+    for lineno, line in enumerate(lines, 1):
+        tokens = line.split()
+        if not tokens or tokens[0].startswith('#'):
+            continue
+        kw = tokens[0]
+        if kw in values:
+            errors.append('line {}: {} is given more than once'.format(lineno, kw))
+            continue
+        try:
+            values[kw] = convert_config_value(kw, tokens[1:])
+        except ConfigError as e:
+            errors.extend('line {}: {}'.format(lineno, error) for error in e.errors)
+    if errors:
+        raise ConfigError(errors)
+    return GwasConfig(**values)
+
+
+def parse_config_file(fname):
+    with open(fname, 'r') as f:
+        return parse_config_lines(f)
+
+
+# Ranges of ports [start, end) used by every dataset, given that the ports of consecutive datasets are spaced
+# NUM_CHANNELS * num_threads apart
+def dataset_port_ranges(num_S, num_threads):
+    starts = [int(port) for port in get_P0_P1_ports(num_S, num_threads).split()]
+    return [(start, start + NUM_CHANNELS * num_threads) for start in starts]
+
+
+# Return a list of everything wrong with the config, which is empty if the config is valid
+def validate_config(config):
+    errors = []
+
+    for name in ('NUM_SNPS', 'NUM_COVS', 'NTL_NUM_THREADS'):
+        if getattr(config, name) < 0:
+            errors.append('{} can not be negative'.format(name))
+    if config.NUM_THREADS < 1:
+        errors.append('NUM_THREADS must be at least 1')
+    if config.NUM_PARALLEL_ROUNDS is not None and config.NUM_PARALLEL_ROUNDS < 1:
+        errors.append('NUM_PARALLEL_ROUNDS must be at least 1, or left blank')
+
+    if config.NUM_S < 1:
+        errors.append('NUM_S must be at least 1')
+        return errors
+
+    # every dataset needs its own number of individuals and chunks
+    if len(config.NUM_INDS) != config.NUM_S:
+        errors.append('NUM_INDS lists {} datasets, but NUM_S is {}'.format(len(config.NUM_INDS), config.NUM_S))
+    if len(config.NUM_CHUNKS) != config.NUM_S:
+        errors.append('NUM_CHUNKS lists {} datasets, but NUM_S is {}'.format(len(config.NUM_CHUNKS), config.NUM_S))
+    if any(n < 0 for n in config.NUM_INDS):
+        errors.append('NUM_INDS can not be negative')
+    if any(n < 1 for n in config.NUM_CHUNKS):
+        errors.append('NUM_CHUNKS must be at least 1 for every dataset')
+
+    if config.CP_ROLE is not None and config.CP_ROLE not in (0, 1, 2):
+        errors.append('CP_ROLE must be 0, 1 or 2, or left blank')
+    if config.S_ROLE is not None and not 0 <= config.S_ROLE < config.NUM_S:
+        errors.append('S_ROLE must be a number between 0 and NUM_S - 1, or left blank')
+
+    # the ports of every dataset are derived from NUM_S and NUM_THREADS (see params.py), so the datasets' ranges never
+    # overlap, but they must all be valid port numbers
+    if config.NUM_THREADS >= 1:
+        ranges = dataset_port_ranges(config.NUM_S, config.NUM_THREADS)
+        if ranges[-1][1] - 1 > MAX_PORT:
+            errors.append('{} datasets with {} threads each need ports up to {}, past the highest port {}'.format(
+                config.NUM_S, config.NUM_THREADS, ranges[-1][1] - 1, MAX_PORT))
+
+    return errors
+
+
+# Raise a ConfigError listing everything wrong with the config, if anything is
+def check_config(config):
+    errors = validate_config(config)
+    if errors:
+        raise ConfigError(errors)
@@ -7,7 +7,7 @@ sudo apt-get --assume-yes install libgmp3-dev
 sudo apt-get --assume-yes install libssl-dev
 sudo apt-get --assume-yes install libomp-dev
 sudo apt-get --assume-yes install python3-pip
-pip3 install numpy
+pip3 install numpy pandas psutil
 echo done installing packages
 
 sudo apt-get --assume-yes install git
@@ -0,0 +1,12 @@
+import json
+
+
+# This file contains helpers for streaming events to the browser as server-sent events
+
+
+# Format a server-sent event carrying a JSON payload
+# If an event_id is given, a browser that loses the connection sends the last one it received in the Last-Event-ID
+# header when it reconnects, so the stream can pick up where it left off
+def sse_event(event, payload, event_id=None):
+    id_line = 'id: {}\n'.format(event_id) if event_id is not None else ''
+    return '{}event: {}\ndata: {}\n\n'.format(id_line, event, json.dumps(payload))
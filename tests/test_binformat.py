@@ -0,0 +1,42 @@
+import io
+
+import numpy as np
+import pytest
+
+from binformat import ENCODING_INT8, ENCODING_INT32, ENCODING_PACKED2, convert_matrix_file_to_text, int_encoding, \
+    load_matrix_file, write_matrix_file
+
+
+@pytest.mark.parametrize('values, encoding', [
+    ([[0, 1], [1, 0]], ENCODING_INT8),
+    ([[-128, 127]], ENCODING_INT8),
+    ([[21, 200], [30, -5]], ENCODING_INT32),
+    ([[0, -129]], ENCODING_INT32)
+])
+def test_int_matrices_round_trip(tmp_path, values, encoding):
+    matrix = np.array(values, dtype=np.int64)
+    assert int_encoding(matrix) == encoding
+    fname = str(tmp_path / 'cov.bin')
+    write_matrix_file(fname, [matrix], matrix.shape[0], matrix.shape[1], encoding)
+    np.testing.assert_array_equal(load_matrix_file(fname), matrix)
+
+    text = str(tmp_path / 'cov.txt')
+    convert_matrix_file_to_text(fname, text, max_bytes=4)
+    expected = io.BytesIO()
+    np.savetxt(expected, matrix, fmt='%i')
+    with open(text, 'rb') as f:
+        assert f.read() == expected.getvalue()
+
+
+@pytest.mark.parametrize('values, encoding', [([[200]], ENCODING_INT8), ([[2 ** 31]], ENCODING_INT32)])
+def test_values_out_of_range_are_rejected(tmp_path, values, encoding):
+    matrix = np.array(values, dtype=np.int64)
+    with pytest.raises(ValueError, match='do not fit'):
+        write_matrix_file(str(tmp_path / 'cov.bin'), [matrix], 1, 1, encoding)
+
+
+def test_packed_genotypes_round_trip(tmp_path):
+    matrix = np.random.RandomState(0).randint(-1, 3, size=(7, 13)).astype(np.int8)
+    fname = str(tmp_path / 'geno.bin')
+    write_matrix_file(fname, [matrix[:3], matrix[3:]], 7, 13, ENCODING_PACKED2)
+    np.testing.assert_array_equal(load_matrix_file(fname), matrix)
@@ -0,0 +1,68 @@
+import os
+
+import pytest
+
+from bundle import BundleTransferError, transfer_bundle_to_instance
+from remote import LocalBackend
+
+
+# LocalBackend whose first uploads are cut off partway, as an interrupted connection would
+class FlakyBackend(LocalBackend):
+    def __init__(self, root, failures, fraction=0.5):
+        super().__init__(root)
+        self.failures = failures
+        self.fraction = fraction
+        self.uploaded = []
+
+    def run(self, project, instance, command, stdin=None):
+        if command.startswith('cat >> ') and stdin is not None:
+            data = stdin.read()
+            self.uploaded.append(len(data))
+            if self.failures > 0:
+                self.failures -= 1
+                with open(self.local_path(project, instance, command[len('cat >> '):]), 'ab') as f:
+                    f.write(data[:int(len(data) * self.fraction)])
+                return 255
+            with open(self.local_path(project, instance, command[len('cat >> '):]), 'ab') as f:
+                f.write(data)
+            return 0
+        return super().run(project, instance, command, stdin)
+
+
+def write_files(tmp_path, num_files=3, size=200000):
+    fnames = []
+    for i in range(num_files):
+        fname = str(tmp_path / 'file{}.txt'.format(i))
+        with open(fname, 'wb') as f:
+            f.write(os.urandom(size))
+        fnames.append(fname)
+    return fnames
+
+
+def test_interrupted_upload_resumes(tmp_path):
+    fnames = write_files(tmp_path)
+    backend = FlakyBackend(str(tmp_path / 'instances'), failures=2)
+    sent = transfer_bundle_to_instance('p', 'i', fnames, '~/data/', backend)
+
+    assert sorted(sent) == ['file0.txt', 'file1.txt', 'file2.txt']
+    for fname in fnames:
+        with open(fname, 'rb') as f, open(backend.local_path('p', 'i', '~/data/' + os.path.basename(fname)), 'rb') as g:
+            assert f.read() == g.read()
+    # every retry only sent what hadn't arrived yet
+    assert backend.uploaded[1] == backend.uploaded[0] - int(backend.uploaded[0] * 0.5)
+    assert backend.uploaded[2] == backend.uploaded[1] - int(backend.uploaded[1] * 0.5)
+    assert not [name for name in os.listdir(backend.local_path('p', 'i', '~/data')) if name.startswith('.bundle-')]
+
+
+def test_upload_gives_up_after_repeated_failures(tmp_path):
+    fnames = write_files(tmp_path, num_files=1)
+    backend = FlakyBackend(str(tmp_path / 'instances'), failures=100, fraction=0)
+    with pytest.raises(BundleTransferError):
+        transfer_bundle_to_instance('p', 'i', fnames, '~/data/', backend)
+
+
+def test_unchanged_files_are_skipped(tmp_path):
+    fnames = write_files(tmp_path, num_files=2)
+    backend = LocalBackend(str(tmp_path / 'instances'))
+    assert len(transfer_bundle_to_instance('p', 'i', fnames, '~/data/', backend)) == 2
+    assert transfer_bundle_to_instance('p', 'i', fnames, '~/data/', backend) == []
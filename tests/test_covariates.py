@@ -0,0 +1,73 @@
+import io
+import random
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from covariates import build_covariate_matrix, parse_covariate_columns, read_covariate_table
+
+
+# The encoding transform_covariate_data produced before covariates.py, which the default columns have to reproduce
+def reference_matrix(text, ids):
+    df = pd.read_csv(io.StringIO(text), delimiter='\t', encoding='utf-8')[['Sample name', 'Sex', 'Population code']]
+    if ids is not None:
+        df = pd.merge(df, pd.DataFrame(ids, columns=['Sample name']), on='Sample name', how='inner')
+    sex = df['Sex'].replace(['female', 'male'], [0, 1])
+    population = pd.get_dummies(df['Population code'])
+    return pd.concat([sex, population], axis=1).to_numpy().astype(int)
+
+
+def covariate_file(rows, extra_columns=()):
+    lines = ['\t'.join(['Sample name', 'Sex', 'Population code', 'Family ID'] + [name for name, _ in extra_columns])]
+    for i, (subject, sex, population) in enumerate(rows):
+        lines.append('\t'.join([subject, sex, population, 'F{}'.format(i)] + [str(v[i]) for _, v in extra_columns]))
+    return '\n'.join(lines) + '\n'
+
+
+def matrix(text, columns, ids):
+    columns = parse_covariate_columns(columns)
+    return build_covariate_matrix(read_covariate_table(io.StringIO(text), columns), columns, ids)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_default_columns_match_reference(seed):
+    rng = random.Random(seed)
+    populations = ['GBR', 'FIN', 'CHS', 'PUR', 'YRI'][:rng.randint(1, 5)]
+    rows = [('HG{:05d}'.format(i), rng.choice(['female', 'male']), rng.choice(populations))
+            for i in range(rng.randint(5, 60))]
+    text = covariate_file(rows)
+    # the reference keeps the order of the file, so pick the subjects in file order
+    ids = [subject for subject, _, _ in rows if rng.random() < 0.6] or [rows[0][0]]
+    expected = reference_matrix(text, ids)
+    np.testing.assert_array_equal(matrix(text, 'Sex:binary, Population code:onehot', ids), expected)
+
+
+def test_categories_only_come_from_chosen_subjects():
+    text = covariate_file([('A', 'male', 'GBR'), ('B', 'female', 'FIN'), ('C', 'male', 'CHS'), ('D', 'female', 'YRI')])
+    result = matrix(text, 'Sex:binary, Population code:onehot', ['B', 'A'])
+    np.testing.assert_array_equal(result, [[0, 1, 0], [1, 0, 1]])
+
+
+def test_binary_keeps_codes_of_a_single_value():
+    text = covariate_file([('A', 'male', 'GBR'), ('B', 'male', 'GBR'), ('C', 'female', 'GBR')])
+    np.testing.assert_array_equal(matrix(text, 'Sex:binary', ['A', 'B']), [[1], [1]])
+    np.testing.assert_array_equal(matrix(text, 'Sex:binary', ['C']), [[0]])
+
+
+def test_numeric_rejects_fractions():
+    rows = [('A', 'male', 'GBR'), ('B', 'female', 'GBR')]
+    text = covariate_file(rows, [('Age', [21.7, 30])])
+    with pytest.raises(ValueError, match='not integers'):
+        matrix(text, 'Age:numeric', ['A', 'B'])
+    text = covariate_file(rows, [('Age', [21.0, 300])])
+    np.testing.assert_array_equal(matrix(text, 'Age:numeric', ['B', 'A']), [[300], [21]])
+
+
+def test_missing_and_duplicated_subjects():
+    text = covariate_file([('A', 'male', 'GBR'), ('A', 'female', 'GBR')])
+    with pytest.raises(ValueError, match='more than once'):
+        matrix(text, 'Sex:binary', ['A'])
+    text = covariate_file([('A', 'male', 'GBR')])
+    with pytest.raises(ValueError, match='no rows'):
+        matrix(text, 'Sex:binary', ['A', 'Z'])
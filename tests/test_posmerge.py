@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from posmerge import MERGE_INTERSECTION, MERGE_UNION, merge_pos_files, reindex_geno_file
+
+
+def write_lines(path, lines):
+    path.write_text(''.join(line + '\n' for line in lines))
+    return str(path)
+
+
+@pytest.fixture
+def datasets(tmp_path):
+    pos = [write_lines(tmp_path / 'pos1.txt', ['1 100', '1 200', '2 50']),
+           write_lines(tmp_path / 'pos2.txt', ['1 200', '2 50', '2 70'])]
+    maps = [str(tmp_path / 'map1.txt'), str(tmp_path / 'map2.txt')]
+    return pos, maps
+
+
+@pytest.mark.parametrize('mode, merged, maps', [
+    (MERGE_UNION, ['1 100', '1 200', '2 50', '2 70'], [[0, 1, 2], [1, 2, 3]]),
+    (MERGE_INTERSECTION, ['1 200', '2 50'], [[-1, 0, 1], [0, 1, -1]])
+])
+def test_merge(tmp_path, datasets, mode, merged, maps):
+    pos, map_fnames = datasets
+    out = tmp_path / 'merged.txt'
+    assert merge_pos_files(pos, str(out), map_fnames, mode, chunk_lines=1) == len(merged)
+    assert out.read_text().splitlines() == merged
+    for map_fname, expected in zip(map_fnames, maps):
+        assert np.loadtxt(map_fname, dtype=int, ndmin=1).tolist() == expected
+
+
+def test_reindex_in_place(tmp_path, datasets):
+    pos, map_fnames = datasets
+    merge_pos_files(pos, str(tmp_path / 'merged.txt'), map_fnames, MERGE_UNION)
+    geno = write_lines(tmp_path / 'geno.txt', ['0 1 2', '2 -1 0'])
+    reindex_geno_file(geno, map_fnames[1], 4, geno)
+    assert (tmp_path / 'geno.txt').read_text().splitlines() == ['-1 0 1 2', '-1 2 -1 0']
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['geno.txt', 'map1.txt', 'map2.txt', 'merged.txt', 'pos1.txt',
+                                                          'pos2.txt']
+
+
+def test_reindex_failure_leaves_input_alone(tmp_path, datasets):
+    pos, map_fnames = datasets
+    merge_pos_files(pos, str(tmp_path / 'merged.txt'), map_fnames, MERGE_UNION)
+    geno = write_lines(tmp_path / 'geno.txt', ['0 1 2', '2 -1'])
+    with pytest.raises(ValueError):
+        reindex_geno_file(geno, map_fnames[0], 4, geno)
+    assert (tmp_path / 'geno.txt').read_text().splitlines() == ['0 1 2', '2 -1']
+    assert not [p for p in tmp_path.iterdir() if p.name.startswith('.reindex-')]
@@ -0,0 +1,81 @@
+import io
+import os
+import random
+
+import numpy as np
+import pytest
+
+from benchmarks.synthetic import write_synthetic_vcf
+from binformat import load_matrix_file
+from converter import transform_genotype_data_vcf, write_geno_file
+from preprocess import transform_genotype_data_vcf_parallel
+from qc import VariantFilter
+
+
+def read_outputs(out_dir):
+    outputs = {}
+    for name in sorted(os.listdir(out_dir)):
+        with open(os.path.join(out_dir, name), 'rb') as f:
+            outputs[name] = f.read()
+    return outputs
+
+
+def convert(convert_fn, vcf, out_dir, **kwargs):
+    os.makedirs(out_dir)
+    # the phenotypes are simulated with the random module, so both converters need the same seed
+    random.seed(0)
+    with open(vcf, 'rb') as source:
+        subjects = convert_fn(source, out_dir=out_dir, **kwargs)
+    return subjects, read_outputs(out_dir)
+
+
+@pytest.mark.parametrize('num_samples, num_snps, shard_size', [(7, 1, 1), (50, 999, 64), (200, 3000, 1000)])
+@pytest.mark.parametrize('binary', [False, True])
+def test_parallel_matches_serial(tmp_path, num_samples, num_snps, shard_size, binary):
+    vcf = str(tmp_path / 'input.vcf.gz')
+    write_synthetic_vcf(vcf, num_samples, num_snps, phased_fraction=0.7, missing_rate=0.05, seed=num_snps)
+
+    serial = convert(transform_genotype_data_vcf, vcf, str(tmp_path / 'serial'), block_size=100, binary=binary)
+    parallel = convert(transform_genotype_data_vcf_parallel, vcf, str(tmp_path / 'parallel'), num_workers=2,
+                       shard_size=shard_size, block_size=100, binary=binary)
+    assert parallel == serial
+
+
+def test_parallel_matches_serial_with_qc(tmp_path):
+    vcf = str(tmp_path / 'input.vcf.gz')
+    write_synthetic_vcf(vcf, 100, 2000, missing_rate=0.08, seed=1)
+
+    serial_filter = VariantFilter(min_maf=0.1, max_missing=0.1)
+    parallel_filter = VariantFilter(min_maf=0.1, max_missing=0.1)
+    serial = convert(transform_genotype_data_vcf, vcf, str(tmp_path / 'serial'), variant_filter=serial_filter)
+    parallel = convert(transform_genotype_data_vcf_parallel, vcf, str(tmp_path / 'parallel'), num_workers=2,
+                       shard_size=300, variant_filter=parallel_filter)
+    assert parallel == serial
+    assert parallel_filter.counters == serial_filter.counters
+    assert 0 < serial_filter.counters['kept'] < serial_filter.counters['seen']
+
+
+@pytest.mark.parametrize('max_bytes', [1, 7, 100, 10 ** 6])
+@pytest.mark.parametrize('binary', [False, True])
+def test_geno_file_is_the_transpose_of_the_segments(tmp_path, max_bytes, binary):
+    rng = np.random.RandomState(max_bytes)
+    num_subjects = 23
+    parts = [rng.randint(-1, 3, size=(n, num_subjects)).astype(np.int8) for n in (17, 0, 40, 1)]
+    segments = []
+    for i, part in enumerate(parts):
+        fname = str(tmp_path / 'segment{}.geno'.format(i))
+        part.tofile(fname)
+        segments.append((fname, part.shape[0]))
+    expected = np.vstack(parts).T
+
+    out = str(tmp_path / ('geno.bin' if binary else 'geno.txt'))
+    write_geno_file(segments, num_subjects, out, max_bytes, binary)
+    if binary:
+        np.testing.assert_array_equal(load_matrix_file(out), expected)
+    else:
+        text = io.BytesIO()
+        np.savetxt(text, expected, fmt='%i')
+        with open(out, 'rb') as f:
+            assert f.read() == text.getvalue()
+    # the temporary transposed file is gone
+    assert sorted(os.listdir(str(tmp_path))) == sorted([os.path.basename(out)] + [os.path.basename(f) for f, _ in segments])
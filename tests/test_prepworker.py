@@ -0,0 +1,99 @@
+import ast
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+from benchmarks.synthetic import sample_ids, write_synthetic_covariates, write_synthetic_vcf
+from prepworker import RESULT_PREFIX
+from remoteprep import WORKER_SOURCES
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Oldest Python the worker has to run on, that of the instances' Debian 9 image
+INSTANCE_PYTHON_VERSION = (3, 5)
+
+# Interpreter standing in for the instances' Python, e.g. a python3.5 with numpy and pandas installed
+INSTANCE_PYTHON = os.environ.get('GWAS_INSTANCE_PYTHON')
+
+
+def repo_modules():
+    return set(name[:-len('.py')] for name in os.listdir(REPO_DIR) if name.endswith('.py'))
+
+
+# Names of the modules a source file imports anywhere in it, including inside functions
+def imported_modules(source):
+    with open(os.path.join(REPO_DIR, source)) as f:
+        tree = ast.parse(f.read(), source)
+    modules = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            modules.update(alias.name.split('.')[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.level == 0:
+            modules.add(node.module.split('.')[0])
+    return modules
+
+
+@pytest.mark.parametrize('source', WORKER_SOURCES)
+def test_worker_sources_parse_as_instance_python(source):
+    with open(os.path.join(REPO_DIR, source)) as f:
+        ast.parse(f.read(), source, feature_version=INSTANCE_PYTHON_VERSION)
+
+
+@pytest.mark.parametrize('source', WORKER_SOURCES)
+def test_worker_only_imports_shipped_modules(source):
+    shipped = set(name[:-len('.py')] for name in WORKER_SOURCES)
+    assert imported_modules(source) & repo_modules() <= shipped
+
+
+def instance_pythons():
+    pythons = [sys.executable]
+    if INSTANCE_PYTHON:
+        pythons.append(INSTANCE_PYTHON)
+    return pythons
+
+
+# Run the worker from a directory holding nothing but the shipped sources, like ~/gwas-prep/ on an instance
+def run_worker(python, worker_dir, args):
+    process = subprocess.run([python, 'prepworker.py'] + args, cwd=worker_dir, stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT, universal_newlines=True)
+    lines = process.stdout.splitlines()
+    results = [json.loads(line[len(RESULT_PREFIX):]) for line in lines if line.startswith(RESULT_PREFIX)]
+    assert process.returncode == 0, process.stdout
+    assert len(results) == 1, process.stdout
+    return results[0]
+
+
+@pytest.fixture
+def worker_dir(tmp_path):
+    worker_dir = tmp_path / 'gwas-prep'
+    worker_dir.mkdir()
+    for source in WORKER_SOURCES:
+        shutil.copy(os.path.join(REPO_DIR, source), str(worker_dir / source))
+    return str(worker_dir)
+
+
+@pytest.mark.parametrize('python', instance_pythons())
+def test_worker_runs_on_instance_python(tmp_path, worker_dir, python):
+    if subprocess.run([python, '-c', 'import numpy, pandas']).returncode != 0:
+        pytest.skip('{} has no numpy and pandas'.format(python))
+
+    gcs_root = tmp_path / 'gcs'
+    (gcs_root / 'bucket').mkdir(parents=True)
+    write_synthetic_vcf(str(gcs_root / 'bucket' / 'input.vcf.gz'), 20, 150, seed=1)
+    write_synthetic_covariates(str(gcs_root / 'bucket' / 'cov.tsv'), sample_ids(20), seed=1)
+    gen_uri, cov_uri = 'gs://bucket/input.vcf.gz', 'gs://bucket/cov.tsv'
+
+    summary = run_worker(python, worker_dir, ['check', gen_uri, cov_uri, '--gcs-root', str(gcs_root)])
+    assert summary['cpus'] >= 1
+
+    out_dir = tmp_path / 'gwas_data'
+    result = run_worker(python, worker_dir, ['convert', '--out', str(out_dir), '--genotype', gen_uri,
+                                             '--covariates', cov_uri, '--gcs-root', str(gcs_root), '--workers', '2'])
+    assert result['genotype']['subjects'] == 20
+    assert result['covariates']['num_covs'] >= 1
+    assert sorted(os.listdir(str(out_dir))) == ['cov.txt', 'geno.txt', 'pheno.txt', 'pos.txt']
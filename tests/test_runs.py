@@ -0,0 +1,51 @@
+import json
+import os
+import tempfile
+
+import pytest
+
+# the run registry is created when runs.py is imported, so it must not land in the working directory
+os.environ.setdefault('GWAS_RUNS_DB', os.path.join(tempfile.mkdtemp(prefix='gwas-runs-'), 'runs.db'))
+
+import runs
+from protorun import MAX_LINE_CHARS
+from remote import LocalBackend
+from scheduler import ProtocolRound
+
+
+@pytest.fixture
+def backend(tmp_path, monkeypatch):
+    monkeypatch.setattr(runs, 'RUNS_DB', str(tmp_path / 'runs.db'))
+    runs.init_runs_db()
+    return LocalBackend(str(tmp_path / 'instances'))
+
+
+def test_long_output_lines_are_split(backend):
+    line = 'x' * (3 * MAX_LINE_CHARS + 5)
+    rounds = [ProtocolRound('r0', ['echo {}'.format(line), 'echo completed'])]
+    run_id = runs.launch_run('p', 'i', runs.RUN_GWAS, rounds, 1, 0, backend)
+    run = runs.get_run(run_id)
+
+    events = [event for _, event in runs.follow_run(run, poll_interval=0.1, backend=backend)]
+    pieces = [event['line'] for event in events if event['event'] == 'line']
+    assert pieces == ['x' * MAX_LINE_CHARS] * 3 + ['xxxxx']
+    assert events[-1]['event'] == 'done' and events[-1]['failed'] == []
+
+    run = runs.get_run(run_id)
+    assert run['status'] == runs.RUN_COMPLETED
+    assert run['finished'] - run['started'] == pytest.approx(events[-1]['t'], abs=1e-3)
+
+
+def test_events_longer_than_a_read_are_read_whole(backend):
+    run = {'id': 'long', 'project': 'p', 'instance': 'i', 'status': runs.RUN_RUNNING, 'started': 0}
+    run_dir = backend.local_path('p', 'i', runs.remote_run_dir('long'))
+    os.makedirs(run_dir)
+    written = [{'event': 'line', 'tag': 'r0', 'line': 'y' * 1000, 't': 1}, {'event': 'done', 'failed': [], 't': 2}]
+    with open(os.path.join(run_dir, 'events.log'), 'w') as f:
+        for event in written:
+            f.write(json.dumps(event) + '\n')
+
+    alive, events = runs.read_run_log(run, 0, max_bytes=100, backend=backend)
+    assert not alive
+    assert [event for _, event in events] == written
+    assert events[-1][0] == os.path.getsize(os.path.join(run_dir, 'events.log'))
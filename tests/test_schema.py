@@ -0,0 +1,159 @@
+import random
+import string
+
+import pytest
+
+from schema import FIELD_NAMES, MAX_PORT, ConfigError, GwasConfig, check_config, dataset_port_ranges, \
+    parse_config_lines, validate_config
+
+
+# Seeds of the randomly generated configs and config lines every property is checked against
+SEEDS = range(200)
+
+
+def random_word(rng):
+    return ''.join(rng.choice(string.ascii_letters + string.digits + '._-') for _ in range(rng.randint(1, 12)))
+
+
+# A random config that passes validation
+def random_valid_config(rng):
+    num_S = rng.randint(1, 6)
+    num_threads = rng.randint(1, 20)
+    return GwasConfig(
+        IP_ADDR_P0='10.0.0.{}'.format(rng.randint(1, 254)),
+        IP_ADDR_P1='10.0.1.{}'.format(rng.randint(1, 254)),
+        IP_ADDR_P2=rng.choice(['', '10.0.2.{}'.format(rng.randint(1, 254))]),
+        NUM_S=num_S,
+        CP_ROLE=rng.choice([None, 0, 1, 2]),
+        S_ROLE=rng.choice([None, rng.randrange(num_S)]),
+        PROJ0=random_word(rng),
+        PROJ1=random_word(rng),
+        PROJ2=random_word(rng),
+        PROJ3=[random_word(rng) for _ in range(num_S)],
+        NUM_INDS=[rng.randint(0, 10 ** 6) for _ in range(num_S)],
+        NUM_SNPS=rng.randint(0, 10 ** 7),
+        NUM_COVS=rng.randint(0, 50),
+        NUM_CHUNKS=[rng.randint(1, 100) for _ in range(num_S)],
+        NUM_THREADS=num_threads,
+        NTL_NUM_THREADS=rng.randint(0, 64),
+        NUM_PARALLEL_ROUNDS=rng.choice([None, rng.randint(1, 8)]))
+
+
+# Render a config as the lines of a config.txt file, in a random order, with blank and comment lines mixed in
+def config_lines(config, rng):
+    lines = []
+    for name, value in config.to_dict().items():
+        if value is None:
+            tokens = []
+        elif isinstance(value, list):
+            tokens = [str(v) for v in value]
+        else:
+            tokens = [str(value)]
+        lines.append(' '.join([name] + tokens) + rng.choice(['', ' ', '\t', '\n']))
+    for _ in range(rng.randint(0, 3)):
+        lines.append(rng.choice(['', '   ', '# a comment', '#NUM_S 3']))
+    rng.shuffle(lines)
+    return lines
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_valid_config_round_trips_through_file(seed):
+    rng = random.Random(seed)
+    config = random_valid_config(rng)
+    assert validate_config(config) == []
+    assert parse_config_lines(config_lines(config, rng)) == config
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_valid_config_round_trips_through_dict(seed):
+    config = random_valid_config(random.Random(seed))
+    assert GwasConfig.from_dict(config.to_dict()) == config
+    # the dict of a config is a copy, so changing it leaves the config alone
+    d = config.to_dict()
+    d['NUM_INDS'].append(1)
+    assert config.NUM_INDS != d['NUM_INDS']
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_random_lines_only_raise_config_errors(seed):
+    rng = random.Random(seed)
+    keywords = list(FIELD_NAMES) + ['NUM_', 'num_s', 'UNKNOWN', '#', '']
+    lines = []
+    for _ in range(rng.randint(0, 10)):
+        tokens = [rng.choice(keywords)] + [rng.choice([random_word(rng), str(rng.randint(-5, 5)), '1.5', 'None'])
+                                           for _ in range(rng.randint(0, 4))]
+        lines.append(rng.choice([' ', '\t', '  ']).join(tokens))
+    try:
+        config = parse_config_lines(lines)
+    except ConfigError as e:
+        assert e.errors
+        assert all(error.startswith('line ') for error in e.errors)
+    else:
+        assert isinstance(config, GwasConfig)
+        # validation never raises anything but ConfigError either
+        try:
+            check_config(config)
+        except ConfigError as e:
+            assert e.errors
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_mismatched_lengths_are_reported(seed):
+    rng = random.Random(seed)
+    config = random_valid_config(rng)
+    name = rng.choice(['NUM_INDS', 'NUM_CHUNKS'])
+    values = getattr(config, name)
+    if rng.random() < 0.5 or len(values) == 1:
+        values.append(1)
+    else:
+        values.pop()
+    errors = validate_config(config)
+    assert len(errors) == 1
+    assert errors[0].startswith(name)
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_roles_out_of_range_are_reported(seed):
+    rng = random.Random(seed)
+    config = random_valid_config(rng)
+    config.CP_ROLE = rng.choice([-1, 3, 100])
+    config.S_ROLE = rng.choice([-1, config.NUM_S, config.NUM_S + 5])
+    errors = validate_config(config)
+    assert any(error.startswith('CP_ROLE') for error in errors)
+    assert any(error.startswith('S_ROLE') for error in errors)
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_port_limit(seed):
+    rng = random.Random(seed)
+    config = random_valid_config(rng)
+    config.NUM_THREADS = rng.randint(1, 3000)
+    last_port = dataset_port_ranges(config.NUM_S, config.NUM_THREADS)[-1][1] - 1
+    errors = validate_config(config)
+    assert any('past the highest port' in error for error in errors) == (last_port > MAX_PORT)
+
+
+@pytest.mark.parametrize('num_S', [1, 2, 5, 20])
+@pytest.mark.parametrize('num_threads', [1, 3, 20])
+def test_dataset_port_ranges_are_disjoint(num_S, num_threads):
+    ranges = dataset_port_ranges(num_S, num_threads)
+    assert len(ranges) == num_S
+    for (_, prev_end), (start, _) in zip(ranges, ranges[1:]):
+        assert prev_end <= start
+
+
+def test_errors_report_line_numbers():
+    lines = ['NUM_S 2', '', '# comment', 'NUM_S 3', 'NUM_SNPS lots', 'BOGUS 1', 'NUM_THREADS']
+    with pytest.raises(ConfigError) as e:
+        parse_config_lines(lines)
+    assert e.value.errors == [
+        'line 4: NUM_S is given more than once',
+        "line 5: NUM_SNPS must be an integer, got 'lots'",
+        'line 6: Unknown config parameter BOGUS',
+        'line 7: NUM_THREADS needs a value'
+    ]
+
+
+def test_blank_file_gives_defaults():
+    assert parse_config_lines(['', '  \n', '# nothing here\n']) == GwasConfig()
+    assert validate_config(GwasConfig()) == []